@@ -0,0 +1,6 @@
+"""
+Librerian benchmarks
+
+Standalone scripts, run from the repository root, for example
+    python -m benchmarks.bench_validation
+"""
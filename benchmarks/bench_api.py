@@ -0,0 +1,193 @@
+"""
+Benchmark suite of the API endpoints
+
+Databases of 1k, 100k and 1M books are seeded with gen-db and every
+collection and item endpoint, and the POST and PUT of works and books, is
+called repeatedly with the test client. Throughput and p50 and p99 latency
+are printed for each endpoint and size.
+
+Results can be saved as a JSON baseline. When a baseline is given, the run
+fails if the p50 latency of an endpoint grew by more than the tolerance.
+Baselines are only comparable on the same machine.
+
+Usage:
+    python -m benchmarks.bench_api [--sizes N [N ...]] [--repeat R]
+        [--save PATH] [--baseline PATH] [--tolerance T]
+"""
+import argparse
+import json
+import platform
+import sqlite3
+import sys
+import time
+
+from sqlalchemy import select
+
+from benchmarks.common import measure, summary, temp_app
+from librerian import db
+from librerian.constants import BOOK_BORROWED
+from librerian.models import Book, Library, User, Work
+
+SIZES = (1000, 100000, 1000000)
+BOOKS_PER_USER = 8
+WORK_RANK = 100
+
+def populate(app, books, seed=1):
+    """
+    Seed books books with gen-db, 8 per user
+    """
+    result = app.test_cli_runner().invoke(
+        args=["gen-db", "--count", str(max(1, books // BOOKS_PER_USER)), "--seed", str(seed)]
+    )
+    assert result.exit_code == 0, result.output
+    print(result.output.splitlines()[0])
+
+def fixtures(app):
+    """
+    URL parts of the rows the endpoints are called with
+    A work of average popularity is used, the most popular works have a
+    large share of all books
+    """
+    with app.app_context():
+        user = db.session.get(User, 1)
+        library = db.session.scalars(select(Library).where(Library.owner_id == user.id)).first()
+        book = db.session.scalars(select(Book).where(Book.library_id == library.id)).first()
+        borrowed = db.session.scalars(select(Book).where(Book.status == BOOK_BORROWED)).first()
+        work = db.session.scalars(
+            select(Work).order_by(Work.total_copies.desc()).offset(WORK_RANK)
+        ).first() or db.session.get(Work, 1)
+        last_work = db.session.scalars(select(Work).order_by(Work.id.desc())).first()
+        library_url = f"/api/users/{user.handle}/libraries/{library.name}/"
+        return {
+            "user": f"/api/users/{user.handle}/",
+            "library": library_url,
+            "book": f"{library_url}books/{book.id}/",
+            "book_doc": {"status": book.status, "work_id": book.work_id},
+            "loans": f"/api/books/{borrowed.id}/loans/",
+            "borrower": f"/api/users/{borrowed.borrower.handle}/loans/",
+            "work": f"/api/works/{work.id}/",
+            "title": work.title,
+            "put_work": f"/api/works/{last_work.id}/",
+        }
+
+def cases(urls):
+    """
+    Benchmark cases as (name, method, url, document function, expected status)
+    """
+    return [
+        ("GET users", "get", "/api/users/", None, 200),
+        ("GET user", "get", urls["user"], None, 200),
+        ("GET user libraries", "get", urls["user"] + "libraries/", None, 200),
+        ("GET user loans", "get", urls["borrower"], None, 200),
+        ("GET libraries", "get", "/api/libraries/", None, 200),
+        ("GET library", "get", urls["library"], None, 200),
+        ("GET library books", "get", urls["library"] + "books/", None, 200),
+        ("GET books", "get", "/api/books/", None, 200),
+        ("GET book", "get", urls["book"], None, 200),
+        ("GET book loans", "get", urls["loans"], None, 200),
+        ("GET works", "get", "/api/works/", None, 200),
+        ("GET works search", "get", f"/api/works/search/?q={urls['title']}", None, 200),
+        ("GET work", "get", urls["work"], None, 200),
+        (
+            "POST work", "post", "/api/works/",
+            lambda i: {"title": f"bench-{i}", "author": "bench"}, 201
+        ),
+        (
+            "PUT work", "put", urls["put_work"],
+            lambda i: {"title": f"bench-{i}", "author": "bench"}, 204
+        ),
+        (
+            "POST book", "post", urls["library"] + "books/",
+            lambda i: {**urls["book_doc"], "notes": f"bench-{i}"}, 201
+        ),
+        (
+            "PUT book", "put", urls["book"],
+            lambda i: {**urls["book_doc"], "notes": f"bench-{i}"}, 204
+        ),
+    ]
+
+def run(app, repeat):
+    """
+    Measure every case, returns summaries by case name
+    """
+    client = app.test_client()
+    results = {}
+    for name, method, url, document, status in cases(fixtures(app)):
+        counter = iter(range(sys.maxsize))
+
+        def call():
+            kwargs = {} if document is None else {"json": document(next(counter))}
+            resp = getattr(client, method)(url, **kwargs)
+            assert resp.status_code == status, (name, resp.status_code, resp.data[:200])
+
+        results[name] = summary(measure(call, repeat, max(1, repeat // 10)))
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Print p50 latency against the baseline, returns the regressions
+    """
+    regressions = []
+    for size, cases_results in results.items():
+        for name, stats in cases_results.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None:
+                continue
+            ratio = stats["p50"] / base["p50"]
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = "  REGRESSION"
+                regressions.append((size, name, ratio))
+            print(f"{size:>8} {name:<24} p50 {ratio:6.2f}x baseline{flag}")
+    return regressions
+
+def main():
+    """
+    Run the suite for each size and compare with or save a baseline
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--save", help="write results as a baseline to this file")
+    parser.add_argument("--baseline", help="compare with the baseline in this file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 growth")
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        with temp_app() as app:
+            started = time.perf_counter()
+            populate(app, size)
+            print(f"seeded {size} books in {time.perf_counter() - started:.1f} s")
+            results[str(size)] = run(app, args.repeat)
+        for name, stats in results[str(size)].items():
+            print(
+                f"{size:>8} {name:<24} {stats['rps']:8.1f} req/s"
+                f"  p50 {stats['p50'] * 1e6:10.1f} us  p99 {stats['p99'] * 1e6:10.1f} us"
+            )
+
+    if args.save:
+        document = {
+            "environment": {
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "machine": platform.machine(),
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }
+        with open(args.save, "w", encoding="utf-8") as baseline_file:
+            json.dump(document, baseline_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(
+                f"{len(regressions)} endpoints slower than the baseline "
+                f"by over {args.tolerance:.0%}"
+            )
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Benchmark of the async ASGI read path against the WSGI Flask app
+
+Requests for a page of works and books are kept in flight at a fixed
+concurrency. The Flask app is run by a thread pool with one thread per
+request in flight, as a threaded WSGI server would, and through the ASGI
+fallback wrapper. The async handlers are run on one event loop. Both paths
+record metrics and check the query log, the response cache is off so that
+every request is handled.
+
+Usage:
+    python -m benchmarks.bench_asgi [--requests N] [--concurrency C [C ...]]
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import insert
+
+from benchmarks.common import report, temp_app
+from librerian import db
+from librerian.asgi import AsyncReadApp
+from librerian.models import Book, Library, User, Work
+
+URLS = ("/api/works/?limit=50", "/api/books/?limit=50")
+
+def populate(app, count):
+    """
+    Add count works with one book each
+    """
+    with app.app_context():
+        user = User(handle="bench", email="bench@email.com")
+        library = Library(name="bench", owner=user)
+        db.session.add(library)
+        db.session.commit()
+        db.session.execute(insert(Work), [
+            {"title": f"title-{i}", "author": f"author-{i % 100}"} for i in range(count)
+        ])
+        db.session.execute(insert(Book), [
+            {"status": 0, "work_id": i + 1, "library_id": library.id} for i in range(count)
+        ])
+        db.session.commit()
+
+def run_threads(app, requests, concurrency):
+    """
+    Serve requests with the WSGI app in a pool of concurrency threads
+    """
+    clients = [app.test_client() for _i in range(concurrency)]
+
+    def worker(index):
+        client = clients[index % concurrency]
+        start = time.perf_counter()
+        resp = client.get(URLS[index % len(URLS)])
+        assert resp.status_code == 200
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(worker, range(requests)))
+
+async def asgi_get(app, url):
+    """
+    Send a GET request to an ASGI app and return its latency
+    """
+    path, _, query = url.partition("?")
+    scope = {
+        "type": "http", "method": "GET", "path": path, "query_string": query.encode(),
+        "root_path": "", "headers": [], "http_version": "1.1", "scheme": "http",
+        "server": ("localhost", 80), "client": ("127.0.0.1", 1234),
+    }
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    assert status == [200]
+    return time.perf_counter() - start
+
+async def run_asgi(app, requests, concurrency):
+    """
+    Serve requests with an ASGI app keeping concurrency requests in flight
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(index):
+        async with semaphore:
+            return await asgi_get(app, URLS[index % len(URLS)])
+
+    return await asyncio.gather(*(bounded(index) for index in range(requests)))
+
+def main():
+    """
+    Run the read benchmark for each concurrency level
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    args = parser.parse_args()
+
+    with temp_app({"SQLITE_POOL_SIZE": max(args.concurrency)}) as app:
+        populate(app, args.count)
+        async_app = AsyncReadApp(app)
+        wsgi_app = WsgiToAsgi(app)
+
+        async def run_all(concurrency):
+            await run_asgi(async_app, 50, concurrency)
+            started = time.perf_counter()
+            asgi = await run_asgi(async_app, args.requests, concurrency)
+            asgi_rate = args.requests / (time.perf_counter() - started)
+            started = time.perf_counter()
+            fallback = await run_asgi(wsgi_app, args.requests, concurrency)
+            fallback_rate = args.requests / (time.perf_counter() - started)
+            return asgi, asgi_rate, fallback, fallback_rate
+
+        for concurrency in args.concurrency:
+            started = time.perf_counter()
+            threads = run_threads(app, args.requests, concurrency)
+            threads_rate = args.requests / (time.perf_counter() - started)
+            asgi, asgi_rate, fallback, fallback_rate = asyncio.run(run_all(concurrency))
+            for name, latencies, rate in (
+                ("wsgi threads", threads, threads_rate),
+                ("asgi wsgi wrapper", fallback, fallback_rate),
+                ("asgi async handlers", asgi, asgi_rate),
+            ):
+                report(f"{name} c={concurrency} {rate:8.1f} req/s", latencies)
+        asyncio.run(async_app.dispose())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark of JSON encoders on a book listing of 100k items
+
+The items of /api/books/ are built once and encoded as one body with
+json.dumps as the resources used to, and with the stdlib and orjson
+encoders of librerian.encoding. The whole listing is then streamed through
+the API with each encoder.
+
+Usage:
+    python -m benchmarks.bench_encoding [--rows N] [--repeat R]
+"""
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from benchmarks.common import measure, report, temp_app
+from librerian import db
+from librerian.encoding import get_encoder, orjson
+from librerian.models import Book, Library, User, Work
+from librerian.resources.book import eager_books, itemize
+
+START = datetime(2024, 1, 1)
+
+def populate(app, rows, seed=1):
+    """
+    Add rows books on 1000 works in 100 libraries, half of them borrowed
+    """
+    generator = random.Random(seed)
+    with app.app_context():
+        db.session.execute(insert(User), [
+            {"handle": f"bench-{i}", "email": f"bench-{i}@email.com", "version": 1}
+            for i in range(100)
+        ])
+        db.session.execute(insert(Library), [
+            {"name": f"bench-library-{i}", "owner_id": i + 1, "version": 1} for i in range(100)
+        ])
+        db.session.execute(insert(Work), [
+            {"title": f"title-{i}", "author": f"author-{i % 100}", "version": 1}
+            for i in range(1000)
+        ])
+        books = []
+        for i in range(rows):
+            book = {
+                "status": 0, "work_id": generator.randint(1, 1000), "library_id": i % 100 + 1,
+                "notes": f"notes-{i}", "validity_start": None, "validity_end": None, "version": 1
+            }
+            if i % 2:
+                start = START + timedelta(minutes=generator.randrange(365 * 24 * 60))
+                book.update(validity_start=start, validity_end=start + timedelta(days=21))
+            books.append(book)
+        db.session.execute(insert(Book), books)
+        db.session.commit()
+
+def main():
+    """
+    Run the encoding benchmark
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    names = ["json"] + (["orjson"] if orjson is not None else [])
+    with temp_app() as app:
+        populate(app, args.rows)
+        with app.test_request_context():
+            body = {"items": [itemize(book) for book in eager_books().order_by(Book.id)]}
+            size = len(json.dumps(body))
+            print(f"{len(body['items'])} items, {size / 1e6:.1f} MB")
+            report("json.dumps", measure(lambda: json.dumps(body).encode(), args.repeat, 1))
+            for name in names:
+                encoder = get_encoder(name)
+                report(f"{name} encoder", measure(lambda: encoder.dumps(body), args.repeat, 1))
+
+        client = app.test_client()
+        for name in names:
+            app.extensions["json_encoder"] = get_encoder(name)
+
+            def stream():
+                resp = client.get("/api/books/?stream=true")
+                assert resp.status_code == 200
+                return resp.data
+
+            report(f"{name} stream /api/books/", measure(stream, args.repeat, 1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark for building hypermedia links of book items
+
+Builds the four links of book itemize for N books with url_for and with
+the compiled link templates, and checks that both produce the same output.
+
+Usage:
+    python -m benchmarks.bench_links [--items N]
+"""
+import argparse
+import gc
+import time
+
+from flask import url_for
+
+from benchmarks.common import temp_app
+from librerian.links import href
+from librerian.models import User, Library, Book, Work
+
+def book_links(build, book):
+    """
+    Links of book itemize built with build function
+    """
+    return {
+        "self": {
+            "href": build("api.bookitem", book=book, library=book.library, user=book.library.owner)
+        },
+        "collection": {
+            "href": build("api.booklocalcollection", library=book.library, user=book.library.owner)
+        },
+        "up": {
+            "href": build("api.bookglobalcollection")
+        },
+        "type": {
+            "href": build("api.workitem", work=book.work)
+        }
+    }
+
+def main():
+    """
+    Run link building benchmark
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=100000)
+    args = parser.parse_args()
+
+    books = []
+    for i in range(args.items):
+        owner = User(handle=f"user {i % 100}")
+        library = Library(name=f"library's {i % 1000}", owner=owner)
+        books.append(Book(id=i, library=library, work=Work(id=i % 5000)))
+
+    # keep the model objects out of garbage collection so it does not dominate timings
+    gc.collect()
+    gc.freeze()
+
+    with temp_app() as app, app.test_request_context("/api/books/"):
+        results = {}
+        for name, build in (("url_for", url_for), ("href", href)):
+            start = time.perf_counter()
+            results[name] = [book_links(build, book) for book in books]
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:<10} {elapsed:8.3f} s  {elapsed / args.items * 1e6:8.2f} us/item"
+            )
+        assert results["url_for"] == results["href"]
+        print("outputs identical")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of a burst of borrow requests on a popular work
+
+Threads keep borrowing and returning the copies of one work, so most
+requests race for the same rows. Every request is a single conditional
+UPDATE, a lost race is answered with 409 without further writes.
+
+Usage:
+    python -m benchmarks.bench_loans [--requests N] [--copies C] [--concurrency T [T ...]]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import insert
+
+from benchmarks.common import report, temp_app
+from librerian import db
+from librerian.models import Book, Library, User, Work
+
+def populate(app, copies, users):
+    """
+    Add one work with copies available books and users borrowers
+    """
+    with app.app_context():
+        db.session.execute(insert(User), [
+            {"handle": f"bench-{i}", "email": f"bench-{i}@email.com"} for i in range(users)
+        ])
+        library = Library(name="bench", owner=db.session.get(User, 1))
+        work = Work(title="popular", author="bench")
+        db.session.add_all((library, work))
+        db.session.commit()
+        db.session.execute(insert(Book), [
+            {"status": 0, "work_id": work.id, "library_id": library.id} for _i in range(copies)
+        ])
+        db.session.commit()
+
+def run(app, requests, copies, concurrency):
+    """
+    Send borrow and return requests from concurrency threads, returns
+    latencies and status code counts
+    """
+    clients = [app.test_client() for _i in range(concurrency)]
+
+    def worker(index):
+        client = clients[index % concurrency]
+        url = f"/api/books/{index % copies + 1}/loan/"
+        start = time.perf_counter()
+        if index // copies % 2 == 0:
+            resp = client.post(url, json={"borrower": f"bench-{index % concurrency}"})
+        else:
+            resp = client.delete(url)
+        return time.perf_counter() - start, resp.status_code
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(worker, range(requests)))
+    statuses = {}
+    for _latency, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return [latency for latency, _status in results], statuses
+
+def main():
+    """
+    Run the borrow benchmark for each concurrency level
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--copies", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        with temp_app({"SQLITE_POOL_SIZE": concurrency}) as app:
+            populate(app, args.copies, concurrency)
+            started = time.perf_counter()
+            latencies, statuses = run(app, args.requests, args.copies, concurrency)
+            rate = args.requests / (time.perf_counter() - started)
+            report(f"borrow/return c={concurrency} {rate:8.1f} req/s", latencies)
+            print(f"{'':<40} status codes {dict(sorted(statuses.items()))}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark of book and work listings from models and from plain rows
+
+The items of every book and work are built with itemize from models loaded
+with their relationships, and with the row itemizers from plain rows of the
+listed columns. Time and peak memory are measured for each. Pages of 1000
+items and the whole streamed listings are then fetched through the API.
+
+Usage:
+    python -m benchmarks.bench_projection [--rows N] [--repeat R]
+"""
+import argparse
+import tracemalloc
+
+from benchmarks.bench_encoding import populate
+from benchmarks.common import measure, report, temp_app
+from librerian import db
+from librerian.models import Book, Work
+from librerian.resources import book as book_resource
+from librerian.resources import work as work_resource
+
+def model_items(query, itemize):
+    """
+    Items of all rows of a model query, the session is cleared afterwards
+    """
+    items = [itemize(row) for row in query]
+    db.session.expunge_all()
+    return items
+
+def row_items(query, itemizer):
+    """
+    Items of all rows of a column query
+    """
+    itemize = itemizer()
+    return [itemize(row) for row in query]
+
+def peak_memory(func):
+    """
+    Peak memory allocated while func runs, in MB
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+def main():
+    """
+    Run the projection benchmark
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with temp_app() as app:
+        populate(app, args.rows)
+        with app.test_request_context():
+            cases = (
+                ("books from models", lambda: model_items(
+                    book_resource.eager_books().order_by(Book.id), book_resource.itemize
+                )),
+                ("books from rows", lambda: row_items(
+                    book_resource.book_rows().order_by(Book.id), book_resource.row_itemizer
+                )),
+                ("works from models", lambda: model_items(
+                    Work.query.order_by(Work.id), work_resource.itemize
+                )),
+                ("works from rows", lambda: row_items(
+                    db.session.query(*work_resource.WORK_COLUMNS).order_by(Work.id),
+                    work_resource.row_itemizer
+                )),
+            )
+            for name, func in cases:
+                report(name, measure(func, args.repeat, 1))
+                print(f"{'':<40} peak memory {peak_memory(func):8.1f} MB")
+
+        client = app.test_client()
+        for url in ("/api/books/?limit=1000", "/api/works/?limit=1000", "/api/books/?stream=true"):
+            repeat = args.repeat if "stream" in url else args.repeat * 20
+
+            def get():
+                resp = client.get(url)
+                assert resp.status_code == 200
+                return resp.data
+
+            report(url, measure(get, repeat, 1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark for work search, FTS5 index against a LIKE scan
+
+Seeds N works with titles and authors drawn from a synthetic vocabulary
+and fetches the first page of matches for the same terms through the FTS5
+index and with LIKE '%term%' filters. The search endpoint is measured
+separately.
+
+Usage:
+    python -m benchmarks.bench_search [--works N] [--repeat N]
+"""
+import argparse
+import random
+import time
+
+from sqlalchemy import func, insert, literal_column, or_, select
+
+from benchmarks.common import measure, report, temp_app
+from librerian import db
+from librerian.models import Work
+from librerian.resources.work import match_expression, work_fts
+
+SYLLABLES = ["ka", "lo", "mi", "ra", "te", "su", "no", "vi", "de", "po", "ri", "an", "el", "or"]
+PAGE_SIZE = 100
+
+def vocabulary(rng, size=5000):
+    """
+    Create list of distinct random words
+    """
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    return sorted(words)
+
+def seed(count, words, rng, chunk_size=10000):
+    """
+    Insert count random works in chunks
+    """
+    for start in range(0, count, chunk_size):
+        rows = [
+            {
+                "title": " ".join(rng.choices(words, k=3)),
+                "author": " ".join(rng.choices(words, k=2)).title(),
+            }
+            for _i in range(min(chunk_size, count - start))
+        ]
+        db.session.execute(insert(Work), rows)
+    db.session.commit()
+
+def fts_page(terms):
+    """
+    First page of works matching all terms, ranked by bm25
+    """
+    rank = func.bm25(literal_column("work_fts")).label("rank")
+    matches = (
+        select(work_fts.c.rowid.label("id"), rank)
+        .where(literal_column("work_fts").op("MATCH")(match_expression(terms)))
+        .subquery()
+    )
+    return (
+        Work.query.join(matches, Work.id == matches.c.id)
+        .order_by(matches.c.rank, matches.c.id).limit(PAGE_SIZE).all()
+    )
+
+def like_page(terms):
+    """
+    First page of works containing all terms in title or author
+    """
+    query = Work.query
+    for term in terms.split():
+        query = query.filter(or_(Work.title.like(f"%{term}%"), Work.author.like(f"%{term}%")))
+    return query.order_by(Work.id).limit(PAGE_SIZE).all()
+
+def main():
+    """
+    Run search benchmark
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--works", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    words = vocabulary(rng)
+    with temp_app() as app:
+        with app.app_context():
+            start = time.perf_counter()
+            seed(args.works, words, rng)
+            print(f"seeded {args.works} works in {time.perf_counter() - start:.1f} s")
+
+            for terms in (words[10], f"{words[20]} {words[30]}", words[40][:4]):
+                report(f"FTS  '{terms}'", measure(lambda: fts_page(terms), args.repeat, 2))
+                report(f"LIKE '{terms}'", measure(lambda: like_page(terms), args.repeat, 2))
+
+        client = app.test_client()
+        report(
+            f"GET /api/works/search/?q={words[10]}",
+            measure(lambda: client.get("/api/works/search/", query_string={"q": words[10]}),
+                    args.repeat, 2)
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Microbenchmark for request body validation on the write path
+
+Compares flasgger.validate, which reads librerian.yml and builds the
+validator on every call, with the schema registry built in create_app.
+Also measures end-to-end POST latency for works and books.
+
+Usage:
+    python -m benchmarks.bench_validation [--repeat N]
+"""
+import argparse
+
+from flasgger import validate as flasgger_validate
+
+from benchmarks.common import measure, report, temp_app
+from librerian import db
+from librerian.models import User, Library, Work
+from librerian.utils import SPEC_PATH
+
+WORK = {"title": "The Brothers Karamazov", "author": "Fyodor Dostoyevsky", "isbn": "978-0374528379"}
+BOOK = {"status": 0, "notes": "Signed", "condition": "Good", "work_id": 1}
+
+def main():
+    """
+    Run validation benchmarks
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    with temp_app() as app:
+        with app.app_context():
+            user = User(handle="bench", email="bench@email.com")
+            db.session.add(Library(name="bench", owner=user))
+            db.session.add(Work(title="bench", author="bench"))
+            db.session.commit()
+
+        registry = app.extensions["schemas"]
+        with app.test_request_context("/api/works/", method="POST", json=WORK):
+            for name, doc in (("Work", WORK), ("Book", BOOK)):
+                report(
+                    f"flasgger.validate {name}",
+                    measure(lambda: flasgger_validate(doc, name, SPEC_PATH), args.repeat)
+                )
+                report(
+                    f"SchemaRegistry.validate {name}",
+                    measure(lambda: registry.validate(doc, name), args.repeat)
+                )
+
+        client = app.test_client()
+        report(
+            "POST /api/works/",
+            measure(lambda: client.post("/api/works/", json=WORK), args.repeat)
+        )
+        report(
+            "POST .../books/",
+            measure(
+                lambda: client.post("/api/users/bench/libraries/bench/books/", json=BOOK),
+                args.repeat
+            )
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of validity window queries on a large book table
+
+The expiry sweep used to read every book and compare validity_end on the
+client. It is compared with the expiring_before filter of the book listing,
+which reads the validity index, streamed whole and as a first page. valid_at
+is measured streamed whole, which reads the index too, and as a first page,
+which scans books in id order.
+
+Usage:
+    python -m benchmarks.bench_validity [--rows N] [--repeat R]
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select
+
+from benchmarks.common import measure, report, temp_app
+from librerian import db
+from librerian.models import Book, Library, User, Work
+
+START = datetime(2024, 1, 1)
+SWEEP_AT = START + timedelta(days=30)
+VALID_AT = START + timedelta(days=365)
+BATCH = 50000
+
+def populate(app, rows, seed=1):
+    """
+    Add rows books, two thirds of them lent for 2 to 8 weeks within two years
+    """
+    generator = random.Random(seed)
+    with app.app_context():
+        user = User(handle="bench", email="bench@email.com")
+        db.session.add(Library(name="bench", owner=user))
+        db.session.execute(insert(Work), [
+            {"title": f"title-{i}", "author": "bench"} for i in range(100)
+        ])
+        db.session.commit()
+        for offset in range(0, rows, BATCH):
+            batch = []
+            for _i in range(min(BATCH, rows - offset)):
+                book = {"status": 0, "work_id": generator.randint(1, 100), "library_id": 1}
+                if generator.random() < 2 / 3:
+                    start = START + timedelta(minutes=generator.randrange(2 * 365 * 24 * 60))
+                    book["status"] = 1
+                    book["validity_start"] = start
+                    book["validity_end"] = start + timedelta(days=generator.randint(14, 56))
+                else:
+                    book["validity_start"] = book["validity_end"] = None
+                batch.append(book)
+            db.session.execute(insert(Book), batch)
+        db.session.commit()
+
+def client_sweep(app):
+    """
+    Expiry sweep that reads the validity of every book
+    """
+    with app.app_context():
+        rows = db.session.execute(select(Book.id, Book.validity_end)).all()
+        return [book_id for book_id, end in rows if end is not None and end < SWEEP_AT]
+
+def api_sweep(client, args):
+    """
+    Sweep that streams the books matching filter args from the book listing
+    """
+    resp = client.get(f"/api/books/?{args}&stream=true")
+    assert resp.status_code == 200
+    return resp.data
+
+def api_page(client, args):
+    """
+    First page of the book listing with filter args
+    """
+    resp = client.get(f"/api/books/?{args}")
+    assert resp.status_code == 200
+    return resp.data
+
+def main():
+    """
+    Run the validity benchmark
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with temp_app() as app:
+        started = time.perf_counter()
+        populate(app, args.rows)
+        print(f"populated {args.rows} books in {time.perf_counter() - started:.1f} s")
+        print(f"{len(client_sweep(app))} books expiring before {SWEEP_AT:%Y-%m-%d}")
+        client = app.test_client()
+        report("client sweep", measure(lambda: client_sweep(app), args.repeat, 1))
+        for name, value in (("expiring_before", SWEEP_AT), ("valid_at", VALID_AT)):
+            args_filter = f"{name}={value.isoformat()}"
+            report(
+                f"{name} stream", measure(lambda: api_sweep(client, args_filter), args.repeat, 1)
+            )
+            report(
+                f"{name} page", measure(lambda: api_page(client, args_filter), args.repeat * 10, 1)
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Load test for concurrent writes from several worker processes
+
+Each worker process creates its own app on a shared database file, like
+gunicorn workers do, and posts works for a fixed time. The default SQLite
+settings (rollback journal, synchronous=FULL) are compared with the engine
+profile of create_app (WAL, synchronous=NORMAL, busy timeout).
+
+Usage:
+    python -m benchmarks.bench_writes [--workers N] [--seconds S]
+"""
+import argparse
+import multiprocessing
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.common import temp_app
+from librerian import create_app, db
+
+PROFILES = {
+    "default": {"SQLITE_PRAGMAS": {"foreign_keys": "ON"}},
+    "tuned": {},
+}
+
+def worker(uri, config, seconds, barrier, results):
+    """
+    Post works until the time is up and report the number of writes and errors
+    """
+    app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "TESTING": True, **config})
+    client = app.test_client()
+    writes = 0
+    locked = 0
+    barrier.wait()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        doc = {"title": f"load-{writes}", "author": "load"}
+        try:
+            resp = client.post("/api/works/", json=doc)
+        except OperationalError:
+            locked += 1
+            continue
+        if resp.status_code == 201:
+            writes += 1
+    with app.app_context():
+        db.engine.dispose()
+    results.put((writes, locked))
+
+def run(profile, workers, seconds):
+    """
+    Run the load test with an engine profile, returns writes per second and errors
+    """
+    config = PROFILES[profile]
+    with temp_app(config) as app:
+        uri = app.config["SQLALCHEMY_DATABASE_URI"]
+        with app.app_context():
+            db.engine.dispose()
+        barrier = multiprocessing.Barrier(workers)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=worker, args=(uri, config, seconds, barrier, results))
+            for _i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        counts = [results.get() for _i in processes]
+        for process in processes:
+            process.join()
+    writes = sum(count[0] for count in counts)
+    locked = sum(count[1] for count in counts)
+    return writes / seconds, locked
+
+def main():
+    """
+    Run the write load test for both engine profiles
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    for profile in PROFILES:
+        rate, locked = run(profile, args.workers, args.seconds)
+        print(
+            f"{profile:<10} {args.workers} workers  {rate:10.1f} writes/s"
+            f"  {locked} database is locked errors"
+        )
+
+if __name__ == "__main__":
+    main()
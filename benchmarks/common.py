@@ -0,0 +1,92 @@
+"""
+Shared helpers for benchmarks
+
+Functions:
+    temp_app
+    measure
+    summary
+    report
+"""
+import os
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+
+from librerian import create_app, db
+
+@contextmanager
+def temp_app(config=None):
+    """
+    Create app with an empty temporary database
+
+    Parameters:
+        config : dict
+            extra app config
+    """
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    test_config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True
+    }
+    test_config.update(config or {})
+    app = create_app(test_config)
+    with app.app_context():
+        db.create_all()
+    try:
+        yield app
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+def measure(func, repeat=1000, warmup=10):
+    """
+    Call func repeatedly and return latencies in seconds
+
+    Parameters:
+        func : function
+        repeat : int
+        warmup : int
+            calls made before measuring
+    """
+    for _i in range(warmup):
+        func()
+    latencies = []
+    for _i in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def summary(latencies):
+    """
+    Mean, p50 and p99 latency in seconds and throughput in calls per second
+
+    Parameters:
+        latencies : list of float
+    """
+    ordered = sorted(latencies)
+    return {
+        "mean": statistics.mean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        "rps": len(ordered) / sum(ordered),
+    }
+
+def report(name, latencies):
+    """
+    Print mean, p50 and p99 latency
+
+    Parameters:
+        name : str
+        latencies : list of float
+    """
+    stats = summary(latencies)
+    print(
+        f"{name:<40} mean {stats['mean'] * 1e6:10.1f} us"
+        f"  p50 {stats['p50'] * 1e6:10.1f} us  p99 {stats['p99'] * 1e6:10.1f} us"
+    )
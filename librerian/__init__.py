@@ -9,9 +9,25 @@ import os
 from flask import Flask, send_from_directory, redirect
 from flask_sqlalchemy import SQLAlchemy
 from flasgger import Swagger, swag_from
+from sqlalchemy.engine import make_url
 from librerian.constants import *
+from librerian.routing import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+def _pool_options(config):
+    """
+    Connection pool options for file based SQLite databases
+    In-memory databases share one connection and are left to flask_sqlalchemy
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return {}
+    return {
+        "pool_size": config["SQLITE_POOL_SIZE"],
+        "max_overflow": config["SQLITE_POOL_OVERFLOW"],
+        "pool_timeout": config["SQLITE_POOL_TIMEOUT"],
+    }
 
 def create_app(test_config=None):
     """
@@ -21,7 +37,38 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        PAGE_SIZE=100,
+        PAGE_SIZE_MAX=1000,
+        STREAM_BATCH_SIZE=1000,
+        CONVERTER_CACHE_SIZE=4096,
+        CONVERTER_CACHE_TTL=300,
+        RESPONSE_CACHE_SIZE=0,
+        RESPONSE_CACHE_CLIENT=None,
+        RESPONSE_CACHE_TIMEOUT=300,
+        SQLITE_PRAGMAS={
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "foreign_keys": "ON",
+            "busy_timeout": 5000,
+            "cache_size": -64000,
+            "mmap_size": 268435456,
+            "temp_store": "MEMORY",
+        },
+        SQLITE_POOL_SIZE=5,
+        SQLITE_POOL_OVERFLOW=10,
+        SQLITE_POOL_TIMEOUT=30,
+        READ_YOUR_WRITES_SECONDS=5,
+        LOAN_ARCHIVE_DIR=os.path.join(app.instance_path, "loan-archive"),
+        LOAN_ARCHIVE_MONTHS=12,
+        LOAN_ARCHIVE_FORMAT="sqlite",
+        METRICS_ENABLED=True,
+        SERVER_TIMING_TOKEN=None,
+        SLOW_QUERY_SECONDS=0.25,
+        N_PLUS_ONE_THRESHOLD=10,
+        QUERY_BUDGETS={},
+        QUERY_BUDGET_STRICT=False,
+        JSON_ENCODER="auto"
     )
 
     app.config["SWAGGER"] = {
@@ -42,22 +89,59 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **_pool_options(app.config), **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    }
     db.init_app(app)
 
     from . import models
     from . import api
     from . import utils
+    from . import cache
+    from . import routing
+    from . import archive
+    from . import metrics
+    from . import querylog
+    from . import encoding
     #from librerian.utils import UserConverter, LibraryConverter, BookConverter, WorkConverter
 
     app.cli.add_command(models.init_db_command)
     app.cli.add_command(models.generate_db_command)
     app.cli.add_command(models.empty_db_command)
+    app.cli.add_command(models.rebuild_fts_command)
+    app.cli.add_command(models.recount_copies_command)
+    app.cli.add_command(routing.sync_replica_command)
+    app.cli.add_command(archive.archive_loans_command)
+    routing.init_app(app)
+    querylog.init_app(app)
+
+    if app.config["SQLITE_PRAGMAS"]:
+        with app.app_context():
+            for engine in db.engines.values():
+                if engine.dialect.name == "sqlite":
+                    models.listen_sqlite_pragmas(engine, app.config["SQLITE_PRAGMAS"])
 
     app.url_map.converters["user"] = utils.UserConverter
     app.url_map.converters["library"] = utils.LibraryConverter
     app.url_map.converters["book"] = utils.BookConverter
+    app.url_map.converters["book_id"] = utils.BookIdConverter
     app.url_map.converters["work"] = utils.WorkConverter
 
+    app.extensions["schemas"] = utils.SchemaRegistry()
+    app.extensions["json_encoder"] = encoding.get_encoder(app.config["JSON_ENCODER"])
+    if app.config["CONVERTER_CACHE_SIZE"] > 0:
+        app.extensions["converter_cache"] = utils.TTLCache(
+            app.config["CONVERTER_CACHE_SIZE"], app.config["CONVERTER_CACHE_TTL"]
+        )
+    if app.config["RESPONSE_CACHE_CLIENT"] is not None:
+        backend = cache.ClientBackend(
+            app.config["RESPONSE_CACHE_CLIENT"], app.config["RESPONSE_CACHE_TIMEOUT"]
+        )
+        cache.ResponseCache(backend).init_app(app)
+    elif app.config["RESPONSE_CACHE_SIZE"] > 0:
+        cache.ResponseCache(cache.LRUBackend(app.config["RESPONSE_CACHE_SIZE"])).init_app(app)
+    if app.config["METRICS_ENABLED"]:
+        metrics.Metrics().init_app(app)
     app.register_blueprint(api.api_bp)
 
     @app.route("/api/")
@@ -6,14 +6,17 @@ from flask_restful import Api
 
 from librerian.resources.user import UserCollection, UserItem
 from librerian.resources.library import LibraryGlobalCollection, LibraryLocalCollection, LibraryItem
-from librerian.resources.book import BookGlobalCollection, BookLocalCollection, BookItem
-from librerian.resources.work import WorkCollection, WorkItem
+from librerian.resources.book import BookGlobalCollection, BookLocalCollection, BookBatch, BookItem
+from librerian.resources.loan import BookLoan, LoanCollection, UserLoanCollection
+from librerian.resources.work import WorkCollection, WorkSearch, WorkBatch, WorkItem
+from librerian.resources.export import UserExport, LibraryExport, BookExport, WorkExport
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
 
 api.add_resource(UserCollection, "/users/")
 api.add_resource(UserItem, "/users/<user:user>/")
+api.add_resource(UserLoanCollection, "/users/<user:user>/loans/")
 
 api.add_resource(LibraryGlobalCollection, "/libraries/")
 api.add_resource(LibraryLocalCollection, "/users/<user:user>/libraries/")
@@ -21,7 +24,18 @@ api.add_resource(LibraryItem, "/users/<user:user>/libraries/<library:library>/")
 
 api.add_resource(BookGlobalCollection, "/books/")
 api.add_resource(BookLocalCollection, "/users/<user:user>/libraries/<library:library>/books/")
+api.add_resource(BookBatch, "/users/<user:user>/libraries/<library:library>/books/batch/")
 api.add_resource(BookItem, "/users/<user:user>/libraries/<library:library>/books/<book:book>/")
 
+api.add_resource(BookLoan, "/books/<book_id:book>/loan/")
+api.add_resource(LoanCollection, "/books/<book:book>/loans/")
+
 api.add_resource(WorkCollection, "/works/")
+api.add_resource(WorkSearch, "/works/search/")
+api.add_resource(WorkBatch, "/works/batch/")
 api.add_resource(WorkItem, "/works/<work:work>/")
+
+api.add_resource(UserExport, "/export/users/")
+api.add_resource(LibraryExport, "/export/libraries/")
+api.add_resource(BookExport, "/export/books/")
+api.add_resource(WorkExport, "/export/works/")
@@ -0,0 +1,311 @@
+"""
+Loan archive
+
+Closed loans that were borrowed before a cutoff month are moved out of the
+loan table into one file per month, a SQLite database or gzip compressed
+NDJSON. Loan listings read the live table and the archive files whose month
+overlaps the requested date range.
+
+Functions:
+    add_months
+    archive_files
+    read_archived_loans
+    archive_loans_command
+"""
+
+import gzip
+import heapq
+import json
+import os
+from operator import itemgetter
+import pathlib
+import re
+import sqlite3
+from datetime import datetime, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, select
+
+from librerian.models import Loan
+from librerian.utils import IN_CHUNK_SIZE
+from librerian import db
+
+ARCHIVE_FILE = re.compile(r"^loans-(\d{4})-(\d{2})\.(sqlite|ndjson\.gz)$")
+ARCHIVE_SUFFIXES = {"sqlite": "sqlite", "ndjson": "ndjson.gz"}
+COLUMNS = ("id", "book_id", "borrower_id", "borrowed_at", "returned_at")
+ARCHIVE_DDL = (
+    "CREATE TABLE IF NOT EXISTS loan (id INTEGER PRIMARY KEY, book_id INTEGER NOT NULL, "
+    "borrower_id INTEGER, borrowed_at TEXT NOT NULL, returned_at TEXT)",
+    "CREATE INDEX IF NOT EXISTS ix_loan_borrower_borrowed_at ON loan (borrower_id, borrowed_at)",
+    "CREATE INDEX IF NOT EXISTS ix_loan_book_borrowed_at ON loan (book_id, borrowed_at)",
+)
+
+def add_months(month, count):
+    """
+    First day of the month count months after the month of a datetime
+
+    Parameters:
+        month : datetime
+        count : int
+            can be negative
+    """
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def archive_files(directory, since=None, until=None):
+    """
+    Archive files in directory as (month, path) pairs ordered by month
+    Only months that overlap [since, until) are listed
+
+    Parameters:
+        directory : str
+        since : datetime
+        until : datetime
+    """
+    if not os.path.isdir(directory):
+        return []
+    files = []
+    for name in os.listdir(directory):
+        match = ARCHIVE_FILE.match(name)
+        if match is None:
+            continue
+        month = datetime(int(match.group(1)), int(match.group(2)), 1)
+        if since is not None and add_months(month, 1) <= since:
+            continue
+        if until is not None and month >= until:
+            continue
+        files.append((month, os.path.join(directory, name)))
+    return sorted(files)
+
+def _text(value):
+    return None if value is None else value.isoformat(sep=" ")
+
+def _record(values):
+    record = dict(values)
+    for name in ("borrowed_at", "returned_at"):
+        if record[name] is not None:
+            record[name] = datetime.fromisoformat(record[name])
+    return record
+
+def _read_sqlite(path, column, value, since, until, after, before, limit):
+    """
+    Matching loans of a SQLite archive file, read through its indexes
+    """
+    clauses = [f"{column} = ?"]
+    params = [value]
+    for clause, param in (
+        ("borrowed_at >= ?", _text(since)), ("borrowed_at < ?", _text(until)),
+        ("id > ?", after), ("id < ?", before)
+    ):
+        if param is not None:
+            clauses.append(clause)
+            params.append(param)
+    order = "id DESC" if before is not None else "id"
+    connection = sqlite3.connect(pathlib.Path(path).as_uri() + "?mode=ro", uri=True)
+    try:
+        rows = connection.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM loan WHERE {' AND '.join(clauses)} "
+            f"ORDER BY {order} LIMIT ?",
+            (*params, -1 if limit is None else limit)
+        ).fetchall()
+    finally:
+        connection.close()
+    return [_record(zip(COLUMNS, row)) for row in rows]
+
+def _matching_lines(path, column, value, since, until, after, before):
+    """
+    Stream the loans of an NDJSON archive file that match the filters
+    Lines without the id value as _NDJSONArchive writes it are skipped
+    before they are parsed. Dates are compared as stored text, as in SQLite
+    archives, and loans written twice by a rerun are yielded once
+    """
+    since, until = _text(since), _text(until)
+    needle = f"{json.dumps(column)}: {json.dumps(value)},"
+    seen = set()
+    with gzip.open(path, "rt", encoding="utf-8") as archive:
+        for line in archive:
+            if needle not in line:
+                continue
+            doc = json.loads(line)
+            if (
+                doc[column] != value
+                or (since is not None and doc["borrowed_at"] < since)
+                or (until is not None and doc["borrowed_at"] >= until)
+                or (after is not None and doc["id"] <= after)
+                or (before is not None and doc["id"] >= before)
+                or doc["id"] in seen
+            ):
+                continue
+            seen.add(doc["id"])
+            yield doc
+
+def _read_ndjson(path, column, value, since, until, after, before, limit):
+    """
+    Matching loans of an NDJSON archive file, at most limit of them are kept
+    while the file is streamed and only those are converted
+    """
+    docs = _matching_lines(path, column, value, since, until, after, before)
+    if limit is None:
+        docs = sorted(docs, key=itemgetter("id"), reverse=before is not None)
+    elif before is None:
+        docs = heapq.nsmallest(limit, docs, key=itemgetter("id"))
+    else:
+        docs = heapq.nlargest(limit, docs, key=itemgetter("id"))
+    return [_record(doc) for doc in docs]
+
+def read_archived_loans(
+    directory, column, value, since=None, until=None, after=None, before=None, limit=None
+):
+    """
+    Read archived loans ordered by id, in descending order if before is given
+    Only the files of months that overlap [since, until) are opened
+
+    Parameters:
+        directory : str
+        column : str
+            book_id or borrower_id
+        value : int
+            id the column must match
+        since : datetime
+        until : datetime
+            range of borrowed_at
+        after : int
+        before : int
+            id cursors, as with keyset pagination
+        limit : int
+
+    Returns:
+        list of dicts with the loan columns
+    """
+    records = {}
+    for _month, path in archive_files(directory, since, until):
+        read = _read_sqlite if path.endswith(".sqlite") else _read_ndjson
+        for record in read(path, column, value, since, until, after, before, limit):
+            records[record["id"]] = record
+    records = sorted(records.values(), key=lambda record: record["id"], reverse=before is not None)
+    return records[:limit]
+
+class _SQLiteArchive:
+    """
+    Monthly archive file as a SQLite database
+
+    Parameters:
+        path : str
+            created with the loan table if it does not exist
+
+    Methods:
+        write
+        close
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        for statement in ARCHIVE_DDL:
+            self.connection.execute(statement)
+
+    def write(self, records):
+        """
+        Insert loans, loans already in the file are skipped
+
+        Parameters:
+            records : list of dicts
+                loan columns, dates as text
+        """
+        self.connection.executemany(
+            f"INSERT OR IGNORE INTO loan ({', '.join(COLUMNS)}) VALUES (?, ?, ?, ?, ?)",
+            [tuple(record[name] for name in COLUMNS) for record in records]
+        )
+
+    def close(self):
+        """
+        Commit the written loans and close the file
+        """
+        self.connection.commit()
+        self.connection.close()
+
+class _NDJSONArchive:
+    """
+    Monthly archive file as gzip compressed NDJSON, appended as a new gzip member
+
+    Parameters:
+        path : str
+
+    Methods:
+        write
+        close
+    """
+    def __init__(self, path):
+        self.file = gzip.open(path, "at", encoding="utf-8")
+
+    def write(self, records):
+        """
+        Append loans, one JSON object per line
+
+        Parameters:
+            records : list of dicts
+                loan columns, dates as text
+        """
+        self.file.writelines(json.dumps(record) + "\n" for record in records)
+
+    def close(self):
+        """
+        Finish the gzip member and close the file
+        """
+        self.file.close()
+
+@click.command("archive-loans")
+@click.option("--months", type=int, default=None, help="Number of months kept in the database")
+@click.option(
+    "--format", "archive_format", type=click.Choice(list(ARCHIVE_SUFFIXES)), default=None
+)
+@with_appcontext
+def archive_loans_command(months=None, archive_format=None):
+    """
+    Click command for moving closed loans borrowed before the last months
+    into monthly archive files
+    Files are written before the loans are deleted. If the command fails in
+    between, a loan can end up in the table and in a file, or twice in a
+    file after a rerun, listings keep one copy per loan id
+    """
+    config = current_app.config
+    months = config["LOAN_ARCHIVE_MONTHS"] if months is None else months
+    archive_format = archive_format or config["LOAN_ARCHIVE_FORMAT"]
+    directory = config["LOAN_ARCHIVE_DIR"]
+    cutoff = add_months(datetime.now(timezone.utc), -months)
+    os.makedirs(directory, exist_ok=True)
+
+    table = Loan.__table__
+    query = (
+        select(table)
+        .where(table.c.returned_at.is_not(None), table.c.borrowed_at < cutoff)
+        .order_by(table.c.id)
+    )
+    archives = {}
+    ids = []
+    try:
+        result = db.session.execute(query, execution_options={"yield_per": IN_CHUNK_SIZE})
+        for partition in result.mappings().partitions():
+            by_month = {}
+            for row in partition:
+                record = dict(row)
+                month = add_months(record["borrowed_at"], 0)
+                record["borrowed_at"] = _text(record["borrowed_at"])
+                record["returned_at"] = _text(record["returned_at"])
+                by_month.setdefault(month, []).append(record)
+                ids.append(record["id"])
+            for month, records in by_month.items():
+                if month not in archives:
+                    name = f"loans-{month:%Y-%m}.{ARCHIVE_SUFFIXES[archive_format]}"
+                    path = os.path.join(directory, name)
+                    archive_class = _SQLiteArchive if archive_format == "sqlite" else _NDJSONArchive
+                    archives[month] = archive_class(path)
+                archives[month].write(records)
+    finally:
+        for archive in archives.values():
+            archive.close()
+
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        db.session.execute(delete(table).where(table.c.id.in_(ids[start:start + IN_CHUNK_SIZE])))
+    db.session.commit()
+    print(f"Archived {len(ids)} loans borrowed before {cutoff:%Y-%m} into {len(archives)} files")
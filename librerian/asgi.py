@@ -0,0 +1,300 @@
+"""
+ASGI entry point
+
+The hot read endpoints, work, book and library listings and work items, are
+served by async handlers on an aiosqlite engine, so one process serves as
+many of them at a time as there are requests in flight. Every other request
+is passed to the Flask app, which runs in a thread pool. Without aiosqlite,
+or with an in-memory database, all requests are passed to the Flask app.
+
+The async path is observed like the Flask app: the statements of the async
+engines are recorded by the metrics and checked by the query log, the
+requests are timed, and the responses pass through the after request hooks
+of the app, so they are counted, checked against their query budget and
+stored in the response cache, which answers cached GET requests before they
+are dispatched.
+
+Run with an ASGI server, for example
+    uvicorn --factory librerian.asgi:create_asgi_app
+
+Classes:
+    AsyncReadApp
+
+Functions:
+    create_asgi_app
+"""
+
+import io
+import sys
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import url_for
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+
+try:
+    import aiosqlite
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+except ImportError:
+    aiosqlite = None
+
+from librerian import create_app, db, querylog
+from librerian.api import api_bp
+from librerian.cache import cache_tags
+from librerian.encoding import json_response
+from librerian.metrics import START_KEY, timing
+from librerian.models import Book, Library, Work, listen_sqlite_pragmas
+from librerian.resources import book as book_resource
+from librerian.resources import library as library_resource
+from librerian.resources import work as work_resource
+from librerian.routing import REPLICA_BIND, use_replica
+from librerian.utils import (
+    flag_arg, make_etag, not_modified, page_query, page_rows, row_etag, table_versions,
+    versions_etag
+)
+
+class AsyncReadApp:
+    """
+    ASGI app serving the hot read endpoints with async handlers in front of
+    the Flask app
+
+    Parameters:
+        flask_app : Flask
+
+    Methods:
+        dispose
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.fallback = WsgiToAsgi(flask_app)
+        prefix = api_bp.url_prefix
+        # each handler with the endpoint of the Flask resource it stands in for
+        self.routes = Map([
+            Rule(f"{prefix}/works/", endpoint=(self._works, "api.workcollection")),
+            Rule(f"{prefix}/works/<int:work>/", endpoint=(self._work, "api.workitem")),
+            Rule(f"{prefix}/books/", endpoint=(self._books, "api.bookglobalcollection")),
+            Rule(
+                f"{prefix}/libraries/", endpoint=(self._libraries, "api.libraryglobalcollection")
+            ),
+        ]).bind("localhost")
+        self.engines = {}
+        config = flask_app.config
+        metrics = flask_app.extensions.get("metrics")
+        with flask_app.app_context():
+            for key, engine in db.engines.items():
+                async_engine = create_async_engine(
+                    engine.url.set(drivername="sqlite+aiosqlite"),
+                    pool_size=config["SQLITE_POOL_SIZE"],
+                    max_overflow=config["SQLITE_POOL_OVERFLOW"],
+                    pool_timeout=config["SQLITE_POOL_TIMEOUT"],
+                )
+                if config["SQLITE_PRAGMAS"]:
+                    listen_sqlite_pragmas(async_engine.sync_engine, config["SQLITE_PRAGMAS"])
+                querylog.listen(async_engine.sync_engine)
+                if metrics is not None:
+                    metrics.listen(async_engine.sync_engine)
+                self.engines[key] = async_engine
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] == "GET":
+            environ = _environ(scope)
+            environ[START_KEY] = time.perf_counter()
+            try:
+                route, values = self.routes.match(environ["PATH_INFO"], method="GET")
+            except HTTPException:
+                route = None
+            if route is not None:
+                cache = self.flask_app.extensions.get("response_cache")
+                response = None if cache is None else cache.cached_response(environ)
+                if response is None:
+                    response = await self._dispatch(environ, *route, values)
+                if response is not None:
+                    await _send_response(response, send)
+                    return
+        await self.fallback(scope, receive, send)
+
+    async def dispose(self):
+        """
+        Close the connections of the async engines
+        """
+        for engine in self.engines.values():
+            await engine.dispose()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _dispatch(self, environ, handler, endpoint, values):
+        """
+        Run handler in a request context of endpoint and the after request
+        hooks of the Flask app on its response, None if the request should be
+        passed to the Flask app instead
+        """
+        ctx = self.flask_app.request_context(environ)
+        # pushing the context would match the request with the URL converters
+        # of the app, which load the objects synchronously
+        url_adapter, ctx.url_adapter = ctx.url_adapter, None
+        ctx.push()
+        ctx.url_adapter = url_adapter
+        ctx.request.url_rule = next(self.flask_app.url_map.iter_rules(endpoint))
+        ctx.request.view_args = values
+        try:
+            if flag_arg("stream"):
+                return None
+            engine = self.engines[REPLICA_BIND if use_replica() else None]
+            async with AsyncSession(engine) as session:
+                response = await handler(session, **values)
+            if response is None:
+                return None
+            return self.flask_app.process_response(response)
+        except HTTPException:
+            # the Flask app renders errors
+            return None
+        finally:
+            ctx.pop()
+
+    async def _works(self, session):
+        cache_tags("works")
+        return await _collection(
+            session, work_resource.filter_works(select(*work_resource.WORK_COLUMNS)), Work.id,
+            work_resource.row_itemizer(), ("work",), "api.workcollection", projected=True
+        )
+
+    async def _books(self, session):
+        cache_tags("books", "names")
+        statement = book_resource.book_rows(select(*book_resource.BOOK_COLUMNS))
+        return await _collection(
+            session, book_resource.filter_books(statement), Book.id, book_resource.row_itemizer(),
+            ("book", "library", "user"), "api.bookglobalcollection", projected=True
+        )
+
+    async def _libraries(self, session):
+        cache_tags("libraries", "names")
+        return await _collection(
+            session, select(Library).options(joinedload(Library.owner)), Library.id,
+            library_resource.itemize, ("library", "user"), "api.libraryglobalcollection"
+        )
+
+    async def _work(self, session, work):
+        cache_tags(f"work:{work}", "names", "copies")
+        work = await session.get(Work, work)
+        if work is None:
+            return None
+        tables = ("book", "library", "user")
+        versions = dict((await session.execute(table_versions(tables))).all())
+        tables_etag = versions_etag(versions, tables)
+        etag = None if tables_etag is None else make_etag(row_etag(work), tables_etag)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        books = await session.scalars(
+            select(Book).options(*book_resource.book_options()).where(Book.work_id == work.id)
+        )
+        with timing("serialize"):
+            data = work_resource.itemize(work)
+            data["links"]["items"] = [work_resource.itemize_book(book) for book in books.unique()]
+            response = json_response(data)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
+
+async def _collection(session, statement, key, itemize, tables, endpoint, projected=False):
+    """
+    Async counterpart of collection_response for a page of a collection
+    projected statements select plain rows instead of models
+    """
+    versions = dict((await session.execute(table_versions(tables))).all())
+    etag = versions_etag(versions, tables)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    statement, limit = page_query(statement, key)
+    result = await session.execute(statement)
+    rows = result.all() if projected else list(result.unique().scalars())
+    rows, page_links = page_rows(rows, key, limit, endpoint)
+    links = {
+        "self": {
+            "href": url_for(endpoint)
+        }
+    }
+    links.update(page_links)
+    with timing("serialize"):
+        body = {
+            "items": [itemize(row) for row in rows],
+            "links": links
+        }
+        response = json_response(body)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+def _environ(scope):
+    """
+    WSGI environ of an ASGI HTTP request without a body
+    """
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf8").decode("latin1"),
+        "PATH_INFO": path.encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin1")
+        environ[name] = environ[name] + "," + value if name in environ else value
+    return environ
+
+async def _send_response(response, send):
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [
+            (name.lower().encode("latin1"), value.encode("latin1"))
+            for name, value in response.headers.items()
+        ],
+    })
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+def create_asgi_app(test_config=None):
+    """
+    Create ASGI app, see create_app for test_config
+    """
+    flask_app = create_app(test_config)
+    with flask_app.app_context():
+        database = db.engine.url.database
+    if aiosqlite is None or database in (None, "", ":memory:"):
+        app = WsgiToAsgi(flask_app)
+        app.flask_app = flask_app
+        return app
+    return AsyncReadApp(flask_app)
@@ -0,0 +1,345 @@
+"""
+Response cache for read endpoints
+
+Cached GET responses are keyed on the request path and query string and are
+served before the request reaches Flask, so a hit does not touch the database.
+Each entry records the tags of the data it was built from. Writes invalidate
+tags, which makes every entry built with an older version of the tag a miss.
+
+URL converters load their instances before the handler declares its tags.
+Every write also invalidates GENERATION_TAG, which is read before the first
+instance is loaded. A response whose generation changed while it was built
+is not stored, it could hold data older than its tag tokens.
+
+Classes:
+    LRUBackend
+    ClientBackend
+    ResponseCache
+
+Functions:
+    hold_generation
+    cache_tags
+    invalidate
+"""
+
+import secrets
+import threading
+from collections import OrderedDict
+
+from flask import current_app, g, request
+from werkzeug.wrappers import Response
+
+from librerian.routing import use_replica
+
+RESPONSE_PREFIX = "response:"
+TAG_PREFIX = "tag:"
+UNCACHED_HEADERS = ("Set-Cookie", "Server-Timing")
+GENERATION_TAG = "*"
+
+class LRUBackend:
+    """
+    In-process least recently used backend
+
+    Methods:
+        get
+        get_many
+        set
+        set_many
+        add
+        delete
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get value of key, None if it is not stored
+        """
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def get_many(self, keys):
+        """
+        Get values of keys as a list, None for keys that are not stored
+        """
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        """
+        Store value of key, evicting the least recently used key if full
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def set_many(self, mapping):
+        """
+        Store all the values of mapping
+        """
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def add(self, key, value):
+        """
+        Store value of key if the key is not stored yet
+        Returns True if the value was stored
+        """
+        with self._lock:
+            if key in self._data:
+                return False
+        self.set(key, value)
+        return True
+
+    def delete(self, key):
+        """
+        Remove key
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+class ClientBackend:
+    """
+    Backend for an external cache client with the cachelib interface,
+    for example cachelib.RedisCache or cachelib.MemcachedCache
+
+    Methods:
+        get
+        get_many
+        set
+        set_many
+        add
+        delete
+    """
+
+    def __init__(self, client, timeout=300, prefix="librerian:"):
+        self.client = client
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def get(self, key):
+        """
+        Get value of key, None if it is not stored
+        """
+        return self.client.get(self.prefix + key)
+
+    def get_many(self, keys):
+        """
+        Get values of keys as a list, None for keys that are not stored
+        """
+        return list(self.client.get_many(*(self.prefix + key for key in keys)))
+
+    def set(self, key, value):
+        """
+        Store value of key
+        """
+        self.client.set(self.prefix + key, value, timeout=self.timeout)
+
+    def set_many(self, mapping):
+        """
+        Store all the values of mapping
+        """
+        self.client.set_many(
+            {self.prefix + key: value for key, value in mapping.items()}, timeout=self.timeout
+        )
+
+    def add(self, key, value):
+        """
+        Store value of key if the key is not stored yet
+        Returns True if the value was stored
+        """
+        return self.client.add(self.prefix + key, value, timeout=self.timeout)
+
+    def delete(self, key):
+        """
+        Remove key
+        """
+        self.client.delete(self.prefix + key)
+
+class ResponseCache:
+    """
+    Response cache with tag based invalidation
+
+    Parameters:
+        backend : LRUBackend or ClientBackend
+
+    Methods:
+        init_app
+        tokens
+        lookup
+        cached_response
+        store
+        invalidate
+        stats
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Serve cached responses in front of app and store responses of
+        requests that declared cache tags
+        """
+        app.extensions["response_cache"] = self
+        app.wsgi_app = _CacheMiddleware(app.wsgi_app, self)
+        app.after_request(self._after_request)
+
+    def tokens(self, tags):
+        """
+        Current tokens of tags, tags without a token get a new one
+        """
+        keys = [TAG_PREFIX + tag for tag in tags]
+        tokens = self.backend.get_many(keys)
+        for index, token in enumerate(tokens):
+            if token is None:
+                token = secrets.token_hex(8)
+                if not self.backend.add(keys[index], token):
+                    token = self.backend.get(keys[index])
+                tokens[index] = token
+        return tokens
+
+    def lookup(self, key):
+        """
+        Cached entry of key, None if there is none or a tag was invalidated
+        """
+        entry = self.backend.get(RESPONSE_PREFIX + key)
+        if entry is not None:
+            tags, tokens = entry[0], entry[1]
+            if tags and self.tokens(tags) != tokens:
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def cached_response(self, environ):
+        """
+        Cached response of the GET request of environ, None on a miss
+        """
+        entry = self.lookup(_cache_key(environ))
+        if entry is None:
+            return None
+        _tags, _tokens, status, headers, body = entry
+        response = Response(body, status=status, headers=headers)
+        response.headers["X-Cache"] = "HIT"
+        response.make_conditional(environ)
+        return response
+
+    def store(self, key, tags, tokens, response):
+        """
+        Store response with the tag tokens read before it was built
+        """
+        headers = [
+            (name, value) for name, value in response.headers if name not in UNCACHED_HEADERS
+        ]
+        entry = (list(tags), tokens, response.status_code, headers, response.get_data())
+        self.backend.set(RESPONSE_PREFIX + key, entry)
+
+    def invalidate(self, *tags):
+        """
+        Invalidate all the entries built with the current version of tags
+        """
+        self.backend.set_many(
+            {TAG_PREFIX + tag: secrets.token_hex(8) for tag in {GENERATION_TAG, *tags}}
+        )
+
+    def stats(self):
+        """
+        Hit and miss counts since the cache was created
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _after_request(self, response):
+        tags = g.pop("cache_tags", None)
+        if tags is None:
+            return response
+        response.headers["X-Cache"] = "MISS"
+        tokens = g.pop("cache_tokens")
+        # replica reads may lag behind the writes that invalidated the tags
+        if (
+            tokens is not None
+            and request.method == "GET"
+            and response.status_code == 200
+            and not response.is_streamed
+            and not use_replica()
+        ):
+            self.store(_cache_key(request.environ), tags, tokens, response)
+        return response
+
+class _CacheMiddleware:
+    """
+    WSGI middleware answering GET requests from the response cache
+    """
+
+    def __init__(self, wsgi_app, cache):
+        self.wsgi_app = wsgi_app
+        self.cache = cache
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] == "GET":
+            response = self.cache.cached_response(environ)
+            if response is not None:
+                return response(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+def _cache_key(environ):
+    return (
+        environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "")
+        + "?" + environ.get("QUERY_STRING", "")
+    )
+
+def hold_generation():
+    """
+    Read the write generation before the first instance of the current GET
+    request is loaded by a URL converter
+    """
+    cache = current_app.extensions.get("response_cache")
+    if cache is None or request.method != "GET" or "cache_generation" in g:
+        return
+    g.cache_generation = cache.tokens((GENERATION_TAG,))[0]
+
+def cache_tags(*tags):
+    """
+    Mark the response of the current GET request cacheable
+    Tag tokens are read here, before the data of the response, so that a
+    write that happens while the response is built makes the entry stale.
+    The response is not stored if a write happened after URL converters
+    loaded their instances
+
+    Parameters:
+        tags : str
+            names of the data the response is built from
+    """
+    cache = current_app.extensions.get("response_cache")
+    if cache is None or request.method != "GET":
+        return
+    tokens = cache.tokens((*tags, GENERATION_TAG))
+    held = g.get("cache_generation")
+    g.cache_tags = tags
+    g.cache_tokens = tokens[:-1] if held in (None, tokens[-1]) else None
+
+def invalidate(*tags):
+    """
+    Invalidate cached responses built from tags, no-op if caching is disabled
+
+    Parameters:
+        tags : str
+    """
+    cache = current_app.extensions.get("response_cache")
+    if cache is not None:
+        cache.invalidate(*tags)
@@ -5,3 +5,6 @@ USER_PROFILE = "/profile/user/"
 LIBRARY_PROFILE = "/profile/library/"
 BOOK_PROFILE = "/profile/book/"
 WORK_PROFILE = "/profile/work/"
+
+BOOK_AVAILABLE = 0
+BOOK_BORROWED = 1
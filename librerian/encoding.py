@@ -0,0 +1,106 @@
+"""
+JSON encoding of response bodies
+
+Resources encode their bodies with dumps or json_response, which use the
+encoder of the app. orjson is used when it is installed, otherwise the
+standard library. Both write compact UTF-8 bytes and encode datetimes and
+dates as ISO 8601 strings, so the bodies do not depend on the encoder.
+The encoder is chosen with JSON_ENCODER: auto, orjson or json.
+
+Classes:
+    StdlibEncoder
+    OrjsonEncoder
+
+Functions:
+    get_encoder
+    dumps
+    json_response
+"""
+
+import json
+from datetime import date
+
+from flask import Response, current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class StdlibEncoder:
+    """
+    Encoder using the json module of the standard library
+
+    Methods:
+        dumps
+    """
+    name = "json"
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(
+            ensure_ascii=False, separators=(",", ":"), default=self._default
+        )
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, date):
+            return value.isoformat()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    def dumps(self, obj):
+        """
+        Encode obj into JSON bytes
+        """
+        return self._encoder.encode(obj).encode()
+
+class OrjsonEncoder:
+    """
+    Encoder using orjson, which writes bytes directly and encodes datetimes natively
+
+    Methods:
+        dumps
+    """
+    name = "orjson"
+
+    def dumps(self, obj):
+        """
+        Encode obj into JSON bytes
+        """
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+ENCODERS = {"json": StdlibEncoder, "orjson": OrjsonEncoder}
+
+def get_encoder(name="auto"):
+    """
+    Encoder by name, auto picks orjson if it is installed
+
+    Parameters:
+        name : str
+            auto, orjson or json
+    """
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown JSON encoder {name}")
+    if name == "orjson" and orjson is None:
+        raise ValueError("JSON encoder orjson is not installed")
+    return ENCODERS[name]()
+
+def dumps(obj):
+    """
+    Encode obj into JSON bytes with the encoder of the current app
+
+    Parameters:
+        obj : json serializable object
+    """
+    return current_app.extensions["json_encoder"].dumps(obj)
+
+def json_response(body, status=200):
+    """
+    JSON response with body encoded by the encoder of the current app
+
+    Parameters:
+        body : json serializable object
+        status : int
+    """
+    return Response(response=dumps(body), status=status, mimetype="application/json")
@@ -0,0 +1,129 @@
+"""
+Hypermedia link building
+
+URLs of the API routes are compiled once into format strings, links are
+then built by filling in the converted URL values directly instead of
+going through url_for for every link.
+
+Classes:
+    LinkTemplate
+
+Functions:
+    compile_template
+    link_template
+    href
+"""
+import re
+
+from flask import current_app, request, url_for
+
+RULE_ARGUMENT = re.compile(r"<(?:(?P<converter>\w+)(?:\(.*?\))?:)?(?P<name>\w+)>")
+
+class _Placeholder:
+    """
+    Stand-in model passed to url_for when compiling templates
+    Every key attribute used by the converters returns the marker
+    """
+    def __init__(self, marker):
+        self.id = marker
+        self.handle = marker
+        self.name = marker
+
+    def __str__(self):
+        return self.id
+
+class LinkTemplate:
+    """
+    Compiled URL of a single endpoint
+
+    Methods:
+        build
+        format
+    """
+    def __init__(self, template, converters):
+        self.template = template
+        self.converters = converters
+        self.arguments = frozenset(converters)
+        self.static = None if converters else template % {}
+
+    def build(self, **values):
+        """
+        Build URL from model values, same output as url_for
+
+        Parameters:
+            values : dict
+                URL values for each argument of the endpoint
+        """
+        if self.static is not None:
+            return self.static
+        return self.template % {
+            name: converter.to_url(values[name]) for name, converter in self.converters.items()
+        }
+
+    def format(self, **parts):
+        """
+        Build URL from values that are already converted into path segments,
+        for rows that are not model instances
+
+        Parameters:
+            parts : dict
+                path segment for each argument of the endpoint
+        """
+        return self.template % parts
+
+def compile_template(endpoint):
+    """
+    Compile URL template of endpoint in the current request context
+    The URL is built once by url_for with placeholder values, which are
+    then replaced with format fields
+
+    Parameters:
+        endpoint : str
+    """
+    url_map = current_app.url_map
+    rule = next(url_map.iter_rules(endpoint))
+    converters = {}
+    placeholders = {}
+    for match in RULE_ARGUMENT.finditer(rule.rule):
+        name = match.group("name")
+        converter_class = url_map.converters[match.group("converter") or "default"]
+        converters[name] = converter_class(url_map)
+        placeholders[name] = _Placeholder(f"LINKTEMPLATE{name}LINKTEMPLATE")
+    template = url_for(endpoint, **placeholders).replace("%", "%%")
+    for name in converters:
+        template = template.replace(f"LINKTEMPLATE{name}LINKTEMPLATE", f"%({name})s")
+    return LinkTemplate(template, converters)
+
+def link_template(endpoint):
+    """
+    Compiled template of endpoint for the script root of the current request
+
+    Parameters:
+        endpoint : str
+    """
+    # templates of the request are looked up once, context proxies are slow
+    # compared to building a link
+    req = request._get_current_object()
+    templates = getattr(req, "link_templates", None)
+    if templates is None:
+        by_root = current_app.extensions.setdefault("link_templates", {})
+        templates = req.link_templates = by_root.setdefault(req.script_root, {})
+    template = templates.get(endpoint)
+    if template is None:
+        template = templates[endpoint] = compile_template(endpoint)
+    return template
+
+def href(endpoint, **values):
+    """
+    Build link to endpoint, drop-in replacement for url_for in itemize
+    Falls back to url_for when values contain other than route arguments
+
+    Parameters:
+        endpoint : str
+        values : dict
+            URL values for endpoint
+    """
+    template = link_template(endpoint)
+    if values.keys() != template.arguments:
+        return url_for(endpoint, **values)
+    return template.build(**values)
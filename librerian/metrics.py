@@ -0,0 +1,281 @@
+"""
+Request metrics
+
+Every request that reaches Flask is recorded per endpoint and method:
+latency, number and duration of SQL statements, time spent serialising the
+response body and response size. The totals are served in the Prometheus
+text format on /metrics. They are kept in process memory, so each worker
+process reports its own counters. Responses served by the response cache
+do not reach Flask and are only counted by the cache hit counter.
+
+A request that sends the X-Server-Timing header with the value of
+SERVER_TIMING_TOKEN gets a Server-Timing header with its own timings.
+
+Classes:
+    Metrics
+
+Functions:
+    listen_statements
+    timing
+"""
+
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from librerian import db
+
+START_KEY = "librerian.metrics.start"
+TOKEN_HEADER = "X-Server-Timing"
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class _RouteStats:
+    """
+    Totals of one endpoint and method
+    """
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+
+class _RequestTimings:
+    """
+    Timings of the current request
+    """
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.phases = {}
+
+class Metrics:
+    """
+    Request metrics of an app
+
+    Methods:
+        init_app
+        listen
+        record
+        render
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Record the requests of app and the statements of its engines,
+        and serve the totals on /metrics
+        """
+        app.extensions["metrics"] = self
+        app.wsgi_app = _StartMiddleware(app.wsgi_app)
+        with app.app_context():
+            for engine in db.engines.values():
+                self.listen(engine)
+        app.after_request(self._after_request)
+        app.add_url_rule("/metrics", "metrics", self._view)
+
+    def listen(self, engine):
+        """
+        Record the statements of an engine created outside of the app
+        """
+        listen_statements(engine, _record_statement)
+
+    def record(self, endpoint, method, status, seconds, timings, size):
+        """
+        Add the measurements of one request to the totals
+
+        Parameters:
+            endpoint : str
+            method : str
+            status : int
+            seconds : float
+                request latency
+            timings : _RequestTimings
+            size : int
+                response body bytes, None if unknown
+        """
+        with self._lock:
+            stats = self.routes.get((endpoint, method))
+            if stats is None:
+                stats = self.routes[(endpoint, method)] = _RouteStats()
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[index] += 1
+            stats.count += 1
+            stats.seconds += seconds
+            stats.queries += timings.queries
+            stats.sql_seconds += timings.sql_seconds
+            stats.serialize_seconds += timings.phases.get("serialize", 0.0)
+            stats.response_bytes += size or 0
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+    def render(self):
+        """
+        Totals in the Prometheus text exposition format
+        """
+        with self._lock:
+            routes = sorted(self.routes.items())
+            lines = [
+                "# HELP librerian_request_duration_seconds Request latency",
+                "# TYPE librerian_request_duration_seconds histogram",
+            ]
+            for (endpoint, method), stats in routes:
+                labels = f'endpoint="{_escape(endpoint)}",method="{method}"'
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    lines.append(
+                        f'librerian_request_duration_seconds_bucket{{{labels},le="{bound}"}} '
+                        f"{count}"
+                    )
+                lines.append(
+                    f'librerian_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.count}'
+                )
+                lines.append(f"librerian_request_duration_seconds_sum{{{labels}}} {stats.seconds}")
+                lines.append(f"librerian_request_duration_seconds_count{{{labels}}} {stats.count}")
+
+            lines += [
+                "# HELP librerian_requests_total Requests by response status",
+                "# TYPE librerian_requests_total counter",
+            ]
+            for (endpoint, method), stats in routes:
+                labels = f'endpoint="{_escape(endpoint)}",method="{method}"'
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append(f'librerian_requests_total{{{labels},status="{status}"}} {count}')
+
+            for name, kind, description, attribute in (
+                ("sql_queries_total", "counter", "SQL statements executed", "queries"),
+                ("sql_duration_seconds_total", "counter", "Time spent in SQL statements",
+                 "sql_seconds"),
+                ("serialize_duration_seconds_total", "counter",
+                 "Time spent building response bodies", "serialize_seconds"),
+                ("response_bytes_total", "counter", "Response body bytes", "response_bytes"),
+            ):
+                lines += [
+                    f"# HELP librerian_{name} {description}",
+                    f"# TYPE librerian_{name} {kind}",
+                ]
+                for (endpoint, method), stats in routes:
+                    labels = f'endpoint="{_escape(endpoint)}",method="{method}"'
+                    lines.append(f"librerian_{name}{{{labels}}} {getattr(stats, attribute)}")
+
+        cache = current_app.extensions.get("response_cache")
+        if cache is not None:
+            stats = cache.stats()
+            lines += [
+                "# HELP librerian_response_cache_hits_total Responses served from the cache",
+                "# TYPE librerian_response_cache_hits_total counter",
+                f"librerian_response_cache_hits_total {stats['hits']}",
+                "# HELP librerian_response_cache_misses_total Cache lookups that missed",
+                "# TYPE librerian_response_cache_misses_total counter",
+                f"librerian_response_cache_misses_total {stats['misses']}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def _view(self):
+        return Response(self.render(), status=200, content_type=CONTENT_TYPE)
+
+    def _after_request(self, response):
+        start = request.environ.get(START_KEY)
+        if start is None:
+            return response
+        seconds = time.perf_counter() - start
+        timings = _timings()
+        size = None if response.is_streamed else response.calculate_content_length()
+        self.record(
+            request.endpoint or "none", request.method, response.status_code,
+            seconds, timings, size
+        )
+        if _server_timing_requested():
+            metrics = [
+                f'sql;dur={timings.sql_seconds * 1000:.3f};desc="{timings.queries} queries"'
+            ]
+            metrics += [
+                f"{name};dur={value * 1000:.3f}" for name, value in timings.phases.items()
+            ]
+            metrics.append(f"total;dur={seconds * 1000:.3f}")
+            response.headers["Server-Timing"] = ", ".join(metrics)
+        return response
+
+class _StartMiddleware:
+    """
+    WSGI middleware marking the start of a request, URL converters query the
+    database before request hooks are run
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        environ[START_KEY] = time.perf_counter()
+        return self.wsgi_app(environ, start_response)
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _timings():
+    timings = g.get("metrics_timings")
+    if timings is None:
+        timings = g.metrics_timings = _RequestTimings()
+    return timings
+
+def _server_timing_requested():
+    token = current_app.config["SERVER_TIMING_TOKEN"]
+    value = request.headers.get(TOKEN_HEADER)
+    return bool(token) and value is not None and secrets.compare_digest(value, token)
+
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    context.librerian_start = time.perf_counter()
+
+def listen_statements(engine, listener):
+    """
+    Call listener after every statement of engine with its duration
+    The start time is kept on the execution context, so a failed statement
+    leaves nothing behind
+
+    Parameters:
+        engine : Engine
+        listener : function
+            called with the arguments of after_cursor_execute and the
+            duration in seconds
+    """
+    if not event.contains(engine, "before_cursor_execute", _start_statement):
+        event.listen(engine, "before_cursor_execute", _start_statement)
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context.librerian_start
+        listener(conn, cursor, statement, parameters, context, executemany, seconds)
+
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany, seconds):
+    if has_request_context():
+        timings = _timings()
+        timings.queries += 1
+        timings.sql_seconds += seconds
+
+@contextmanager
+def timing(name):
+    """
+    Add the time spent in the block to the phase name of the current request,
+    for example serialize
+
+    Parameters:
+        name : str
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            phases = _timings().phases
+            phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
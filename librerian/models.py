@@ -6,24 +6,34 @@ Classes:
     Library : Model
     Book : Model
     Work : Model
+    Loan : Model
+    TableVersion : Model
 
 Functions:
     init_db_command
     empty_db_command
+    rebuild_fts_command
+    recount_copies_command
+    sqlite_pragmas_listener
+    listen_sqlite_pragmas
     random_string
     random_user
     random_library
     random_book
     random_work
+    insert_chunks
     generate_db_command
 """
 import random
 import string
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 import click
 from flask.cli import with_appcontext
+from sqlalchemy import DDL, event, func, insert, or_, select, text, update
 from librerian import db
+from librerian.constants import BOOK_AVAILABLE, BOOK_BORROWED
 
 class User(db.Model):
     """
@@ -39,9 +49,12 @@ class User(db.Model):
     last_name       = db.Column(db.String(64), nullable=True)
     email           = db.Column(db.String(64), nullable=False, unique=True)
     contact_phone   = db.Column(db.String(64), nullable=True)
+    version         = db.Column(db.Integer, nullable=False)
     libraries       = db.relationship("Library", cascade="all, delete-orphan", back_populates="owner")
     books           = db.relationship("Book", back_populates="borrower")
 
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return f"User {self.first_name} {self.last_name} <{self.id}>"
 
@@ -101,10 +114,13 @@ class Library(db.Model):
     country         = db.Column(db.String(64), nullable=True)
     postal_code     = db.Column(db.String(64), nullable=True)
     contact_email   = db.Column(db.String(64), nullable=True)
+    version         = db.Column(db.Integer, nullable=False)
     owner_id        = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     owner           = db.relationship("User", back_populates="libraries")
     books           = db.relationship("Book", cascade="all, delete-orphan", back_populates="library")
 
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return f"Library {self.name} <{self.id}>"
 
@@ -148,6 +164,9 @@ class Library(db.Model):
         self.postal_code = doc.get("postal_code")
         self.contact_email = doc.get("contact_email")
 
+def _isoformat(value):
+    return None if value is None else value.isoformat()
+
 class Book(db.Model):
     """
     Book database model
@@ -162,13 +181,19 @@ class Book(db.Model):
     condition       = db.Column(db.String(64), nullable=True)
     validity_start  = db.Column(db.DateTime, nullable=True)
     validity_end    = db.Column(db.DateTime, nullable=True)
-    work_id         = db.Column(db.Integer, db.ForeignKey("work.id"), nullable=False)
-    library_id      = db.Column(db.Integer, db.ForeignKey("library.id"), nullable=False)
-    borrower_id     = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
+    work_id         = db.Column(db.Integer, db.ForeignKey("work.id"), nullable=False, index=True)
+    library_id      = db.Column(db.Integer, db.ForeignKey("library.id"), nullable=False, index=True)
+    borrower_id     = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True, index=True)
+    version         = db.Column(db.Integer, nullable=False)
     work            = db.relationship("Work", back_populates="books")
     library         = db.relationship("Library", back_populates="books")
     borrower        = db.relationship("User", back_populates="books")
 
+    # validity queries are ranges on validity_end, the start is checked
+    # from the index without reading the rows
+    __table_args__ = (db.Index("ix_book_validity", "validity_end", "validity_start"),)
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return f"Book {self.work.title} <{self.id}>"
 
@@ -185,8 +210,8 @@ class Book(db.Model):
             "status": self.status,
             "notes": self.notes,
             "condition": self.condition,
-            "validity_start": self.validity_start,
-            "validity_end": self.validity_end,
+            "validity_start": _isoformat(self.validity_start),
+            "validity_end": _isoformat(self.validity_end),
             "work_id": self.work_id
         }
         return serialized_data
@@ -217,12 +242,18 @@ class Work(db.Model):
         deserialize
     """
     id              = db.Column(db.Integer, primary_key=True)
-    title           = db.Column(db.String(64), nullable=False)
-    author          = db.Column(db.String(64), nullable=False)
+    title           = db.Column(db.String(64), nullable=False, index=True)
+    author          = db.Column(db.String(64), nullable=False, index=True)
     cover           = db.Column(db.String(64), nullable=True)
-    isbn            = db.Column(db.String(64), nullable=True)
+    isbn            = db.Column(db.String(64), nullable=True, index=True)
+    total_copies    = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    available_copies = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    borrowed_copies = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    version         = db.Column(db.Integer, nullable=False)
     books           = db.relationship("Book", back_populates="work")
 
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return f"Work {self.title} <{self.id}>"
 
@@ -239,7 +270,10 @@ class Work(db.Model):
             "title": self.title,
             "author": self.author,
             "cover": self.cover,
-            "isbn": self.isbn
+            "isbn": self.isbn,
+            "total_copies": self.total_copies,
+            "available_copies": self.available_copies,
+            "borrowed_copies": self.borrowed_copies
         }
         return serialized_data
 
@@ -252,6 +286,202 @@ class Work(db.Model):
         self.cover = doc.get("cover")
         self.isbn = doc.get("isbn")
 
+# Full-text index over work titles and authors. The FTS5 table uses work as
+# external content, triggers keep it in sync with inserts, updates and deletes.
+WORK_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS work_fts USING fts5("
+    "title, author, content='work', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS work_fts_insert AFTER INSERT ON work BEGIN "
+    "INSERT INTO work_fts(rowid, title, author) VALUES (new.id, new.title, new.author); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS work_fts_delete AFTER DELETE ON work BEGIN "
+    "INSERT INTO work_fts(work_fts, rowid, title, author) "
+    "VALUES ('delete', old.id, old.title, old.author); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS work_fts_update AFTER UPDATE OF title, author ON work BEGIN "
+    "INSERT INTO work_fts(work_fts, rowid, title, author) "
+    "VALUES ('delete', old.id, old.title, old.author); "
+    "INSERT INTO work_fts(rowid, title, author) VALUES (new.id, new.title, new.author); "
+    "END",
+)
+
+for statement in WORK_FTS_DDL:
+    event.listen(Work.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(
+    Work.__table__, "before_drop",
+    DDL("DROP TABLE IF EXISTS work_fts").execute_if(dialect="sqlite")
+)
+
+# Copy counters of works. Triggers update them in the same transaction as
+# the book insert, update or delete.
+def _count_copies(sign, row):
+    return (
+        f"UPDATE work SET total_copies = total_copies {sign} 1, "
+        f"available_copies = available_copies {sign} ({row}.status = {BOOK_AVAILABLE}), "
+        f"borrowed_copies = borrowed_copies {sign} ({row}.status = {BOOK_BORROWED}) "
+        f"WHERE id = {row}.work_id; "
+    )
+
+WORK_COPIES_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS book_copies_insert AFTER INSERT ON book BEGIN "
+    + _count_copies("+", "new") + "END",
+    "CREATE TRIGGER IF NOT EXISTS book_copies_delete AFTER DELETE ON book BEGIN "
+    + _count_copies("-", "old") + "END",
+    "CREATE TRIGGER IF NOT EXISTS book_copies_update AFTER UPDATE OF status, work_id ON book BEGIN "
+    + _count_copies("-", "old") + _count_copies("+", "new") + "END",
+)
+
+for statement in WORK_COPIES_DDL:
+    event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+class Loan(db.Model):
+    """
+    Loan history of books
+    Loans are opened and closed by triggers on book status changes, so the
+    history is written in the same statement as the status update
+
+    Methods:
+        serialize
+    """
+    id              = db.Column(db.Integer, primary_key=True)
+    book_id         = db.Column(
+        db.Integer, db.ForeignKey("book.id", ondelete="CASCADE"), nullable=False
+    )
+    borrower_id     = db.Column(
+        db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"), nullable=True
+    )
+    borrowed_at     = db.Column(db.DateTime, nullable=False)
+    returned_at     = db.Column(db.DateTime, nullable=True)
+    borrower        = db.relationship("User")
+
+    # ids are not reused after old loans are archived, archived and live
+    # loans are paginated together by id
+    __table_args__ = (
+        db.Index("ix_loan_borrower_borrowed_at", "borrower_id", "borrowed_at"),
+        db.Index("ix_loan_book_borrowed_at", "book_id", "borrowed_at"),
+        {"sqlite_autoincrement": True},
+    )
+
+    def __repr__(self):
+        return f"Loan {self.book_id} <{self.id}>"
+
+    def serialize(self, _short_form=False):
+        """
+        Serialize loan into json
+
+        Parameters:
+        short_form : bool
+            default : False
+            currently unused
+        """
+        serialized_data = {
+            "borrower": None if self.borrower is None else self.borrower.handle,
+            "borrowed_at": _isoformat(self.borrowed_at),
+            "returned_at": _isoformat(self.returned_at)
+        }
+        return serialized_data
+
+# A book becoming borrowed opens a loan, a borrowed book changing to any
+# other status closes its open loan.
+LOAN_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS book_loan_insert AFTER INSERT ON book "
+    f"WHEN new.status = {BOOK_BORROWED} BEGIN "
+    "INSERT INTO loan (book_id, borrower_id, borrowed_at) "
+    "VALUES (new.id, new.borrower_id, CURRENT_TIMESTAMP); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS book_loan_open AFTER UPDATE OF status ON book "
+    f"WHEN old.status != {BOOK_BORROWED} AND new.status = {BOOK_BORROWED} BEGIN "
+    "INSERT INTO loan (book_id, borrower_id, borrowed_at) "
+    "VALUES (new.id, new.borrower_id, CURRENT_TIMESTAMP); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS book_loan_close AFTER UPDATE OF status ON book "
+    f"WHEN old.status = {BOOK_BORROWED} AND new.status != {BOOK_BORROWED} BEGIN "
+    "UPDATE loan SET returned_at = CURRENT_TIMESTAMP "
+    "WHERE book_id = old.id AND returned_at IS NULL; "
+    "END",
+)
+
+for statement in LOAN_DDL:
+    event.listen(Loan.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+class TableVersion(db.Model):
+    """
+    Modification counter of a table
+    Triggers bump the counter on every insert, update and delete of the table
+    so that collection ETags can be checked without reading the rows
+    """
+    name            = db.Column(db.String(64), primary_key=True)
+    version         = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"TableVersion {self.name} <{self.version}>"
+
+VERSIONED_TABLES = ("user", "library", "book", "work", "loan")
+
+def table_version_ddl(name):
+    """
+    Trigger statements that keep the version counter of a table up to date
+
+    Parameters:
+        name : str
+            table name
+    """
+    return tuple(
+        f'CREATE TRIGGER IF NOT EXISTS {name}_version_{operation.lower()} '
+        f'AFTER {operation} ON "{name}" BEGIN '
+        f"UPDATE table_version SET version = version + 1 WHERE name = '{name}'; "
+        f"END"
+        for operation in ("INSERT", "UPDATE", "DELETE")
+    )
+
+TABLE_VERSION_SEED = (
+    "INSERT OR IGNORE INTO table_version (name, version) VALUES "
+    + ", ".join(f"('{name}', 0)" for name in VERSIONED_TABLES)
+)
+
+event.listen(
+    TableVersion.__table__, "after_create",
+    DDL(TABLE_VERSION_SEED).execute_if(dialect="sqlite")
+)
+for model in (User, Library, Book, Work, Loan):
+    for statement in table_version_ddl(model.__tablename__):
+        event.listen(model.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+
+def sqlite_pragmas_listener(pragmas):
+    """
+    Engine connect listener that applies PRAGMA statements to new connections
+
+    Parameters:
+        pragmas : dict
+            pragma names and values, for example {"journal_mode": "WAL"}
+    """
+    statements = [f"PRAGMA {name}={value}" for name, value in pragmas.items()]
+
+    def set_sqlite_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    return set_sqlite_pragmas
+
+def listen_sqlite_pragmas(engine, pragmas):
+    """
+    Apply pragmas to new connections of a SQLite engine
+    The journal mode of read-only databases is stored in the file by its
+    writer and is left out
+
+    Parameters:
+        engine : Engine
+        pragmas : dict
+    """
+    pragmas = dict(pragmas)
+    if engine.url.query.get("mode") == "ro":
+        pragmas.pop("journal_mode", None)
+    event.listen(engine, "connect", sqlite_pragmas_listener(pragmas))
+
 
 @click.command("init-db")
 @with_appcontext
@@ -268,13 +498,57 @@ def empty_db_command():
     Click command for emptying database
     Use with care
     """
-    Work.query.delete()
+    Loan.query.delete()
     Book.query.delete()
+    Work.query.delete()
     Library.query.delete()
     User.query.delete()
     db.session.commit()
     print("All db tables cleared")
 
+@click.command("rebuild-fts")
+@with_appcontext
+def rebuild_fts_command():
+    """
+    Click command for creating and rebuilding the work full-text index
+    """
+    for statement in WORK_FTS_DDL:
+        db.session.execute(text(statement))
+    db.session.execute(text("INSERT INTO work_fts(work_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    print("Work full-text index rebuilt")
+
+@click.command("recount-copies")
+@with_appcontext
+def recount_copies_command():
+    """
+    Click command for recomputing the copy counters of all works from books
+    Works whose counters change get a new version, which changes their ETag
+    """
+    def count(*criteria):
+        return (
+            select(func.count(Book.id))
+            .where(Book.work_id == Work.id, *criteria)
+            .scalar_subquery()
+        )
+
+    counters = {
+        "total_copies": count(),
+        "available_copies": count(Book.status == BOOK_AVAILABLE),
+        "borrowed_copies": count(Book.status == BOOK_BORROWED)
+    }
+    for statement in WORK_COPIES_DDL:
+        db.session.execute(text(statement))
+    db.session.execute(
+        update(Work)
+        .where(or_(*(
+            getattr(Work, name).is_distinct_from(value) for name, value in counters.items()
+        )))
+        .values(version=Work.version + 1, **counters)
+    )
+    db.session.commit()
+    print("Work copy counters recomputed")
+
 def random_string(length=10):
     """
     Create random string
@@ -333,31 +607,156 @@ def random_work():
     return work
 
 
+def _random_word(generator, length=10):
+    return "".join(generator.choices(string.ascii_lowercase, k=length))
+
+def _zipf_cum_weights(count, exponent):
+    """
+    Cumulative weights of ranks 1..count in a Zipf distribution
+    """
+    total = 0.0
+    weights = []
+    for rank in range(1, count + 1):
+        total += rank ** -exponent
+        weights.append(total)
+    return weights
+
+def insert_chunks(model, rows, chunk_size):
+    """
+    Insert rows with executemany in chunks of chunk_size rows
+
+    Parameters:
+        model : Model
+        rows : iterable of dicts
+            column values including the primary key
+        chunk_size : int
+
+    Returns:
+        number of inserted rows
+    """
+    statement = insert(model.__table__)
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            db.session.execute(statement, chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(statement, chunk)
+        count += len(chunk)
+    return count
+
 @click.command("gen-db")
-@click.option("--count", default=1, type=int)
+@click.option("--count", default=1, type=int, help="Number of users")
+@click.option("--works", default=None, type=int, help="Number of works, twice count by default")
+@click.option("--zipf", default=1.1, type=float, help="Exponent of the work popularity")
+@click.option("--borrowed", default=0.3, type=float, help="Share of books that are borrowed")
+@click.option("--seed", default=0, type=int)
+@click.option("--chunk-size", default=10000, type=int)
 @with_appcontext
-def generate_db_command(count=1):
+def generate_db_command(count=1, works=None, zipf=1.1, borrowed=0.3, seed=0, chunk_size=10000):
     """
     Click command for generating database
+    Rows are written with bulk inserts in chunks and the same seed gives the
+    same data. Books are copies of works picked from a Zipf distribution, so
+    a few works have many copies. Keys contain the row id and do not collide
+    with earlier rows
 
     Parameters:
     count : int
-        Defines how many items are created
+        Defines how many users are created, each with 2 libraries of 4 books
+    works : int
+    zipf : float
+    borrowed : float
+    seed : int
+    chunk_size : int
     """
-
-    for _i in range(count * 1):
-        user = random_user()
-        for _j in range(count * 2):
-            library = random_library()
-            for _k in range(count * 4):
-                book = random_book()
-                book.work = random_work()
-                library.books.append(book)
-            user.libraries.append(library)
-        db.session.add(user)
-
+    generator = random.Random(seed)
+    works = count * 2 if works is None else works
+    if count > 0 and works < 1:
+        raise click.BadParameter("Books need at least one work", param_hint="--works")
+    first = {
+        model: (db.session.scalar(select(func.max(model.id))) or 0) + 1
+        for model in (User, Library, Work, Book)
+    }
+    now = datetime.now().replace(microsecond=0)
+    work_ids = range(first[Work], first[Work] + works)
+    user_ids = range(first[User], first[User] + count)
+
+    def users():
+        for user_id in user_ids:
+            first_name = _random_word(generator)
+            last_name = _random_word(generator)
+            yield {
+                "id": user_id,
+                "handle": f"{_random_word(generator)}-{user_id}",
+                "first_name": first_name,
+                "last_name": last_name,
+                "email": f"{first_name}.{last_name}.{user_id}@{_random_word(generator, 4)}.com",
+                "version": 1
+            }
+
+    def libraries():
+        for index in range(count * 2):
+            library_id = first[Library] + index
+            yield {
+                "id": library_id,
+                "name": f"{_random_word(generator)}-{library_id}",
+                "owner_id": user_ids[index // 2],
+                "version": 1
+            }
+
+    def works_rows():
+        authors = [_random_word(generator) for _i in range(max(1, works // 4))]
+        for work_id in work_ids:
+            yield {
+                "id": work_id,
+                "title": _random_word(generator),
+                "author": generator.choice(authors),
+                "version": 1
+            }
+
+    def books():
+        cum_weights = _zipf_cum_weights(works, zipf)
+        for start in range(0, count * 8, chunk_size):
+            size = min(chunk_size, count * 8 - start)
+            picks = generator.choices(work_ids, cum_weights=cum_weights, k=size)
+            for index, work_id in enumerate(picks, start):
+                book = {
+                    "id": first[Book] + index,
+                    "status": BOOK_AVAILABLE,
+                    "work_id": work_id,
+                    "library_id": first[Library] + index // 4,
+                    "borrower_id": None,
+                    "validity_start": None,
+                    "validity_end": None,
+                    "version": 1
+                }
+                if generator.random() < borrowed:
+                    validity_start = now - timedelta(days=generator.randint(0, 28))
+                    book.update(
+                        status=BOOK_BORROWED,
+                        borrower_id=generator.choice(user_ids),
+                        validity_start=validity_start,
+                        validity_end=validity_start + timedelta(days=21)
+                    )
+                yield book
+
+    started = time.perf_counter()
+    counts = [
+        insert_chunks(model, rows, chunk_size)
+        for model, rows in (
+            (User, users()), (Library, libraries()), (Work, works_rows()), (Book, books())
+        )
+    ]
     db.session.commit()
-    print(f"Added {count} randomized users, {count * 2} libraries and {count * 8} books/works.")
+    elapsed = time.perf_counter() - started
+    print(
+        f"Added {counts[0]} users, {counts[1]} libraries, {counts[2]} works and {counts[3]} books "
+        f"in {elapsed:.1f} s ({sum(counts) / elapsed:.0f} rows/s)"
+    )
     add_example_library()
 
 
@@ -366,6 +765,8 @@ def add_example_library():
     Example users Alice and Bob, and Alice's library
     to always have one example that persists in addition to the randomized data
     """
+    if User.query.filter_by(handle="alice123").first() is not None:
+        return
     user = User(
             handle="alice123",
             first_name="Alice",
@@ -406,7 +807,7 @@ def add_example_library():
         condition="Like new",
         library = library,
         work = work,
-        borrower_id = user.handle
+        borrower = user
     )
     db.session.add(book)
     db.session.commit()
@@ -0,0 +1,134 @@
+"""
+Slow query log and N+1 detector
+
+Statements that run longer than SLOW_QUERY_SECONDS are logged with their
+parameters cut to PARAMETERS_LENGTH characters, only the row count and first
+row of an executemany, and reads with their query plan. A request that runs
+the same SELECT statement more than N_PLUS_ONE_THRESHOLD times, usually one
+per listed item because a relationship was not loaded with the rows, is
+logged with the statement.
+Endpoints can be given a total statement budget in QUERY_BUDGETS. With
+QUERY_BUDGET_STRICT set, as in tests, repeated statements and exceeded
+budgets raise QueryBudgetExceeded instead of being logged.
+
+Statements run by streamed responses after the response has been started
+are not counted.
+
+Classes:
+    QueryBudgetExceeded : Exception
+
+Functions:
+    init_app
+    listen
+"""
+
+from collections import Counter
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from librerian import db
+from librerian.metrics import listen_statements
+
+READ_PREFIXES = ("SELECT", "WITH")
+PARAMETERS_LENGTH = 500
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised in strict mode when a request runs too many statements
+    """
+
+def init_app(app):
+    """
+    Listen to the statements of the engines of app and check the statements
+    of each request after it has been handled
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            listen(engine)
+    app.after_request(_check_request)
+
+def listen(engine):
+    """
+    Check the statements of an engine created outside of the app
+    """
+    listen_statements(engine, _check_statement)
+
+def _check_statement(conn, cursor, statement, parameters, context, executemany, seconds):
+    if not has_app_context():
+        return
+    if has_request_context():
+        statements = g.get("querylog_statements")
+        if statements is None:
+            statements = g.querylog_statements = Counter()
+        statements[statement] += 1
+    threshold = current_app.config["SLOW_QUERY_SECONDS"]
+    if threshold is not None and seconds > threshold:
+        message = "Slow query (%.3f s): %s\nParameters: %s"
+        args = [seconds, statement, _format_parameters(parameters, executemany)]
+        if _is_read(statement):
+            plan = None
+            # the cursor of an async driver cannot run another statement here
+            if not executemany and conn.dialect.name == "sqlite" and not conn.dialect.is_async:
+                plan = _query_plan(cursor, statement, parameters)
+            message += "\nPlan:\n%s"
+            args.append(plan or "not available")
+        current_app.logger.warning(message, *args)
+
+def _is_read(statement):
+    return statement.lstrip().upper().startswith(READ_PREFIXES)
+
+def _format_parameters(parameters, executemany):
+    """
+    Parameters of a statement for the log, an executemany is given as its
+    row count and first row
+    """
+    if executemany:
+        first = parameters[0] if parameters else None
+        text = f"{len(parameters)} rows, first {first!r}"
+    else:
+        text = repr(parameters)
+    if len(text) > PARAMETERS_LENGTH:
+        text = text[:PARAMETERS_LENGTH] + f"... ({len(text)} characters)"
+    return text
+
+def _query_plan(cursor, statement, parameters):
+    """
+    EXPLAIN QUERY PLAN of a statement as indented lines, run on a new cursor
+    of the same DBAPI connection so that the statement is not counted again
+    """
+    explain = cursor.connection.cursor()
+    try:
+        rows = explain.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+    except Exception as error:
+        return f"failed: {error}"
+    finally:
+        explain.close()
+    depths = {0: 0}
+    lines = []
+    for node, parent, _unused, detail in rows:
+        depths[node] = depths.get(parent, 0) + 1
+        lines.append("  " * depths[node] + detail)
+    return "\n".join(lines)
+
+def _check_request(response):
+    statements = g.pop("querylog_statements", None)
+    if statements is None:
+        return response
+    config = current_app.config
+    problems = []
+    threshold = config["N_PLUS_ONE_THRESHOLD"]
+    if threshold:
+        for statement, count in statements.most_common():
+            if count <= threshold:
+                break
+            if _is_read(statement):
+                problems.append(f"N+1 query, {count} times: {statement}")
+    budget = config["QUERY_BUDGETS"].get(request.endpoint)
+    total = sum(statements.values())
+    if budget is not None and total > budget:
+        problems.append(f"{total} queries over the budget of {budget}")
+    for problem in problems:
+        message = f"{request.method} {request.full_path.rstrip('?')}: {problem}"
+        if config["QUERY_BUDGET_STRICT"]:
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
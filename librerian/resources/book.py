@@ -4,18 +4,94 @@ Book resources
 Classes:
     BookGlobalCollection : Resource
     BookLocalCollection : Resource
+    BookBatch : Resource
     BookItem : Resource
 """
-import json
 
 from flask import Response, request, url_for
 from flask_restful import Resource
-from flasgger import swag_from, validate
+from flasgger import swag_from
+from sqlalchemy import func, literal_column, select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
 
-from librerian.models import Book, Work
+from librerian.cache import cache_tags, invalidate
+from librerian.encoding import json_response
+from librerian.links import href, link_template
+from librerian.metrics import timing
+from librerian.models import Book, Library, User, Work
+from librerian.utils import (
+    check_if_match, collection_response, date_arg, deserialize_batch, existing_ids, flag_arg,
+    int_arg, not_modified, quote_key, row_etag, validate, write_batch
+)
 from librerian import db
 
+# estimated share of books matched by a validity filter, see filter_books
+VALIDITY_LIKELIHOOD = "0.01"
+
+def book_options():
+    """
+    Loader options that load library, library owner and work of books in the
+    same SELECT so that itemize does not emit lazy loads for every book
+    """
+    return (
+        joinedload(Book.library).joinedload(Library.owner),
+        joinedload(Book.work)
+    )
+
+def eager_books():
+    """
+    Book query with everything itemize needs loaded
+    """
+    return Book.query.options(*book_options())
+
+def _likelihood(criterion, selective):
+    if not selective:
+        return criterion
+    return func.likelihood(criterion, literal_column(VALIDITY_LIKELIHOOD))
+
+def filter_books(query):
+    """
+    Filter book query with request arguments
+    library and borrower are given by name and handle and are resolved
+    to ids in a subquery. valid_at and expiring_before are matched against
+    the validity window, books without one are left out
+    """
+    # set by filters on columns with an index of their own
+    indexed = False
+    work_id = int_arg("work_id")
+    if work_id is not None:
+        query = query.filter(Book.work_id == work_id)
+        indexed = True
+    status = int_arg("status")
+    if status is not None:
+        query = query.filter(Book.status == status)
+    library = request.args.get("library")
+    if library is not None:
+        library_id = select(Library.id).where(Library.name == library).scalar_subquery()
+        query = query.filter(Book.library_id == library_id)
+        indexed = True
+    borrower = request.args.get("borrower")
+    if borrower is not None:
+        borrower_id = select(User.id).where(User.handle == borrower).scalar_subquery()
+        query = query.filter(Book.borrower_id == borrower_id)
+        indexed = True
+    valid_at = date_arg("valid_at")
+    expiring_before = date_arg("expiring_before")
+    # SQLite 3.40 has no range statistics and scans books in id order rather
+    # than sort the hits of the validity index. Marking the validity_end term
+    # as selective makes it read the index, except for a page of valid_at
+    # alone, which matches many books and is filled sooner by the scan
+    selective = not indexed and (expiring_before is not None or flag_arg("stream"))
+    if valid_at is not None:
+        query = query.filter(
+            _likelihood(Book.validity_end > valid_at, selective), Book.validity_start <= valid_at
+        )
+    if expiring_before is not None:
+        query = query.filter(_likelihood(Book.validity_end < expiring_before, selective))
+    return query
+
 def itemize(book):
     """
     Itemize book data
@@ -23,20 +99,74 @@ def itemize(book):
     data = book.serialize()
     data["links"] = {
         "self": {
-            "href": url_for("api.bookitem", book=book, library=book.library, user=book.library.owner)
+            "href": href("api.bookitem", book=book, library=book.library, user=book.library.owner)
         },
         "collection": {
-            "href": url_for("api.booklocalcollection", library=book.library, user=book.library.owner)
+            "href": href("api.booklocalcollection", library=book.library, user=book.library.owner)
         },
         "up": {
-            "href": url_for("api.bookglobalcollection")
+            "href": href("api.bookglobalcollection")
         },
         "type": {
-            "href": url_for("api.workitem", work=book.work)
+            "href": href("api.workitem", work=book.work)
         }
     }
     return data
 
+BOOK_COLUMNS = (
+    Book.id, Book.status, Book.notes, Book.condition, Book.validity_start, Book.validity_end,
+    Book.work_id, Library.name.label("library_name"), User.handle.label("owner_handle")
+)
+
+def book_rows(query=None):
+    """
+    Book listing query of plain rows with the columns row_itemizer needs
+    Rows are not loaded into model instances, which costs more than the
+    data itself on listings
+
+    Parameters:
+        query : Query or Select
+            query of BOOK_COLUMNS, a session query by default
+    """
+    if query is None:
+        query = db.session.query(*BOOK_COLUMNS)
+    # outer joins keep book as the outer loop, as with joinedload
+    return query.outerjoin(Book.library).outerjoin(Library.owner)
+
+def row_itemizer():
+    """
+    Itemize function for rows of book_rows, gives the same items as itemize
+    Link templates are looked up once. Datetimes are left to the encoder
+    """
+    item = link_template("api.bookitem")
+    collection = link_template("api.booklocalcollection")
+    up = {"href": link_template("api.bookglobalcollection").build()}
+    work = link_template("api.workitem")
+
+    def itemize_row(row):
+        (
+            book_id, status, notes, condition, validity_start, validity_end, work_id,
+            library_name, owner_handle
+        ) = row
+        library = quote_key(library_name)
+        user = quote_key(owner_handle)
+        return {
+            "status": status,
+            "notes": notes,
+            "condition": condition,
+            "validity_start": validity_start,
+            "validity_end": validity_end,
+            "work_id": work_id,
+            "links": {
+                "self": {"href": item.format(book=str(book_id), library=library, user=user)},
+                "collection": {"href": collection.format(library=library, user=user)},
+                "up": up,
+                "type": {"href": work.format(work=str(work_id))}
+            }
+        }
+
+    return itemize_row
+
 class BookGlobalCollection(Resource):
     """
     BookGlobalCollection resource
@@ -49,17 +179,11 @@ class BookGlobalCollection(Resource):
         """
         Fetch list of all the books
         """
-        body = {
-            "items": [],
-            "links": {
-                "self": {
-                    "href": url_for("api.bookglobalcollection")
-                }
-            }
-        }
-        for book in Book.query.all():
-            body["items"].append(itemize(book))
-        return Response(response=json.dumps(body), status=200, mimetype="application/json")
+        cache_tags("books", "names")
+        return collection_response(
+            filter_books(book_rows()), Book.id, row_itemizer(), "api.bookglobalcollection",
+            tables=("book", "library", "user")
+        )
 
 class BookLocalCollection(Resource):
     """
@@ -74,17 +198,12 @@ class BookLocalCollection(Resource):
         """
         Fetch list of all the books in a library
         """
-        body = {
-            "items": [],
-            "links": {
-                "self": {
-                    "href": url_for("api.booklocalcollection", library=library, user=user)
-                }
-            }
-        }
-        for book in Book.query.filter_by(library=library):
-            body["items"].append(itemize(book))
-        return Response(response=json.dumps(body), status=200, mimetype="application/json")
+        cache_tags(f"books:{library.id}", "names")
+        return collection_response(
+            book_rows().filter(Book.library_id == library.id), Book.id, row_itemizer(),
+            "api.booklocalcollection", tables=("book", "library", "user"),
+            library=library, user=user
+        )
 
     @swag_from("../doc/booklocalcollection/post.yml")
     def post(self, user=None, library=None):
@@ -93,10 +212,13 @@ class BookLocalCollection(Resource):
         """
         if not request.json:
             return "Wrong media type was used", 415
-        validate(request.json, "Book", "../doc/librerian.yml")
+        validate(request.json, "Book")
 
         book = Book()
-        book.deserialize(doc=request.json)
+        try:
+            book.deserialize(doc=request.json)
+        except (TypeError, ValueError) as err:
+            return str(err), 400
         book.library = library
         if Work.query.filter_by(id=book.work_id) is None:
             return "Work used in book is invalid", 409
@@ -106,6 +228,8 @@ class BookLocalCollection(Resource):
         except IntegrityError:
             db.session.rollback()
             return "Book already exits", 409
+        # work listings show copy counters
+        invalidate("books", f"books:{library.id}", "works", f"work:{book.work_id}")
 
         return Response(
             headers={"Location": url_for("api.bookitem", library=library, user=user, book=book)},
@@ -113,6 +237,70 @@ class BookLocalCollection(Resource):
             status=201
         )
 
+class BookBatch(Resource):
+    """
+    BookBatch resource
+
+    Methods
+    - post
+    """
+    @swag_from("../doc/bookbatch/post.yml")
+    def post(self, user=None, library=None):
+        """
+        Add or update a batch of books in a library in a single transaction
+        """
+        if request.json is None:
+            return "Wrong media type was used", 415
+        if not isinstance(request.json, list):
+            return "Batch must be a JSON array", 400
+        if not request.json:
+            return json_response({"items": []})
+
+        results, rows = deserialize_batch(request.json, "Book", Book)
+        works = existing_ids(Work.id, (row["work_id"] for _, row in rows))
+        found = existing_ids(
+            Book.id, (row["id"] for _, row in rows if "id" in row), Book.library_id == library.id
+        )
+        inserts = []
+        updates = []
+        for index, row in rows:
+            if row["work_id"] not in works:
+                results[index] = {"status": 409, "message": "Work used in book is invalid"}
+            elif "id" not in row:
+                row["library_id"] = library.id
+                inserts.append((index, row))
+            elif row["id"] in found:
+                updates.append(row)
+                results[index] = {
+                    "status": 204,
+                    "location": href(
+                        "api.bookitem", library=library, user=user, book=Book(id=row["id"])
+                    )
+                }
+            else:
+                results[index] = {"status": 404, "message": "The book was not found"}
+
+        try:
+            ids = write_batch(Book, [row for _, row in inserts], updates)
+        except IntegrityError:
+            db.session.rollback()
+            return "Book already exits", 409
+        # updated books may have moved from works that are not known here
+        invalidate(
+            "books", f"books:{library.id}", "works",
+            *(f"work:{row['work_id']}" for _, row in inserts),
+            *(f"book:{row['id']}" for row in updates),
+            *(f"loans:{row['id']}" for row in updates),
+            *(("copies", "loans") if updates else ())
+        )
+
+        for (index, _), book_id in zip(inserts, ids):
+            results[index] = {
+                "status": 201,
+                "location": href("api.bookitem", library=library, user=user, book=Book(id=book_id))
+            }
+        return json_response({"items": results})
+
 class BookItem(Resource):
     """
     BookItem resource
@@ -127,11 +315,15 @@ class BookItem(Resource):
         """
         Fetch book item
         """
-        return Response(
-            response=json.dumps(itemize(book)),
-            status=200,
-            mimetype="application/json"
-        )
+        cache_tags(f"book:{book.id}", "names")
+        etag = row_etag(book, book.library, book.library.owner)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        with timing("serialize"):
+            response = json_response(itemize(book))
+        response.set_etag(etag)
+        return response
 
     @swag_from("../doc/bookitem/put.yml")
     def put(self, user=None, library=None, book=None):
@@ -140,9 +332,19 @@ class BookItem(Resource):
         """
         if not request.json:
             return "Wrong media type was used", 415
-        validate(request.json, "Book", "../doc/librerian.yml")
+        validate(request.json, "Book")
+        check_if_match(row_etag(book, book.library, book.library.owner))
 
-        book.deserialize(doc=request.json)
+        # status changes open and close loans
+        tags = (
+            "books", f"books:{book.library_id}", f"book:{book.id}", "works", f"work:{book.work_id}",
+            "loans", f"loans:{book.id}"
+        )
+        try:
+            book.deserialize(doc=request.json)
+        except (TypeError, ValueError) as err:
+            db.session.rollback()
+            return str(err), 400
         book.library = library
 
         try:
@@ -150,6 +352,10 @@ class BookItem(Resource):
         except IntegrityError:
             db.session.rollback()
             return "Book already exits", 409
+        except StaleDataError:
+            db.session.rollback()
+            return "The book was modified by another request", 412
+        invalidate(*tags, f"books:{library.id}", f"work:{book.work_id}")
 
         return "The book was updated succesfully", 204
 
@@ -158,6 +364,12 @@ class BookItem(Resource):
         """
         Delete book item
         """
+        # the loans of the book are deleted with it
+        tags = (
+            "books", f"books:{book.library_id}", f"book:{book.id}", "works", f"work:{book.work_id}",
+            "loans", f"loans:{book.id}"
+        )
         db.session.delete(book)
         db.session.commit()
+        invalidate(*tags)
         return "The book was succesfully deleted", 200
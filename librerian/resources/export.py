@@ -0,0 +1,164 @@
+"""
+Export resources
+
+Classes:
+    ExportResource : Resource
+    UserExport : ExportResource
+    LibraryExport : ExportResource
+    BookExport : ExportResource
+    WorkExport : ExportResource
+"""
+import zlib
+
+from flask import Response, current_app, request, stream_with_context
+from flask_restful import Resource
+from flasgger import swag_from
+
+from librerian.models import User, Library, Book, Work
+
+def ndjson_lines(query, batch_size, encode, keys=("id",)):
+    """
+    Serialize query rows into NDJSON, one chunk per batch of rows
+    Each record starts with the key columns of its row, the serialized form
+    alone does not identify the row
+    The session of the query is closed when the stream ends, it has already
+    been removed from the request scope by then
+
+    Parameters:
+        query : Query
+        batch_size : int
+        encode : function
+            encodes a record into JSON bytes
+        keys : tuple of str
+            default : ("id",)
+            key columns added to each record
+    """
+    try:
+        batch = []
+        for record in query.yield_per(batch_size):
+            item = {key: getattr(record, key) for key in keys}
+            item.update(record.serialize(True))
+            batch.append(encode(item))
+            if len(batch) == batch_size:
+                yield b"\n".join(batch) + b"\n"
+                batch = []
+        if batch:
+            yield b"\n".join(batch) + b"\n"
+    finally:
+        query.session.close()
+
+def gzip_chunks(chunks):
+    """
+    Compress chunks into a gzip stream on the fly
+
+    Parameters:
+        chunks : iterable of bytes
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class ExportResource(Resource):
+    """
+    Base resource for exporting all rows of a model as NDJSON
+
+    Attributes:
+        model : Model
+        keys : tuple of str
+            key columns added to each record
+
+    Methods:
+    - get
+    """
+    model = None
+    keys = ("id",)
+
+    def get(self):
+        """
+        Stream every row of the model, one serialized record per line
+        Response is gzip compressed if the client accepts it
+        """
+        query = self.model.query.order_by(self.model.id)
+        chunks = ndjson_lines(
+            query, current_app.config["STREAM_BATCH_SIZE"],
+            current_app.extensions["json_encoder"].dumps, self.keys
+        )
+        headers = {"Vary": "Accept-Encoding"}
+        if request.accept_encodings["gzip"] > 0:
+            chunks = gzip_chunks(chunks)
+            headers["Content-Encoding"] = "gzip"
+        return Response(
+            stream_with_context(chunks),
+            status=200,
+            headers=headers,
+            mimetype="application/x-ndjson"
+        )
+
+class UserExport(ExportResource):
+    """
+    UserExport resource
+
+    Methods:
+    - get
+    """
+    model = User
+
+    @swag_from("../doc/userexport/get.yml")
+    def get(self):
+        """
+        Export all users
+        """
+        return super().get()
+
+class LibraryExport(ExportResource):
+    """
+    LibraryExport resource
+
+    Methods:
+    - get
+    """
+    model = Library
+    keys = ("id", "owner_id")
+
+    @swag_from("../doc/libraryexport/get.yml")
+    def get(self):
+        """
+        Export all libraries
+        """
+        return super().get()
+
+class BookExport(ExportResource):
+    """
+    BookExport resource
+
+    Methods:
+    - get
+    """
+    model = Book
+    keys = ("id", "library_id")
+
+    @swag_from("../doc/bookexport/get.yml")
+    def get(self):
+        """
+        Export all books
+        """
+        return super().get()
+
+class WorkExport(ExportResource):
+    """
+    WorkExport resource
+
+    Methods:
+    - get
+    """
+    model = Work
+
+    @swag_from("../doc/workexport/get.yml")
+    def get(self):
+        """
+        Export all works
+        """
+        return super().get()
@@ -6,14 +6,22 @@ Classes:
     LibraryLocalCollection : Resource
     LibraryItem : Resource
 """
-import json
 
 from flask import Response, request, url_for
 from flask_restful import Resource
-from flasgger import swag_from, validate
+from flasgger import swag_from
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
 
+from librerian.cache import cache_tags, invalidate
+from librerian.encoding import json_response
+from librerian.links import href
+from librerian.metrics import timing
 from librerian.models import Library
+from librerian.utils import (
+    check_if_match, collection_response, not_modified, row_etag, validate
+)
 from librerian import db
 
 def itemize(library):
@@ -23,16 +31,16 @@ def itemize(library):
     data = library.serialize(short_form=True)
     data["links"] = {
         "self": {
-            "href": url_for("api.libraryitem", library=library, user=library.owner)
+            "href": href("api.libraryitem", library=library, user=library.owner)
         },
         "collection": {
-            "href": url_for("api.librarylocalcollection", user=library.owner)
+            "href": href("api.librarylocalcollection", user=library.owner)
         },
         "up": {
-            "href": url_for("api.libraryglobalcollection")
+            "href": href("api.libraryglobalcollection")
         },
         "about": {
-            "href": url_for("api.booklocalcollection", library=library, user=library.owner)
+            "href": href("api.booklocalcollection", library=library, user=library.owner)
         }
     }
 
@@ -50,17 +58,12 @@ class LibraryGlobalCollection(Resource):
         """
         Fetch list of all the libraries
         """
-        body = {
-            "items": [],
-            "links": {
-                "self": {
-                    "href": url_for("api.libraryglobalcollection")
-                }
-            }
-        }
-        for library in Library.query.all():
-            body["items"].append(itemize(library))
-        return Response(response=json.dumps(body), status=200, mimetype="application/json")
+        cache_tags("libraries", "names")
+        return collection_response(
+            Library.query.options(joinedload(Library.owner)), Library.id, itemize,
+            "api.libraryglobalcollection",
+            tables=("library", "user")
+        )
 
 class LibraryLocalCollection(Resource):
     """
@@ -75,17 +78,11 @@ class LibraryLocalCollection(Resource):
         """
         Fetch list of libraries of an user
         """
-        body = {
-            "items": [],
-            "links": {
-                "self": {
-                    "href": url_for("api.librarylocalcollection", user=user)
-                }
-            }
-        }
-        for library in Library.query.filter_by(owner=user):
-            body["items"].append(itemize(library))
-        return Response(response=json.dumps(body), status=200, mimetype="application/json")
+        cache_tags(f"libraries:{user.id}", "names")
+        return collection_response(
+            Library.query.filter_by(owner=user), Library.id, itemize,
+            "api.librarylocalcollection", tables=("library", "user"), user=user
+        )
 
     @swag_from("../doc/librarylocalcollection/post.yml")
     def post(self, user=None):
@@ -96,7 +93,7 @@ class LibraryLocalCollection(Resource):
             return "Invalid URL for POST", 415
         if not request.json:
             return "Wrong media type was used", 415
-        validate(request.json, "Library", "../doc/librerian.yml")
+        validate(request.json, "Library")
 
         library = Library()
         library.deserialize(doc=request.json)
@@ -108,6 +105,7 @@ class LibraryLocalCollection(Resource):
         except IntegrityError:
             db.session.rollback()
             return "A library with the same name already exists", 409
+        invalidate("libraries", f"libraries:{user.id}")
 
         return Response(
             headers={"Location": url_for("api.libraryitem", library=library, user=user)},
@@ -130,11 +128,15 @@ class LibraryItem(Resource):
         """
         Fetch library item
         """
-        return Response(
-            response=json.dumps(itemize(library)),
-            status=200,
-            mimetype="application/json"
-        )
+        cache_tags(f"library:{library.id}", "names")
+        etag = row_etag(library, library.owner)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        with timing("serialize"):
+            response = json_response(itemize(library))
+        response.set_etag(etag)
+        return response
 
     @swag_from("../doc/libraryitem/put.yml")
     def put(self, user=None, library=None):
@@ -143,8 +145,11 @@ class LibraryItem(Resource):
         """
         if not request.json:
             return "Wrong media type was used", 415
-        validate(request.json, "Library", "../doc/librerian.yml")
+        validate(request.json, "Library")
+        check_if_match(row_etag(library, library.owner))
 
+        renamed = library.name != request.json["name"]
+        owner_id = library.owner_id
         library.deserialize(doc=request.json)
         library.owner = user
 
@@ -153,6 +158,14 @@ class LibraryItem(Resource):
         except IntegrityError:
             db.session.rollback()
             return "A library with the same name already exists", 409
+        except StaleDataError:
+            db.session.rollback()
+            return "The library was modified by another request", 412
+        # book links contain the library name
+        invalidate(
+            "libraries", f"libraries:{owner_id}", f"libraries:{user.id}",
+            f"library:{library.id}", *(("names",) if renamed else ())
+        )
 
         return "The library was updated succesfully", 204
 
@@ -161,6 +174,10 @@ class LibraryItem(Resource):
         """
         Delete library item
         """
+        tags = (
+            "libraries", f"libraries:{library.owner_id}", f"library:{library.id}", "names", "works"
+        )
         db.session.delete(library)
         db.session.commit()
+        invalidate(*tags)
         return "The library was succesfully deleted", 200
@@ -0,0 +1,277 @@
+"""
+Loan resources
+
+Borrowing and returning a book are single conditional UPDATE statements on
+the book row, so of concurrent requests for the same copy only one changes
+its status. Triggers on the book table write the loan history in the same
+statement. Loans are addressed by book id to avoid the URL converter
+queries of the book item. Loan listings include the archived loans, see
+librerian.archive.
+
+Classes:
+    BookLoan : Resource
+    LoanCollection : Resource
+    UserLoanCollection : Resource
+"""
+from datetime import datetime
+
+from flask import Response, current_app, request, url_for
+from flask_restful import Resource
+from flasgger import swag_from
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import joinedload
+
+from librerian.archive import read_archived_loans
+from librerian.cache import cache_tags, invalidate
+from librerian.constants import BOOK_AVAILABLE, BOOK_BORROWED
+from librerian.encoding import json_response
+from librerian.links import href
+from librerian.metrics import timing
+from librerian.models import Book, Loan, User
+from librerian.utils import (
+    date_arg, decode_cursor, not_modified, page_query, page_rows, table_etag, validate
+)
+from librerian import db
+
+def itemize(loan):
+    """
+    Itemize loan data
+    """
+    data = loan.serialize()
+    data["links"] = {
+        "collection": {
+            "href": href("api.loancollection", book=Book(id=loan.book_id))
+        }
+    }
+    if loan.borrower is not None:
+        data["links"]["borrower"] = {
+            "href": href("api.useritem", user=loan.borrower)
+        }
+    return data
+
+def _archived(records):
+    """
+    Transient loans of archived records with their borrowers loaded
+    """
+    borrower_ids = {record["borrower_id"] for record in records} - {None}
+    borrowers = {}
+    if borrower_ids:
+        borrowers = {user.id: user for user in User.query.filter(User.id.in_(borrower_ids))}
+    loans = []
+    for record in records:
+        loan = Loan(**record)
+        loan.borrower = borrowers.get(record["borrower_id"])
+        loans.append(loan)
+    return loans
+
+def loan_response(column, value, endpoint, **values):
+    """
+    Build response for a loan collection
+    Pages are read from the loan table and from the archive files of the
+    months that overlap the since and until arguments, and merged by id
+
+    Parameters:
+        column : Column
+            Loan.book_id or Loan.borrower_id
+        value : int
+        endpoint : str
+        values : dict
+            URL values for endpoint
+    """
+    etag = table_etag("loan", "user")
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    since = date_arg("since")
+    until = date_arg("until")
+    query = Loan.query.options(joinedload(Loan.borrower)).filter(column == value)
+    if since is not None:
+        query = query.filter(Loan.borrowed_at >= since)
+    if until is not None:
+        query = query.filter(Loan.borrowed_at < until)
+    query, limit = page_query(query, Loan.id)
+    rows = query.all()
+
+    before = request.args.get("before")
+    before = None if before is None else decode_cursor(before)
+    after = request.args.get("after")
+    after = None if after is None else decode_cursor(after)
+    records = read_archived_loans(
+        current_app.config["LOAN_ARCHIVE_DIR"], column.key, value,
+        since, until, after, before, limit + 1
+    )
+    if records:
+        live = {row.id for row in rows}
+        rows = sorted(
+            rows + [loan for loan in _archived(records) if loan.id not in live],
+            key=lambda loan: loan.id, reverse=before is not None
+        )[:limit + 1]
+    rows, page_links = page_rows(rows, Loan.id, limit, endpoint, **values)
+
+    links = {
+        "self": {
+            "href": url_for(endpoint, **values)
+        }
+    }
+    links.update(page_links)
+    with timing("serialize"):
+        body = {
+            "items": [itemize(row) for row in rows],
+            "links": links
+        }
+        response = json_response(body)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+def change_status(book_id, status, values, *criteria):
+    """
+    Change status of a book to values[status] if the book has status
+    The status is checked and changed in one UPDATE ... RETURNING statement
+
+    Parameters:
+        book_id : int
+        status : int
+            status the book must have
+        values : dict
+            new column values
+        criteria : additional filter expressions
+
+    Returns:
+        library id and work id of the book, None if the book does not exist
+        or does not have status
+    """
+    table = Book.__table__
+    statement = (
+        update(table)
+        .where(table.c.id == book_id, table.c.status == status, *criteria)
+        .values(version=table.c.version + 1, **values)
+        .returning(table.c.library_id, table.c.work_id)
+    )
+    row = db.session.execute(statement).first()
+    db.session.commit()
+    return row
+
+def _invalidate(book_id, row):
+    library_id, work_id = row
+    invalidate(
+        "books", f"books:{library_id}", f"book:{book_id}", "works", f"work:{work_id}",
+        "loans", f"loans:{book_id}"
+    )
+
+class BookLoan(Resource):
+    """
+    BookLoan resource
+
+    Methods:
+    - get
+    - post
+    - delete
+    """
+    @swag_from("../doc/bookloan/get.yml")
+    def get(self, book):
+        """
+        Fetch the open loan of a book
+        """
+        cache_tags(f"loans:{book}", "names")
+        loan = Loan.query.options(joinedload(Loan.borrower)).filter_by(
+            book_id=book, returned_at=None
+        ).first()
+        if loan is None:
+            if db.session.get(Book, book) is None:
+                return "The book was not found", 404
+            return "The book is not borrowed", 404
+        with timing("serialize"):
+            return json_response(itemize(loan))
+
+    @swag_from("../doc/bookloan/post.yml")
+    def post(self, book):
+        """
+        Borrow a book
+        """
+        if not request.json:
+            return "Wrong media type was used", 415
+        validate(request.json, "Loan")
+        validity_end = None
+        if "validity_end" in request.json:
+            try:
+                validity_end = datetime.fromisoformat(request.json["validity_end"])
+            except ValueError:
+                return "validity_end must be an ISO 8601 datetime", 400
+
+        borrower = select(User.id).where(User.handle == request.json["borrower"])
+        row = change_status(
+            book, BOOK_AVAILABLE,
+            {
+                "status": BOOK_BORROWED,
+                "borrower_id": borrower.scalar_subquery(),
+                "validity_start": func.current_timestamp(),
+                "validity_end": validity_end
+            },
+            borrower.exists()
+        )
+        if row is None:
+            if db.session.get(Book, book) is None:
+                return "The book was not found", 404
+            if db.session.scalar(borrower) is None:
+                return "Borrower is invalid", 409
+            return "The book is not available", 409
+        _invalidate(book, row)
+
+        return Response(
+            headers={"Location": url_for("api.bookloan", book=Book(id=book))},
+            response="The book was borrowed succesfully",
+            status=201
+        )
+
+    @swag_from("../doc/bookloan/delete.yml")
+    def delete(self, book):
+        """
+        Return a borrowed book
+        """
+        row = change_status(
+            book, BOOK_BORROWED,
+            {
+                "status": BOOK_AVAILABLE,
+                "borrower_id": None,
+                "validity_start": None,
+                "validity_end": None
+            }
+        )
+        if row is None:
+            if db.session.get(Book, book) is None:
+                return "The book was not found", 404
+            return "The book is not borrowed", 409
+        _invalidate(book, row)
+        return "The book was returned succesfully", 204
+
+class LoanCollection(Resource):
+    """
+    LoanCollection resource
+
+    Methods:
+    - get
+    """
+    @swag_from("../doc/loancollection/get.yml")
+    def get(self, book):
+        """
+        Fetch the loan history of a book
+        """
+        cache_tags(f"loans:{book.id}", "names")
+        return loan_response(Loan.book_id, book.id, "api.loancollection", book=book)
+
+class UserLoanCollection(Resource):
+    """
+    UserLoanCollection resource
+
+    Methods:
+    - get
+    """
+    @swag_from("../doc/userloancollection/get.yml")
+    def get(self, user):
+        """
+        Fetch the loan history of a user
+        """
+        cache_tags("loans", "names")
+        return loan_response(Loan.borrower_id, user.id, "api.userloancollection", user=user)
@@ -5,14 +5,21 @@ Classes:
     UserCollection : Resource
     UserItem : Resource
 """
-import json
 
 from flask import Response, request, url_for
 from flask_restful import Resource
-from flasgger import swag_from, validate
+from flasgger import swag_from
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
+from librerian.cache import cache_tags, invalidate
+from librerian.encoding import json_response
+from librerian.links import href
+from librerian.metrics import timing
 from librerian.models import User
+from librerian.utils import (
+    check_if_match, collection_response, not_modified, row_etag, validate
+)
 from librerian import db
 
 def itemize(user):
@@ -22,13 +29,13 @@ def itemize(user):
     data = user.serialize(short_form=True)
     data["links"] = {
         "self": {
-            "href": url_for("api.useritem", user=user)
+            "href": href("api.useritem", user=user)
         },
         "collection": {
-            "href": url_for("api.usercollection")
+            "href": href("api.usercollection")
         },
         "about": {
-            "href": url_for("api.librarylocalcollection", user=user)
+            "href": href("api.librarylocalcollection", user=user)
         }
     }
     return data
@@ -46,17 +53,10 @@ class UserCollection(Resource):
         """
         Fetch a list of users
         """
-        body = {
-            "items": [],
-            "links": {
-                "self": {
-                    "href": url_for("api.usercollection")
-                }
-            }
-        }
-        for user in User.query.all():
-            body["items"].append(itemize(user))
-        return Response(response=json.dumps(body), status=200, mimetype="application/json")
+        cache_tags("users")
+        return collection_response(
+            User.query, User.id, itemize, "api.usercollection", tables=("user",)
+        )
 
     @swag_from("../doc/usercollection/post.yml")
     def post(self):
@@ -66,7 +66,7 @@ class UserCollection(Resource):
         if not request.json:
             return "Wrong media type was used", 415
 
-        validate(request.json, "User", "../doc/librerian.yml")
+        validate(request.json, "User")
 
         user = User()
         user.deserialize(doc=request.json)
@@ -77,6 +77,7 @@ class UserCollection(Resource):
         except IntegrityError:
             db.session.rollback()
             return "A user with the same handle or email already exists", 409
+        invalidate("users")
 
         return Response(
             headers={"Location": url_for("api.useritem", user=user)},
@@ -98,11 +99,15 @@ class UserItem(Resource):
         """
         Fetch user item
         """
-        return Response(
-            response=json.dumps(itemize(user)),
-            status=200,
-            mimetype="application/json"
-        )
+        cache_tags(f"user:{user.id}")
+        etag = row_etag(user)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        with timing("serialize"):
+            response = json_response(itemize(user))
+        response.set_etag(etag)
+        return response
 
     @swag_from("../doc/useritem/put.yml")
     def put(self, user):
@@ -111,8 +116,10 @@ class UserItem(Resource):
         """
         if not request.json:
             return "Wrong media type was used", 415
-        validate(request.json, "User", "../doc/librerian.yml")
+        validate(request.json, "User")
+        check_if_match(row_etag(user))
 
+        renamed = user.handle != request.json["handle"]
         user.deserialize(doc=request.json)
 
         try:
@@ -120,6 +127,11 @@ class UserItem(Resource):
         except IntegrityError:
             db.session.rollback()
             return "A user with the same handle or email already exists", 409
+        except StaleDataError:
+            db.session.rollback()
+            return "The user was modified by another request", 412
+        # library and book links contain the user handle
+        invalidate("users", f"user:{user.id}", *(("names",) if renamed else ()))
 
         return "The user was updated succesfully", 204
 
@@ -128,6 +140,8 @@ class UserItem(Resource):
         """
         Delete user item
         """
+        user_id = user.id
         db.session.delete(user)
         db.session.commit()
+        invalidate("users", f"user:{user_id}", "names", "works")
         return "The user was succesfully deleted", 200
@@ -3,18 +3,35 @@ Work resources
 
 Classes:
     WorkCollection : Resource
+    WorkSearch : Resource
+    WorkBatch : Resource
     WorkItem : Resource
 """
-import json
+import re
 
 from flask import Response, request, url_for
 from flask_restful import Resource
-from flasgger import swag_from, validate
+from flasgger import swag_from
+from sqlalchemy import and_, column, func, literal_column, or_, select, table
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
+from librerian.cache import cache_tags, invalidate
+from librerian.encoding import json_response
+from librerian.links import href, link_template
+from librerian.metrics import timing
 from librerian.models import Work, Book
+from librerian.resources.book import eager_books
+from librerian.utils import (
+    check_if_match, collection_response, decode_cursor, deserialize_batch, encode_cursor,
+    existing_ids, flag_arg, make_etag, not_modified, page_limit, row_etag, table_etag, validate,
+    write_batch
+)
 from librerian import db
 
+SEARCH_TERM = re.compile(r"\w+")
+work_fts = table("work_fts", column("rowid"))
+
 def itemize(work):
     """
     Itemize work data
@@ -22,14 +39,78 @@ def itemize(work):
     data = work.serialize()
     data["links"] = {
         "self": {
-            "href": url_for("api.workitem", work=work)
+            "href": href("api.workitem", work=work)
         },
         "collection": {
-            "href": url_for("api.workcollection")
+            "href": href("api.workcollection")
         }
     }
     return data
 
+WORK_COLUMNS = (
+    Work.id, Work.title, Work.author, Work.cover, Work.isbn,
+    Work.total_copies, Work.available_copies, Work.borrowed_copies
+)
+
+def row_itemizer():
+    """
+    Itemize function for rows of WORK_COLUMNS, gives the same items as itemize
+    """
+    item = link_template("api.workitem")
+    collection = {"href": link_template("api.workcollection").build()}
+
+    def itemize_row(row):
+        work_id, title, author, cover, isbn, total, available, borrowed = row
+        return {
+            "title": title,
+            "author": author,
+            "cover": cover,
+            "isbn": isbn,
+            "total_copies": total,
+            "available_copies": available,
+            "borrowed_copies": borrowed,
+            "links": {
+                "self": {"href": item.format(work=str(work_id))},
+                "collection": collection
+            }
+        }
+
+    return itemize_row
+
+def filter_works(query):
+    """
+    Filter work query with request arguments
+    isbn and author must match exactly, title is matched as a prefix and
+    available limits the works to those with a lendable copy
+    """
+    isbn = request.args.get("isbn")
+    if isbn is not None:
+        query = query.filter(Work.isbn == isbn)
+    author = request.args.get("author")
+    if author is not None:
+        query = query.filter(Work.author == author)
+    title = request.args.get("title")
+    if title:
+        # range instead of LIKE so that the title index can be used
+        query = query.filter(Work.title >= title, Work.title < title + "\U0010ffff")
+    if flag_arg("available"):
+        query = query.filter(Work.available_copies > 0)
+    return query
+
+def match_expression(query):
+    """
+    Convert search text into an FTS5 query
+    Every word must match as a prefix of a title or author word
+    """
+    return " ".join(f'"{term}"*' for term in SEARCH_TERM.findall(query))
+
+def parse_rank_key(key):
+    """
+    Parse search cursor key of form rank/id
+    """
+    rank, work_id = key.split("/")
+    return float(rank), int(work_id)
+
 def itemize_book(book):
     """
     Itemize book data
@@ -37,20 +118,30 @@ def itemize_book(book):
     data = book.serialize()
     data["links"] = {
         "self": {
-            "href": url_for("api.bookitem", book=book, library=book.library, user=book.library.owner)
+            "href": href("api.bookitem", book=book, library=book.library, user=book.library.owner)
         },
         "collection": {
-            "href": url_for("api.booklocalcollection", library=book.library, user=book.library.owner)
+            "href": href("api.booklocalcollection", library=book.library, user=book.library.owner)
         },
         "up": {
-            "href": url_for("api.bookglobalcollection")
+            "href": href("api.bookglobalcollection")
         },
         "type": {
-            "href": url_for("api.workitem", work=book.work)
+            "href": href("api.workitem", work=book.work)
         }
     }
     return data
 
+def work_etag(work):
+    """
+    Entity tag of a work item, which also lists the books of the work
+    None if the book tables have no version counters
+    """
+    tables = table_etag("book", "library", "user")
+    if tables is None:
+        return None
+    return make_etag(row_etag(work), tables)
+
 class WorkCollection(Resource):
     """
     Work Collection resource
@@ -64,16 +155,11 @@ class WorkCollection(Resource):
         """
         Fetch a list of the works
         """
-        work_list = Work.query.all()
-        body = {
-            "items": [],
-            "self": {
-                "href": url_for("api.workcollection")
-            }
-        }
-        for work in work_list:
-            body["items"].append(itemize(work))
-        return Response(response=json.dumps(body), status=200, mimetype="application/json")
+        cache_tags("works")
+        return collection_response(
+            filter_works(db.session.query(*WORK_COLUMNS)), Work.id, row_itemizer(),
+            "api.workcollection", tables=("work",)
+        )
 
     @swag_from("../doc/workcollection/post.yml")
     def post(self):
@@ -82,7 +168,7 @@ class WorkCollection(Resource):
         """
         if not request.json:
             return "Wrong media type was used", 415
-        validate(request.json, "Work", "../doc/librerian.yml")
+        validate(request.json, "Work")
 
         work = Work()
         work.deserialize(doc=request.json)
@@ -93,6 +179,7 @@ class WorkCollection(Resource):
         except IntegrityError:
             db.session.rollback()
             return "A work with the same ---- already exists", 409
+        invalidate("works")
 
         return Response(
             headers={"Location": url_for("api.workitem", work=work)},
@@ -100,6 +187,122 @@ class WorkCollection(Resource):
             status=201
         )
 
+class WorkSearch(Resource):
+    """
+    Work search resource
+
+    Methods:
+    - get
+    """
+    @swag_from("../doc/worksearch/get.yml")
+    def get(self):
+        """
+        Search works by title and author, best matches first
+        """
+        expression = match_expression(request.args.get("q", ""))
+        if not expression:
+            return "Search query is missing", 400
+        cache_tags("works")
+        limit = page_limit()
+        etag = table_etag("work")
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        rank = func.bm25(literal_column("work_fts")).label("rank")
+        matches = (
+            select(work_fts.c.rowid.label("id"), rank)
+            .where(literal_column("work_fts").op("MATCH")(expression))
+            .subquery()
+        )
+        query = (
+            Work.query.join(matches, Work.id == matches.c.id)
+            .add_columns(matches.c.rank)
+            .order_by(matches.c.rank, matches.c.id)
+        )
+        after = request.args.get("after")
+        if after is not None:
+            after_rank, after_id = decode_cursor(after, parse_rank_key)
+            query = query.filter(or_(
+                matches.c.rank > after_rank,
+                and_(matches.c.rank == after_rank, matches.c.id > after_id)
+            ))
+        rows = query.limit(limit + 1).all()
+
+        with timing("serialize"):
+            body = {
+                "items": [itemize(work) for work, _rank in rows[:limit]],
+                "links": {
+                    "self": {
+                        "href": url_for("api.worksearch", q=request.args["q"])
+                    },
+                    "collection": {
+                        "href": url_for("api.workcollection")
+                    }
+                }
+            }
+            if len(rows) > limit:
+                work, last_rank = rows[limit - 1]
+                args = {name: value for name, value in request.args.items() if name != "after"}
+                body["links"]["next"] = {
+                    "href": url_for(
+                        "api.worksearch", **args, after=encode_cursor(f"{last_rank!r}/{work.id}")
+                    )
+                }
+            response = json_response(body)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
+
+class WorkBatch(Resource):
+    """
+    WorkBatch resource
+
+    Methods:
+    - post
+    """
+    @swag_from("../doc/workbatch/post.yml")
+    def post(self):
+        """
+        Add or update a batch of works in a single transaction
+        """
+        if request.json is None:
+            return "Wrong media type was used", 415
+        if not isinstance(request.json, list):
+            return "Batch must be a JSON array", 400
+        if not request.json:
+            return json_response({"items": []})
+
+        results, rows = deserialize_batch(request.json, "Work", Work)
+        found = existing_ids(Work.id, (row["id"] for _, row in rows if "id" in row))
+        inserts = []
+        updates = []
+        for index, row in rows:
+            if "id" not in row:
+                inserts.append((index, row))
+            elif row["id"] in found:
+                updates.append(row)
+                results[index] = {
+                    "status": 204,
+                    "location": href("api.workitem", work=Work(id=row["id"]))
+                }
+            else:
+                results[index] = {"status": 404, "message": "The work was not found"}
+
+        try:
+            ids = write_batch(Work, [row for _, row in inserts], updates)
+        except IntegrityError:
+            db.session.rollback()
+            return "A work with the same ---- already exists", 409
+        invalidate("works", *(f"work:{row['id']}" for row in updates))
+
+        for (index, _), work_id in zip(inserts, ids):
+            results[index] = {
+                "status": 201,
+                "location": href("api.workitem", work=Work(id=work_id))
+            }
+        return json_response({"items": results})
+
 class WorkItem(Resource):
     """
     WorkItem resource
@@ -114,15 +317,19 @@ class WorkItem(Resource):
         """
         Fetch work item
         """
-        data = itemize(work)
-        data["links"]["items"] = []
-        for book in Book.query.filter_by(work=work):
-            data["links"]["items"].append(itemize_book(book))
-        return Response(
-            response=json.dumps(data),
-            status=200,
-            mimetype="application/json"
-        )
+        cache_tags(f"work:{work.id}", "names", "copies")
+        etag = work_etag(work)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        books = eager_books().filter_by(work=work).all()
+        with timing("serialize"):
+            data = itemize(work)
+            data["links"]["items"] = [itemize_book(book) for book in books]
+            response = json_response(data)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
 
     @swag_from("../doc/workitem/put.yml")
     def put(self, work):
@@ -131,23 +338,22 @@ class WorkItem(Resource):
         """
         if not request.json:
             return "Wrong media type was used", 415
-        validate(request.json, "Work", "../doc/librerian.yml")
+        validate(request.json, "Work")
+        check_if_match(work_etag(work))
 
-        work = Work()
         work.deserialize(doc=request.json)
 
         try:
-            db.session.add(work)
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
             return "A work with the same ---- already exists", 409
+        except StaleDataError:
+            db.session.rollback()
+            return "The work was modified by another request", 412
+        invalidate("works", f"work:{work.id}")
 
-        return Response(
-            headers={"Location": url_for("api.workitem", work=work)},
-            response="The work was modified succesfully",
-            status=201
-        )
+        return "The work was updated succesfully", 204
 
     @swag_from("../doc/workitem/delete.yml")
     def delete(self, work):
@@ -155,7 +361,9 @@ class WorkItem(Resource):
         Delete work item
         """
         if Book.query.filter_by(work=work).count() == 0:
+            work_id = work.id
             db.session.delete(work)
             db.session.commit()
+            invalidate("works", f"work:{work_id}")
             return "The work was succesfully deleted", 200
         return "The work has books associated, cannot be deleted", 409
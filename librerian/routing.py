@@ -0,0 +1,109 @@
+"""
+Read replica routing
+
+GET and HEAD requests read from the replica bind when one is configured,
+all other requests use the primary database. A client that has written
+recently is pinned to the primary with a cookie, so it reads its own writes
+while the replica catches up.
+
+Classes:
+    RoutingSession : Session
+
+Functions:
+    use_replica
+    init_app
+    sync_replica_command
+"""
+
+import sqlite3
+import time
+
+import click
+from flask import current_app, g, has_request_context, request
+from flask.cli import with_appcontext
+from flask_sqlalchemy.session import Session
+
+REPLICA_BIND = "replica"
+READ_METHODS = ("GET", "HEAD")
+PRIMARY_COOKIE = "librerian_primary"
+
+class RoutingSession(Session):
+    """
+    Session that sends the queries of read requests to the replica bind
+
+    Methods:
+        get_bind
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        """
+        Replica engine for read requests, otherwise the bind of the model
+        """
+        if bind is None and use_replica():
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def use_replica():
+    """
+    Whether the current request reads from the replica
+    Decided on first use and kept for the rest of the request, URL converters
+    query the database before request hooks are run
+    """
+    if not has_request_context():
+        return False
+    choice = g.get("use_replica")
+    if choice is None:
+        choice = (
+            request.method in READ_METHODS
+            and REPLICA_BIND in current_app.config["SQLALCHEMY_BINDS"]
+            and not _pinned()
+        )
+        g.use_replica = choice
+    return choice
+
+def _pinned():
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def _pin_writer(response):
+    window = current_app.config["READ_YOUR_WRITES_SECONDS"]
+    if request.method not in READ_METHODS and response.status_code < 400 and window > 0:
+        response.set_cookie(
+            PRIMARY_COOKIE, str(int(time.time() + window)),
+            max_age=window, httponly=True, samesite="Lax"
+        )
+    return response
+
+def init_app(app):
+    """
+    Pin clients to the primary after writes if a replica bind is configured
+    """
+    if REPLICA_BIND in app.config["SQLALCHEMY_BINDS"]:
+        app.after_request(_pin_writer)
+
+def _sqlite_path(engine):
+    database = engine.url.database
+    if engine.url.query.get("uri"):
+        database = database.split("?", 1)[0].removeprefix("file:")
+    return database
+
+@click.command("sync-replica")
+@with_appcontext
+def sync_replica_command():
+    """
+    Click command for copying the primary SQLite database over the replica
+    """
+    db = current_app.extensions["sqlalchemy"]
+    if REPLICA_BIND not in db.engines:
+        raise click.ClickException("No replica bind is configured")
+    source = db.engines[None].raw_connection()
+    target = sqlite3.connect(_sqlite_path(db.engines[REPLICA_BIND]))
+    try:
+        source.driver_connection.backup(target)
+    finally:
+        target.close()
+        source.close()
+    db.engines[REPLICA_BIND].dispose()
+    print("Replica synced from primary")
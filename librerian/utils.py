@@ -5,15 +5,182 @@ Classes:
     UserConverter : BaseConverter
     LibraryConverter : BaseConverter
     BookConverter : BaseConverter
+    BookIdConverter : BaseConverter
     WorkConverter : BaseConverter
+    TTLCache
+    SchemaRegistry
+
+Functions:
+    quote_key
+    lookup
+    encode_cursor
+    decode_cursor
+    page_limit
+    page_query
+    page_rows
+    paginate
+    flag_arg
+    int_arg
+    date_arg
+    make_etag
+    row_etag
+    table_versions
+    versions_etag
+    table_etag
+    not_modified
+    check_if_match
+    stream_collection
+    collection_response
+    validate
+    deserialize_batch
+    existing_ids
+    write_batch
 """
 
+import base64
+import binascii
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
 from urllib import parse
 
-from werkzeug.exceptions import NotFound
+import jsonschema
+import yaml
+from flask import Response, abort, current_app, g, request, stream_with_context, url_for
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import BadRequest, NotFound, PreconditionFailed
 from werkzeug.routing import BaseConverter
 
-from librerian.models import User, Library, Book, Work
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+from librerian.cache import hold_generation
+from librerian.encoding import json_response
+from librerian.metrics import timing
+from librerian.models import User, Library, Book, Work, TableVersion
+from librerian import db
+
+PAGE_ARGS = ("after", "before")
+SPEC_PATH = os.path.join(os.path.dirname(__file__), "doc", "librerian.yml")
+SCHEMA_NAMES = ("User", "Library", "Book", "Work", "Loan")
+IN_CHUNK_SIZE = 500
+QUOTE_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=QUOTE_CACHE_SIZE)
+def quote_key(value):
+    """
+    Quote natural key into a single URL path segment
+    Cached as the same handles and names repeat across listing items
+
+    Parameters:
+        value : str
+    """
+    return parse.quote(value, safe="")
+
+class TTLCache:
+    """
+    Thread safe LRU cache with entries that expire after ttl seconds
+
+    Methods:
+        get
+        set
+        clear
+    """
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get cached value, None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Store value, evicting the least recently used entry when full
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self._lock:
+            self._entries.clear()
+
+def _load(model, key_name, key, options):
+    """
+    Load model instance by key, None if not found
+    Primary key lookups go through the session identity map first. Other
+    keys are resolved to a primary key with the app's cross-request
+    converter cache when it is enabled
+    """
+    if key_name == "id":
+        try:
+            key = int(key)
+        except ValueError:
+            return None
+        return db.session.get(model, key, options=options)
+
+    keys = current_app.extensions.get("converter_cache")
+    if keys is not None:
+        primary_key = keys.get((model.__name__, key))
+        if primary_key is not None:
+            instance = db.session.get(model, primary_key, options=options)
+            # keys are not immutable, a renamed or deleted row falls back to a query
+            if instance is not None and getattr(instance, key_name) == key:
+                return instance
+
+    instance = model.query.options(*options).filter_by(**{key_name: key}).first()
+    if instance is not None and keys is not None:
+        keys.set((model.__name__, key), instance.id)
+    return instance
+
+def lookup(model, key_name, key, options=()):
+    """
+    Find model instance for URL converters, raises NotFound if missing
+    Results are cached for the rest of the request
+
+    Parameters:
+        model : Model
+        key_name : str
+            name of the unique column used in URLs
+        key : str
+        options : tuple
+            loader options for the query
+    """
+    cache = g.setdefault("converter_instances", {})
+    instance = cache.get((model, key))
+    if instance is None:
+        hold_generation()
+        instance = _load(model, key_name, key, options)
+        if instance is None:
+            raise NotFound
+        cache[(model, key)] = instance
+    return instance
 
 class UserConverter(BaseConverter):
     """
@@ -27,17 +194,13 @@ class UserConverter(BaseConverter):
         """
         Get model from uri
         """
-        handle = parse.unquote(value)
-        db_user = User.query.filter_by(handle=handle).first()
-        if db_user is None:
-            raise NotFound
-        return db_user
+        return lookup(User, "handle", parse.unquote(value))
 
     def to_url(self, value):
         """
         Get uri from model
         """
-        return parse.quote(value.handle, safe="")
+        return quote_key(value.handle)
 
 class LibraryConverter(BaseConverter):
     """
@@ -51,17 +214,13 @@ class LibraryConverter(BaseConverter):
         """
         Get model from uri
         """
-        name = parse.unquote(value)
-        db_library = Library.query.filter_by(name=name).first()
-        if db_library is None:
-            raise NotFound
-        return db_library
+        return lookup(Library, "name", parse.unquote(value))
 
     def to_url(self, value):
         """
         Get uri from model
         """
-        return parse.quote(value.name, safe="")
+        return quote_key(value.name)
 
 class BookConverter(BaseConverter):
     """
@@ -74,11 +233,32 @@ class BookConverter(BaseConverter):
     def to_python(self, value):
         """
         Get model from uri
+        Work is loaded with the book as book items link to it
         """
-        db_book = Book.query.filter_by(id=value).first()
-        if db_book is None:
-            raise NotFound
-        return db_book
+        return lookup(Book, "id", value, (joinedload(Book.work),))
+
+    def to_url(self, value):
+        """
+        Get uri from model
+        """
+        return str(value.id)
+
+class BookIdConverter(BaseConverter):
+    """
+    URI converter for book ids, the book is not loaded
+    Used by routes that check the book in their own statement
+
+    Methods:
+        to_python
+        to_url
+    """
+    regex = r"\d+"
+
+    def to_python(self, value):
+        """
+        Get book id from uri
+        """
+        return int(value)
 
     def to_url(self, value):
         """
@@ -98,13 +278,520 @@ class WorkConverter(BaseConverter):
         """
         Get model from uri
         """
-        db_work = Work.query.filter_by(id=value).first()
-        if db_work is None:
-            raise NotFound
-        return db_work
+        return lookup(Work, "id", value)
 
     def to_url(self, value):
         """
         Get uri from model
         """
         return str(value.id)
+
+def encode_cursor(key):
+    """
+    Encode primary key into an opaque pagination cursor
+
+    Parameters:
+        key : int
+    """
+    return base64.urlsafe_b64encode(str(key).encode()).rstrip(b"=").decode()
+
+def decode_cursor(cursor, convert=int):
+    """
+    Decode pagination cursor back into primary key
+    Raises BadRequest if the cursor is malformed
+
+    Parameters:
+        cursor : str
+        convert : function
+            parses the decoded key, raises ValueError if it is invalid
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return convert(base64.urlsafe_b64decode(cursor + padding).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise BadRequest(description="Invalid pagination cursor") from None
+
+def page_limit():
+    """
+    Get page size from request arguments
+    Defaults to PAGE_SIZE and is capped at PAGE_SIZE_MAX from app config
+    """
+    limit = request.args.get("limit", current_app.config["PAGE_SIZE"])
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise BadRequest(description="Limit must be an integer") from None
+    if limit < 1:
+        raise BadRequest(description="Limit must be positive")
+    return min(limit, current_app.config["PAGE_SIZE_MAX"])
+
+def page_query(query, key):
+    """
+    Apply keyset pagination from request arguments to a query or select
+    statement, one extra row is fetched to check whether a following page exists
+
+    Parameters:
+        query : Query or Select
+        key : Column
+            unique column the pages are ordered by, usually the primary key
+
+    Returns:
+        query : Query or Select
+        limit : int
+            page size
+    """
+    limit = page_limit()
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if after is not None and before is not None:
+        raise BadRequest(description="Only one of after and before can be used")
+
+    if before is not None:
+        query = query.filter(key < decode_cursor(before)).order_by(key.desc())
+    else:
+        if after is not None:
+            query = query.filter(key > decode_cursor(after))
+        query = query.order_by(key)
+    return query.limit(limit + 1), limit
+
+def page_rows(rows, key, limit, endpoint, **values):
+    """
+    Trim rows fetched with page_query to the page and build page links
+
+    Parameters:
+        rows : list
+        key : Column
+        limit : int
+        endpoint : str
+            endpoint used for building next and prev links
+        values : dict
+            URL values for endpoint
+
+    Returns:
+        rows : list
+        links : dict
+            next and prev hypermedia links for the page
+    """
+    if "before" in request.args:
+        has_prev = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        has_next = True
+    else:
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = "after" in request.args
+
+    args = {name: value for name, value in request.args.items() if name not in PAGE_ARGS}
+    links = {}
+    if rows and has_next:
+        cursor = encode_cursor(getattr(rows[-1], key.key))
+        links["next"] = {"href": url_for(endpoint, **values, **args, after=cursor)}
+    if rows and has_prev:
+        cursor = encode_cursor(getattr(rows[0], key.key))
+        links["prev"] = {"href": url_for(endpoint, **values, **args, before=cursor)}
+    return rows, links
+
+def paginate(query, key, endpoint, **values):
+    """
+    Apply keyset pagination from request arguments to query
+    Only rows on the requested page are fetched
+
+    Parameters:
+        query : Query
+        key : Column
+            unique column the pages are ordered by, usually the primary key
+        endpoint : str
+            endpoint used for building next and prev links
+        values : dict
+            URL values for endpoint
+
+    Returns:
+        rows : list
+        links : dict
+            next and prev hypermedia links for the page
+    """
+    query, limit = page_query(query, key)
+    return page_rows(query.all(), key, limit, endpoint, **values)
+
+def flag_arg(name):
+    """
+    Read boolean flag from request arguments
+
+    Parameters:
+        name : str
+    """
+    return request.args.get(name, "").lower() in ("1", "true", "yes")
+
+def int_arg(name):
+    """
+    Read integer from request arguments, None if not given
+    Raises BadRequest if the value is not an integer
+
+    Parameters:
+        name : str
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest(description=f"{name} must be an integer") from None
+
+def date_arg(name):
+    """
+    Read ISO 8601 datetime from request arguments, None if not given
+    Values with an offset are converted into naive UTC like the stored ones.
+    Raises BadRequest if the value is not a datetime
+
+    Parameters:
+        name : str
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = datetime.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(description=f"{name} must be an ISO 8601 datetime") from None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def make_etag(*parts):
+    """
+    Build entity tag from the values that identify a representation
+
+    Parameters:
+        parts : values, converted with str
+    """
+    value = "|".join(str(part) for part in parts).encode()
+    return hashlib.blake2b(value, digest_size=12).hexdigest()
+
+def row_etag(*rows):
+    """
+    Build entity tag from the row versions of the rows in a representation
+
+    Parameters:
+        rows : Model instances with a version column
+    """
+    return make_etag(*((row.__tablename__, row.id, row.version) for row in rows))
+
+def table_versions(tables):
+    """
+    Select statement for the version counters of tables as (name, version) rows
+
+    Parameters:
+        tables : tuple of str
+    """
+    return select(TableVersion.name, TableVersion.version).where(TableVersion.name.in_(tables))
+
+def versions_etag(versions, tables):
+    """
+    Build entity tag of a collection from the version counters of the tables
+    it reads and the request URL, None if a table has no version counter
+
+    Parameters:
+        versions : dict
+            version counters by table name
+        tables : tuple of str
+    """
+    if any(name not in versions for name in tables):
+        return None
+    return make_etag(request.full_path, *(versions[name] for name in tables))
+
+def table_etag(*tables):
+    """
+    Entity tag of a collection read from tables
+
+    Parameters:
+        tables : str
+            table names
+    """
+    return versions_etag(dict(db.session.execute(table_versions(tables)).all()), tables)
+
+def not_modified(etag):
+    """
+    304 response if If-None-Match of the request matches etag, None otherwise
+
+    Parameters:
+        etag : str
+    """
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def check_if_match(etag):
+    """
+    Raise PreconditionFailed if the request has If-Match that does not match etag
+
+    Parameters:
+        etag : str
+    """
+    if request.if_match and not request.if_match.contains(etag):
+        raise PreconditionFailed(description="The resource was modified by another request")
+
+def stream_collection(query, key, itemize, links):
+    """
+    Stream collection document while rows are read from the database
+    Rows are fetched in batches of STREAM_BATCH_SIZE and the output is the
+    same document dumps would produce for the whole body. The session of
+    the query is closed when the stream ends, it has already been removed
+    from the request scope by then
+
+    Parameters:
+        query : Query
+        key : Column
+            column the items are ordered by
+        itemize : function
+            converts a row into an item dict
+        links : dict
+            links block of the document
+    """
+    after = request.args.get("after")
+    if after is not None:
+        query = query.filter(key > decode_cursor(after))
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+    query = query.order_by(key).yield_per(batch_size)
+
+    encode = current_app.extensions["json_encoder"].dumps
+
+    def generate():
+        try:
+            yield b'{"items":['
+            separator = b""
+            batch = []
+            for row in query:
+                batch.append(encode(itemize(row)))
+                if len(batch) == batch_size:
+                    yield separator + b",".join(batch)
+                    separator = b","
+                    batch = []
+            if batch:
+                yield separator + b",".join(batch)
+            yield b'],"links":' + encode(links) + b"}"
+        finally:
+            query.session.close()
+
+    return Response(stream_with_context(generate()), status=200, mimetype="application/json")
+
+def collection_response(query, key, itemize, endpoint, tables=(), **values):
+    """
+    Build response for a collection resource
+    The collection is paginated, or streamed as a whole when the stream flag
+    is set in request arguments. The response is tagged with the versions of
+    tables and If-None-Match is answered with 304 before rows are read
+
+    Parameters:
+        query : Query
+        key : Column
+            unique column the items are ordered by
+        itemize : function
+            converts a row into an item dict
+        endpoint : str
+            endpoint of the collection
+        tables : tuple of str
+            tables the items are read from
+        values : dict
+            URL values for endpoint
+    """
+    etag = table_etag(*tables) if tables else None
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    links = {
+        "self": {
+            "href": url_for(endpoint, **values)
+        }
+    }
+    if flag_arg("stream"):
+        response = stream_collection(query, key, itemize, links)
+    else:
+        rows, page_links = paginate(query, key, endpoint, **values)
+        links.update(page_links)
+        with timing("serialize"):
+            body = {
+                "items": [itemize(row) for row in rows],
+                "links": links
+            }
+            response = json_response(body)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+class SchemaRegistry:
+    """
+    Validators for the request schemas in librerian.yml
+    The spec file is read once and a validator is built for each schema.
+    Schemas are compiled with fastjsonschema when it is installed, the
+    jsonschema validator is still used to produce error messages
+
+    Methods:
+        is_valid
+        error
+        validate
+    """
+    def __init__(self, path=SPEC_PATH, names=SCHEMA_NAMES):
+        with open(path, encoding="utf-8") as spec_file:
+            spec = yaml.safe_load(spec_file)
+        self.validators = {}
+        self.compiled = {}
+        for name in names:
+            schema = spec["components"]["schemas"][name]
+            validator_class = jsonschema.validators.validator_for(schema)
+            validator_class.check_schema(schema)
+            self.validators[name] = validator_class(schema)
+            if fastjsonschema is not None:
+                self.compiled[name] = fastjsonschema.compile(
+                    schema, use_default=False, use_formats=False, detailed_exceptions=False
+                )
+
+    def is_valid(self, doc, name):
+        """
+        Check document against schema
+
+        Parameters:
+            doc : json dict
+            name : str
+        """
+        compiled = self.compiled.get(name)
+        if compiled is None:
+            return self.validators[name].is_valid(doc)
+        try:
+            compiled(doc)
+        except fastjsonschema.JsonSchemaException:
+            return self.error(doc, name) is None
+        return True
+
+    def error(self, doc, name):
+        """
+        Get the most relevant validation error for document, None if valid
+
+        Parameters:
+            doc : json dict
+            name : str
+        """
+        return jsonschema.exceptions.best_match(self.validators[name].iter_errors(doc))
+
+    def validate(self, doc, name):
+        """
+        Validate document, aborts with 400 like flasgger.validate
+
+        Parameters:
+            doc : json dict
+            name : str
+        """
+        if not self.is_valid(doc, name):
+            abort(Response(str(self.error(doc, name)), status=400))
+
+def validate(doc, name):
+    """
+    Validate document against a schema of the app's schema registry
+
+    Parameters:
+        doc : json dict
+        name : str
+            name of the schema under components/schemas
+    """
+    current_app.extensions["schemas"].validate(doc, name)
+
+def deserialize_batch(docs, schema_name, model):
+    """
+    Validate and deserialize documents of a batch request in one pass
+    Documents with an id are updates of existing rows, others are new rows
+
+    Parameters:
+        docs : list of json dicts
+        schema_name : str
+        model : Model
+
+    Returns:
+        results : list
+            per document result, None for documents that passed
+        rows : list of (int, dict)
+            document index and column values of the valid documents
+    """
+    schemas = current_app.extensions["schemas"]
+    results = [None] * len(docs)
+    rows = []
+    for index, doc in enumerate(docs):
+        if not isinstance(doc, dict):
+            results[index] = {"status": 400, "message": "Item is not a JSON object"}
+            continue
+        if not schemas.is_valid(doc, schema_name):
+            results[index] = {"status": 400, "message": str(schemas.error(doc, schema_name))}
+            continue
+        instance = model()
+        try:
+            instance.deserialize(doc=doc)
+        except (TypeError, ValueError) as err:
+            results[index] = {"status": 400, "message": str(err)}
+            continue
+        row = {
+            key: value for key, value in instance.__dict__.items()
+            if key in model.__table__.columns
+        }
+        if "id" in doc:
+            # bool is a subclass of int, JSON true is not an id
+            if isinstance(doc["id"], bool) or not isinstance(doc["id"], int):
+                results[index] = {"status": 400, "message": "Item id must be an integer"}
+                continue
+            row["id"] = doc["id"]
+        rows.append((index, row))
+    return results, rows
+
+def existing_ids(column, ids, *criteria):
+    """
+    Get the subset of ids that exist in column
+    Ids are queried in chunks to stay within SQLite parameter limits
+
+    Parameters:
+        column : Column
+        ids : iterable of int
+        criteria : additional filter expressions
+    """
+    ids = list(set(ids))
+    found = set()
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[start:start + IN_CHUNK_SIZE]
+        query = column.class_.query.with_entities(column).filter(column.in_(chunk), *criteria)
+        found.update(value for value, in query)
+    return found
+
+def write_batch(model, inserts, updates):
+    """
+    Insert and update rows of a batch in a single transaction
+    Rows are sent with executemany, not one statement per row. Updated rows
+    get their version bumped in the same statement
+
+    Parameters:
+        model : Model
+        inserts : list of dicts
+            column values of new rows
+        updates : list of dicts
+            column values of existing rows, including id
+
+    Returns:
+        list of ids of the inserted rows, in the same order as inserts
+    """
+    if updates:
+        table = model.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("row_id"))
+            .values(version=table.c.version + 1)
+        )
+        db.session.execute(statement, [
+            {"row_id": row["id"], **{name: value for name, value in row.items() if name != "id"}}
+            for row in updates
+        ])
+    ids = []
+    if inserts:
+        statement = insert(model).returning(model.id, sort_by_parameter_order=True)
+        ids = db.session.scalars(statement, inserts).all()
+    db.session.commit()
+    return ids
@@ -7,34 +7,43 @@ import requests
 
 SERVER_URL = "http://localhost:5000"
 
+def get_all_items(url, params=None):
+    """ Collect the items of every page of a listing, following next links """
+    items = []
+    while url:
+        resp = requests.get(SERVER_URL + url, params=params, timeout=20)
+        page = resp.json()
+        items.extend(page["items"])
+        url = page["links"].get("next", {}).get("href")
+        params = None
+    return items
+
 def find_work(isbn):
     """ Look up work item based on isbn """
-    resp = requests.get(SERVER_URL + "/api/works/", timeout=20)
+    resp = requests.get(SERVER_URL + "/api/works/", params={"isbn": isbn}, timeout=20)
     works = resp.json()
-    for item in works["items"]:
-        if item["isbn"] == isbn:
-            return item
+    if works["items"]:
+        return works["items"][0]
     return "No title found with the requested ISBN. Try looking for 978-4-7659-7000-1"
 
 def find_work_title(work_id):
     """ Look up work item based on ID """
-    resp = requests.get(SERVER_URL + "/api/works/", timeout=20)
-    works = resp.json()
-    return works["items"][work_id-1]["title"]
+    resp = requests.get(SERVER_URL + f"/api/works/{work_id}/", timeout=20)
+    work = resp.json()
+    return work["title"]
 
 def locate_book(work_id):
     """ Look up libraries where a copy of work exists """
-    resp = requests.get(SERVER_URL + "/api/libraries/", timeout=20)
-    libraries = resp.json()
+    books = get_all_items("/api/books/", params={"work_id": work_id})
     result_libraries = []
-    for item in libraries["items"]:
-        #print(item["name"])
-        for book in item["books"]:
-            #print(book["work_id"])
-            #print(work_id)
-            if book["work_id"] == work_id:
-                result_libraries.append([item["name"], item["city"]])
-                #print(item["name"])
+    library_urls = set()
+    for book in books:
+        library_url = book["links"]["collection"]["href"].rsplit('/', 2)[0] + "/"
+        if library_url in library_urls:
+            continue
+        library_urls.add(library_url)
+        library = requests.get(SERVER_URL + library_url, timeout=20).json()
+        result_libraries.append([library["name"], library["city"]])
     if len(result_libraries) > 0:
         return result_libraries
     return "No books found. Did you populate the database with gen-db ?"
@@ -76,11 +85,10 @@ def find_work_title_by_book(book_item):
 
 def find_all_books():
     """ Look up all books in the system """
-    resp = requests.get(SERVER_URL + "/api/books/", timeout=20)
-    books = resp.json()
+    books = get_all_items("/api/books/")
     index = 0
     listbox.delete(0, tk.END)
-    for item in books["items"]:
+    for item in books:
         title = find_work_title_by_book(item)
         listbox.insert(index, str(item["work_id"]) +"; "+ str(title))
         index += 1
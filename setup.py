@@ -16,5 +16,15 @@ setup(
         "jsonschema",
         "rfc3339-validator",
         "SQLAlchemy",
-    ]
+    ],
+    extras_require={
+        "fast": [
+            "fastjsonschema",
+            "orjson",
+        ],
+        "async": [
+            "aiosqlite",
+            "asgiref",
+        ],
+    }
 )
\ No newline at end of file
@@ -4,7 +4,7 @@ import tempfile
 import time
 from datetime import datetime
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, text
 from sqlalchemy.exc import IntegrityError, StatementError
 
 from librerian import create_app, db
@@ -29,6 +29,8 @@ def app():
     with app.app_context():
         db.create_all()
         yield app
+        db.session.remove()
+        db.engine.dispose()
     
     os.close(db_fd)
     os.unlink(db_fname)
@@ -261,4 +263,36 @@ def test_library_columns(app):
     db.session.add(library)
     with pytest.raises(IntegrityError):
         db.session.commit()
-    db.session.rollback()
\ No newline at end of file
+    db.session.rollback()
+
+def test_engine_profile(app):
+    """
+    Tests that the SQLite pragmas and the connection pool of create_app are applied
+    """
+    assert db.session.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+    assert db.session.execute(text("PRAGMA synchronous")).scalar() == 1
+    assert db.session.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+    assert db.session.execute(text("PRAGMA cache_size")).scalar() == -64000
+    assert db.engine.pool.size() == 5
+
+
+def test_generate_db(app):
+    """
+    Tests that generated data is reproducible, skewed and does not collide
+    with earlier rows
+    """
+    runner = app.test_cli_runner()
+    for _i in range(2):
+        result = runner.invoke(args=["gen-db", "--count", "50", "--seed", "7", "--chunk-size", "64"])
+        assert result.exit_code == 0, result.output
+        assert "rows/s" in result.output
+    db.session.expire_all()
+    assert User.query.count() == 2 * 50 + 2
+    assert Book.query.count() == 2 * 400 + 1
+    handles = [user.handle for user in User.query.order_by(User.id)]
+    assert [handle.split("-")[0] for handle in handles[:50]] == [
+        handle.split("-")[0] for handle in handles[52:]
+    ]
+    copies = sorted((work.total_copies for work in Work.query), reverse=True)
+    assert sum(copies) == Book.query.count()
+    assert copies[0] > 10 * copies[len(copies) // 2]
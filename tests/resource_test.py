@@ -1,19 +1,33 @@
+import asyncio
+import gzip
 import json
 import os
+import pickle
 import pytest
 import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from flask import url_for
 from flask.testing import FlaskClient
 from jsonschema import validate
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, text
 from sqlalchemy.exc import IntegrityError, StatementError
+from sqlalchemy.orm import lazyload
 from werkzeug.datastructures import Headers
 
 from librerian import create_app, db
-from librerian.models import User, Library, Book, Work
+from librerian.archive import read_archived_loans
+from librerian.models import User, Library, Book, Work, Loan
 from librerian.models import random_string, random_book, random_library, random_user, random_work
+from librerian.encoding import dumps, get_encoder
+from librerian.links import href
+from librerian.querylog import QueryBudgetExceeded
+from librerian.resources import book as book_resources
+from librerian.resources import library as library_resources
+from librerian.resources import work as work_resources
+from librerian import utils
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -21,12 +35,37 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.execute("PRAGMA foreign_keys=ON")
     cursor.close()
 
+# statement budgets of the endpoints with the test data, a request that goes
+# over its budget or repeats a SELECT more than 3 times fails the test
+QUERY_CHECKS = {
+    "N_PLUS_ONE_THRESHOLD": 3,
+    "QUERY_BUDGET_STRICT": True,
+    "QUERY_BUDGETS": {
+        "api.usercollection": 2,
+        "api.useritem": 3,
+        "api.userloancollection": 4,
+        "api.libraryglobalcollection": 2,
+        "api.librarylocalcollection": 3,
+        "api.libraryitem": 3,
+        "api.bookglobalcollection": 2,
+        "api.booklocalcollection": 6,
+        "api.bookbatch": 9,
+        "api.bookitem": 6,
+        "api.bookloan": 3,
+        "api.loancollection": 4,
+        "api.workcollection": 2,
+        "api.worksearch": 2,
+        "api.workitem": 4,
+    }
+}
+
 @pytest.fixture
 def client():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
+        "TESTING": True,
+        **QUERY_CHECKS
     }
     app = create_app(config)
     
@@ -36,6 +75,124 @@ def client():
 
     yield app.test_client()
 
+    with app.app_context():
+        db.engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+class _FakeCacheClient(object):
+    """
+    Local stand-in for an external cache client with the cachelib interface
+    Values are pickled like a networked cache would do
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value = self.data.get(key)
+        return None if value is None else pickle.loads(value)
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = pickle.dumps(value)
+        return True
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+        return list(mapping)
+
+    def add(self, key, value, timeout=None):
+        if key in self.data:
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        return self.data.pop(key, None) is not None
+
+@pytest.fixture(params=["lru", "client"])
+def cached_client(request):
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        **QUERY_CHECKS
+    }
+    if request.param == "lru":
+        config["RESPONSE_CACHE_SIZE"] = 1024
+    else:
+        config["RESPONSE_CACHE_CLIENT"] = _FakeCacheClient()
+    app = create_app(config)
+
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app.test_client()
+
+    with app.app_context():
+        db.engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+@pytest.fixture
+def replica_client():
+    db_fd, db_fname = tempfile.mkstemp()
+    replica_fd, replica_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_BINDS": {"replica": f"sqlite:///file:{replica_fname}?mode=ro&uri=true"},
+        "TESTING": True
+    }
+    app = create_app(config)
+
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+    assert app.test_cli_runner().invoke(args=["sync-replica"]).exit_code == 0
+
+    yield app
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+    # metadata of binds is kept on the shared db object across apps
+    db.metadatas.pop("replica", None)
+    for fd, fname in ((db_fd, db_fname), (replica_fd, replica_fname)):
+        os.close(fd)
+        os.unlink(fname)
+    # read-only connections cannot remove the WAL files of the replica
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(replica_fname + suffix):
+            os.unlink(replica_fname + suffix)
+
+@pytest.fixture
+def asgi_app(request):
+    pytest.importorskip("aiosqlite")
+    from librerian.asgi import create_asgi_app
+
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        **QUERY_CHECKS,
+        # extra config of tests parametrized indirectly
+        **getattr(request, "param", {})
+    }
+    app = create_asgi_app(config)
+
+    with app.flask_app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app
+
+    asyncio.run(app.dispose())
+    with app.flask_app.app_context():
+        db.engine.dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -91,6 +248,68 @@ def _populate_db():
         
     db.session.commit()
 
+def _count_queries(client, url):
+    """
+    Count SQL statements executed while serving a GET to url
+    """
+    statements = []
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        resp = client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
+    assert resp.status_code == 200
+    return len(statements)
+
+def _asgi_request(app, method, url, body=b"", headers=()):
+    """
+    Send a request to an ASGI app, returns status, headers and body
+    """
+    path, _, query = url.partition("?")
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers],
+        "http_version": "1.1",
+        "scheme": "http",
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 1234),
+    }
+    response = {"body": b""}
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {
+                name.decode(): value.decode() for name, value in message["headers"]
+            }
+        else:
+            response["body"] += message.get("body", b"")
+    asyncio.run(app(scope, receive, send))
+    return response["status"], response["headers"], response["body"]
+
+def _add_books(client, count):
+    """
+    Add count books to a new library, each with its own work
+    """
+    with client.application.app_context():
+        user = db.session.get(User, 1)
+        library = Library(owner=user, name=f"test-library-bulk-{count}")
+        for i in range(count):
+            book = random_book()
+            book.work = random_work()
+            library.books.append(book)
+        db.session.add(library)
+        db.session.commit()
+
 class TestUserCollection(object):
 
     RESOURCE_URL = "/api/users/"
@@ -108,6 +327,22 @@ class TestUserCollection(object):
             #assert "contact_phone" in item
 
 
+class TestUserItem(object):
+
+    RESOURCE_URL = "/api/users/test-user-handle-1/"
+
+    def test_put_renamed(self, client):
+        """
+        Tests that cached converter keys do not resolve a renamed user
+        """
+        assert client.get(self.RESOURCE_URL).status_code == 200
+        resp = client.put(self.RESOURCE_URL, json={"handle": "renamed", "email": "renamed@email.com"})
+        assert resp.status_code == 204
+        assert client.get(self.RESOURCE_URL).status_code == 404
+        assert client.get("/api/users/renamed/").status_code == 200
+        assert client.get("/api/users/renamed/libraries/test-library-number-1/").status_code == 200
+
+
 class TestLibraryCollection(object):
 
     RESOURCE_URL = "/api/libraries/"
@@ -141,6 +376,168 @@ class TestWorkCollection(object):
             assert "author" in item
             assert "cover" in item
             assert "isbn" in item
+
+    def test_get_filtered(self, client):
+        resp = client.get(self.RESOURCE_URL + "?isbn=0-2346-1819-2")
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["test-title-2"]
+        resp = client.get(self.RESOURCE_URL + "?author=test-author-no-books-3")
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["test-title-no-books-3"]
+        resp = client.get(self.RESOURCE_URL + "?title=test-title-no")
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 4
+        resp = client.get(self.RESOURCE_URL + "?title=test-title-no&limit=3")
+        body = json.loads(resp.data)
+        assert "title=test-title-no" in body["links"]["next"]["href"]
+        resp = client.get(body["links"]["next"]["href"])
+        assert [item["title"] for item in json.loads(resp.data)["items"]] == ["test-title-no-books-3"]
+        resp = client.get(self.RESOURCE_URL + "?isbn=foo")
+        assert json.loads(resp.data)["items"] == []
+
+    def test_get_paginated(self, client):
+        """
+        Tests walking the collection forwards and backwards with cursors
+        """
+        resp = client.get(self.RESOURCE_URL + "?limit=3")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == [
+            "test-title-no-books-0", "test-title-0", "test-title-no-books-1"
+        ]
+        assert "prev" not in body["links"]
+        titles = [item["title"] for item in body["items"]]
+        while "next" in body["links"]:
+            resp = client.get(body["links"]["next"]["href"])
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert len(body["items"]) <= 3
+            titles.extend(item["title"] for item in body["items"])
+        assert len(titles) == 8
+        assert len(set(titles)) == 8
+        assert len(body["items"]) == 2
+
+        resp = client.get(body["links"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == titles[3:6]
+        resp = client.get(body["links"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == titles[:3]
+        assert "prev" not in body["links"]
+        assert "next" in body["links"]
+
+    def test_post(self, client):
+        resp = client.post(self.RESOURCE_URL, json={"title": "new-title", "author": "new-author"})
+        assert resp.status_code == 201
+        resp = client.get(resp.headers["Location"])
+        assert json.loads(resp.data)["title"] == "new-title"
+
+        resp = client.post(self.RESOURCE_URL, json={"title": "new-title"})
+        assert resp.status_code == 400
+        assert b"'author' is a required property" in resp.data
+        resp = client.post(self.RESOURCE_URL, json={"title": "", "author": "new-author"})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, data="foo")
+        assert resp.status_code == 415
+
+    def test_get_invalid_page(self, client):
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=foo")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=%%%")
+        assert resp.status_code == 400
+
+
+class TestWorkBatch(object):
+
+    RESOURCE_URL = "/api/works/batch/"
+
+    def test_post(self, client):
+        docs = [{"title": f"batch-title-{i}", "author": "batch-author"} for i in range(50)]
+        docs.append({"title": "missing-author"})
+        docs.append({"id": 1, "title": "renamed", "author": "batch-author"})
+        docs.append({"id": 999, "title": "renamed", "author": "batch-author"})
+        resp = client.post(self.RESOURCE_URL, json=docs)
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert len(items) == 53
+        assert all(item["status"] == 201 for item in items[:50])
+        assert [item["status"] for item in items[50:]] == [400, 204, 404]
+        for i, item in enumerate(items[:50]):
+            body = json.loads(client.get(item["location"]).data)
+            assert body["title"] == f"batch-title-{i}"
+        assert json.loads(client.get("/api/works/1/").data)["title"] == "renamed"
+
+    def test_post_invalid(self, client):
+        resp = client.post(self.RESOURCE_URL, json={"title": "not-a-list", "author": "batch-author"})
+        assert resp.status_code == 400
+
+    def test_post_empty(self, client):
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == {"items": []}
+
+    def test_post_bool_id(self, client):
+        resp = client.post(self.RESOURCE_URL, json=[{"id": True, "title": "renamed", "author": "a"}])
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"][0]["status"] == 400
+        assert json.loads(client.get("/api/works/1/").data)["title"] != "renamed"
+
+
+class TestWorkSearch(object):
+
+    RESOURCE_URL = "/api/works/search/"
+
+    def test_get(self, client):
+        client.post("/api/works/", json={"title": "Crime and Punishment", "author": "Fyodor Dostoevsky"})
+        client.post("/api/works/", json={"title": "The Idiot", "author": "Fyodor Dostoevsky"})
+        client.post("/api/works/", json={"title": "Punishment Park", "author": "Someone Else"})
+        resp = client.get(self.RESOURCE_URL + "?q=punish")
+        assert resp.status_code == 200
+        titles = [item["title"] for item in json.loads(resp.data)["items"]]
+        assert sorted(titles) == ["Crime and Punishment", "Punishment Park"]
+        resp = client.get(self.RESOURCE_URL + "?q=dostoe+crime")
+        titles = [item["title"] for item in json.loads(resp.data)["items"]]
+        assert titles == ["Crime and Punishment"]
+        resp = client.get(self.RESOURCE_URL + "?q=test-title")
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 8
+
+        titles = []
+        url = self.RESOURCE_URL + "?q=test-title&limit=3"
+        while url:
+            body = json.loads(client.get(url).data)
+            titles.extend(item["title"] for item in body["items"])
+            url = body["links"].get("next", {}).get("href")
+        assert len(titles) == 8
+        assert len(set(titles)) == 8
+
+        assert client.get(self.RESOURCE_URL).status_code == 400
+        assert client.get(self.RESOURCE_URL + "?q=%20-").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?q=test&after=foo").status_code == 400
+
+    def test_get_synced(self, client):
+        """
+        Tests that the index follows updates and deletes of works
+        """
+        resp = client.post("/api/works/batch/", json=[{"id": 1, "title": "Renamed", "author": "Someone"}])
+        assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL + "?q=renamed")
+        assert len(json.loads(resp.data)["items"]) == 1
+        resp = client.get(self.RESOURCE_URL + "?q=test-author-no-books-0")
+        assert json.loads(resp.data)["items"] == []
+        assert client.delete("/api/works/1/").status_code == 200
+        resp = client.get(self.RESOURCE_URL + "?q=renamed")
+        assert json.loads(resp.data)["items"] == []
+
+        with client.application.app_context():
+            db.session.execute(text("DELETE FROM work_fts"))
+            db.session.commit()
+        assert json.loads(client.get(self.RESOURCE_URL + "?q=test").data)["items"] == []
+        result = client.application.test_cli_runner().invoke(args=["rebuild-fts"])
+        assert result.exit_code == 0
+        assert len(json.loads(client.get(self.RESOURCE_URL + "?q=test").data)["items"]) == 7
  
  
 class TestBookCollection(object):
@@ -156,6 +553,976 @@ class TestBookCollection(object):
             assert "status" in item
             assert "notes" in item
             assert "condition" in item
-            #assert "validity_start" in item
-            #assert "validity_end" in item
-            
\ No newline at end of file
+            assert "validity_start" in item
+            assert "validity_end" in item
+
+    def test_get_filtered(self, client):
+        with client.application.app_context():
+            book = db.session.get(Book, 3)
+            book.borrower = User.query.filter_by(handle="test-user-handle-1").first()
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL + "?work_id=4")
+        body = json.loads(resp.data)
+        assert [item["work_id"] for item in body["items"]] == [4]
+        resp = client.get(self.RESOURCE_URL + "?status=2")
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [2]
+        resp = client.get(self.RESOURCE_URL + "?library=test-library-number-3")
+        body = json.loads(resp.data)
+        assert [item["notes"] for item in body["items"]] == ["test-library-number-3"]
+        resp = client.get(self.RESOURCE_URL + "?borrower=test-user-handle-1&status=2")
+        body = json.loads(resp.data)
+        assert [item["notes"] for item in body["items"]] == ["test-library-number-2"]
+        resp = client.get(self.RESOURCE_URL + "?borrower=nobody")
+        assert json.loads(resp.data)["items"] == []
+        resp = client.get(self.RESOURCE_URL + "?work_id=foo")
+        assert resp.status_code == 400
+
+    def test_get_validity(self, client):
+        """
+        Tests validity window filters and that validity dates are serialized
+        """
+        windows = {
+            1: (datetime(2024, 1, 1), datetime(2024, 2, 1)),
+            2: (datetime(2024, 1, 15), datetime(2024, 3, 1)),
+            3: (datetime(2024, 2, 15), None),
+        }
+        with client.application.app_context():
+            for book_id, (start, end) in windows.items():
+                book = db.session.get(Book, book_id)
+                book.validity_start, book.validity_end = start, end
+            db.session.commit()
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["items"][0]["validity_start"] == "2024-01-01T00:00:00"
+        assert body["items"][0]["validity_end"] == "2024-02-01T00:00:00"
+        resp = client.get(self.RESOURCE_URL + "?valid_at=2024-01-20T12:00:00")
+        assert [item["notes"][-1] for item in json.loads(resp.data)["items"]] == ["0", "1"]
+        resp = client.get(self.RESOURCE_URL + "?valid_at=2024-02-01")
+        assert [item["notes"][-1] for item in json.loads(resp.data)["items"]] == ["1"]
+        resp = client.get(self.RESOURCE_URL + "?expiring_before=2024-03-01")
+        assert [item["notes"][-1] for item in json.loads(resp.data)["items"]] == ["0"]
+        resp = client.get(self.RESOURCE_URL + "?expiring_before=2024-03-02&valid_at=2024-02-10")
+        assert [item["notes"][-1] for item in json.loads(resp.data)["items"]] == ["1"]
+        resp = client.get(self.RESOURCE_URL + "?valid_at=2024-01-31T23:00:00-02:00")
+        assert [item["notes"][-1] for item in json.loads(resp.data)["items"]] == ["1"]
+        resp = client.get(self.RESOURCE_URL + "?expiring_before=2024-03-01T01:00:00%2B02:00")
+        assert [item["notes"][-1] for item in json.loads(resp.data)["items"]] == ["0"]
+        assert client.get(self.RESOURCE_URL + "?valid_at=tomorrow").status_code == 400
+
+    def test_get_validity_plan(self, client):
+        """
+        Tests that validity filters on their own read the validity index
+        """
+        with client.application.app_context():
+            engine = db.engine
+        def _plan(url):
+            statements = []
+            def _record(conn, cursor, statement, parameters, context, executemany):
+                if "FROM book" in statement:
+                    statements.append((statement, parameters))
+            event.listen(engine, "before_cursor_execute", _record)
+            try:
+                resp = client.get(url)
+                assert resp.status_code == 200
+                assert resp.data
+            finally:
+                event.remove(engine, "before_cursor_execute", _record)
+            statement, parameters = statements[-1]
+            with engine.connect() as conn:
+                rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+                return " ".join(row[3] for row in rows)
+
+        assert "ix_book_validity" in _plan(self.RESOURCE_URL + "?expiring_before=2024-03-01")
+        assert "ix_book_validity" in _plan(self.RESOURCE_URL + "?valid_at=2024-03-01&stream=true")
+        assert "ix_book_validity" not in _plan(self.RESOURCE_URL + "?valid_at=2024-03-01")
+        plan = _plan(self.RESOURCE_URL + "?expiring_before=2024-03-01&work_id=1")
+        assert "ix_book_validity" not in plan
+
+    def test_get_stream(self, client):
+        """
+        Tests that the streamed document matches the paginated one
+        """
+        _add_books(client, 10)
+        resp = client.get(self.RESOURCE_URL + "?stream=true")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        streamed = json.loads(resp.data)
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert streamed == body
+        assert len(streamed["items"]) == 14
+
+        client.application.config["STREAM_BATCH_SIZE"] = 3
+        resp = client.get(self.RESOURCE_URL + "?stream=true")
+        assert json.loads(resp.data) == body
+        with client.application.app_context():
+            assert db.engine.pool.checkedout() == 0
+
+    def test_get_query_count(self, client):
+        """
+        Tests that the number of queries does not grow with the number of books
+        """
+        before = _count_queries(client, self.RESOURCE_URL)
+        _add_books(client, 10)
+        after = _count_queries(client, self.RESOURCE_URL)
+        assert before == after
+
+    def test_get_conditional(self, client):
+        """
+        Tests that an unchanged collection is answered with 304 without reading
+        the books, and that a batch update changes the ETag
+        """
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        statements = []
+        def _record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", _record)
+        try:
+            resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        finally:
+            event.remove(engine, "before_cursor_execute", _record)
+        assert resp.status_code == 304
+        assert resp.data == b""
+        assert len(statements) == 1
+        assert "table_version" in statements[0]
+        assert client.get(self.RESOURCE_URL + "?status=1", headers={"If-None-Match": etag}).status_code == 200
+
+        resp = client.post(
+            "/api/users/test-user-handle-0/libraries/test-library-number-0/books/batch/",
+            json=[{"id": 1, "status": 2, "work_id": 2}]
+        )
+        assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+
+class TestBookBatch(object):
+
+    RESOURCE_URL = "/api/users/test-user-handle-0/libraries/test-library-number-0/books/batch/"
+
+    def test_post(self, client):
+        docs = [
+            {"status": 0, "work_id": 1, "notes": "batch-book"},
+            {"status": 7, "work_id": 1},
+            {"status": 0, "work_id": 999},
+            {"id": 1, "status": 2, "work_id": 3, "condition": "Worn"},
+            {"id": 2, "status": 0, "work_id": 1},
+            {"status": 0, "work_id": 2, "validity_start": "2024-05-16T10:00:00"},
+        ]
+        resp = client.post(self.RESOURCE_URL, json=docs)
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert [item["status"] for item in items] == [201, 400, 409, 204, 404, 201]
+        resp = client.get(items[0]["location"])
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["notes"] == "batch-book"
+        with client.application.app_context():
+            book_id = int(items[5]["location"].rstrip("/").rsplit("/", 1)[1])
+            assert db.session.get(Book, book_id).validity_start == datetime(2024, 5, 16, 10)
+            book = db.session.get(Book, 1)
+            assert book.status == 2
+            assert book.work_id == 3
+            assert book.condition == "Worn"
+            assert book.notes is None
+            assert Book.query.count() == 6
+
+    def test_post_invalid(self, client):
+        resp = client.post(self.RESOURCE_URL, json={"status": 0, "work_id": 1})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, data="foo")
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == {"items": []}
+
+
+class TestBookItem(object):
+
+    RESOURCE_URL = "/api/users/test-user-handle-0/libraries/test-library-number-0/books/1/"
+
+    def test_get_query_count(self, client):
+        """
+        Tests that the book item is served with one query per URL converter
+        """
+        assert _count_queries(client, self.RESOURCE_URL) == 3
+        assert client.get(self.RESOURCE_URL[:-2] + "999/").status_code == 404
+        assert client.get(self.RESOURCE_URL[:-2] + "foo/").status_code == 404
+
+    def test_put_if_match(self, client):
+        """
+        Tests optimistic concurrency with If-Match on book updates
+        """
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": etag}).status_code == 304
+        doc = {"status": 1, "work_id": 2, "notes": "updated"}
+        resp = client.put(self.RESOURCE_URL, json=doc, headers={"If-Match": etag})
+        assert resp.status_code == 204
+        resp = client.put(self.RESOURCE_URL, json=doc, headers={"If-Match": etag})
+        assert resp.status_code == 412
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["notes"] == "updated"
+        with client.application.app_context():
+            assert db.session.get(Book, 1).version == 2
+
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        resp = client.put(
+            "/api/users/test-user-handle-0/", json={"handle": "renamed", "email": "renamed@email.com"}
+        )
+        assert resp.status_code == 204
+        url = "/api/users/renamed/libraries/test-library-number-0/books/1/"
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+    def test_put_invalid_date(self, client):
+        """
+        Tests that a malformed validity date is answered with 400 and changes nothing
+        """
+        doc = {"status": 1, "work_id": 2, "notes": "updated", "validity_start": "bad"}
+        resp = client.put(self.RESOURCE_URL, json=doc)
+        assert resp.status_code == 400
+        assert "bad" in resp.get_data(as_text=True)
+        assert json.loads(client.get(self.RESOURCE_URL).data)["notes"] != "updated"
+        resp = client.post(self.RESOURCE_URL[:-2], json=doc)
+        assert resp.status_code == 400
+
+
+class TestBookLocalCollection(object):
+
+    RESOURCE_URL = "/api/users/test-user-handle-0/libraries/test-library-bulk-10/books/"
+
+    def test_get_query_count(self, client):
+        """
+        Tests that the number of queries does not grow with the number of books
+        """
+        _add_books(client, 10)
+        before = _count_queries(client, self.RESOURCE_URL)
+        with client.application.app_context():
+            library = Library.query.filter_by(name="test-library-bulk-10").first()
+            for i in range(10):
+                book = random_book()
+                book.work = random_work()
+                library.books.append(book)
+            db.session.commit()
+        after = _count_queries(client, self.RESOURCE_URL)
+        assert before == after
+
+
+class TestWorkItem(object):
+
+    RESOURCE_URL = "/api/works/2/"
+
+    def test_get_query_count(self, client):
+        """
+        Tests that the number of queries does not grow with the number of copies
+        """
+        before = _count_queries(client, self.RESOURCE_URL)
+        with client.application.app_context():
+            work = db.session.get(Work, 2)
+            for library in Library.query.all():
+                for i in range(5):
+                    book = random_book()
+                    library.books.append(book)
+                    book.work = work
+            db.session.commit()
+        after = _count_queries(client, self.RESOURCE_URL)
+        assert before == after
+
+    def test_put(self, client):
+        """
+        Tests that put modifies the work in place and changes its ETag
+        """
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        doc = {"title": "renamed-title", "author": "renamed-author"}
+        resp = client.put(self.RESOURCE_URL, json=doc, headers={"If-Match": '"stale"'})
+        assert resp.status_code == 412
+        resp = client.put(self.RESOURCE_URL, json=doc, headers={"If-Match": etag})
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["title"] == "renamed-title"
+        with client.application.app_context():
+            assert Work.query.count() == 8
+
+
+    def test_copies(self, client):
+        """
+        Tests that copy counters follow book inserts, updates and deletes
+        and that recount-copies repairs them
+        """
+        def copies(url):
+            body = json.loads(client.get(url).data)
+            return body["total_copies"], body["available_copies"], body["borrowed_copies"]
+
+        assert copies(self.RESOURCE_URL) == (1, 1, 0)
+        assert copies("/api/works/4/") == (1, 0, 1)
+        assert copies("/api/works/6/") == (1, 0, 0)
+        library_url = "/api/users/test-user-handle-0/libraries/test-library-number-0/books/"
+        resp = client.post(library_url, json={"status": 1, "work_id": 2})
+        assert resp.status_code == 201
+        assert copies(self.RESOURCE_URL) == (2, 1, 1)
+        resp = client.put(resp.headers["Location"], json={"status": 0, "work_id": 4})
+        assert resp.status_code == 204
+        assert copies(self.RESOURCE_URL) == (1, 1, 0)
+        assert copies("/api/works/4/") == (2, 1, 1)
+        resp = client.post(library_url + "batch/", json=[{"id": 1, "status": 1, "work_id": 2}])
+        assert resp.status_code == 200
+        assert copies(self.RESOURCE_URL) == (1, 0, 1)
+        assert client.delete(library_url + "1/").status_code == 200
+        assert copies(self.RESOURCE_URL) == (0, 0, 0)
+
+        with client.application.app_context():
+            db.session.execute(text("UPDATE work SET total_copies = 7, available_copies = 7"))
+            db.session.commit()
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        result = client.application.test_cli_runner().invoke(args=["recount-copies"])
+        assert result.exit_code == 0
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert copies(self.RESOURCE_URL) == (0, 0, 0)
+        assert copies("/api/works/4/") == (2, 1, 1)
+        resp = client.get("/api/works/?available=true")
+        assert [item["links"]["self"]["href"] for item in json.loads(resp.data)["items"]] == ["/api/works/4/"]
+
+
+class TestBookLoan(object):
+
+    RESOURCE_URL = "/api/books/1/loan/"
+    BOOK_URL = "/api/users/test-user-handle-0/libraries/test-library-number-0/books/1/"
+
+    def test_borrow_return(self, client):
+        """
+        Tests borrowing and returning a book and the loan history
+        """
+        assert client.get(self.RESOURCE_URL).status_code == 404
+        etag = client.get(self.BOOK_URL).headers["ETag"]
+        doc = {"borrower": "test-user-handle-1", "validity_end": "2024-03-15T12:00:00"}
+        resp = client.post(self.RESOURCE_URL, json=doc)
+        assert resp.status_code == 201
+        assert resp.headers["Location"] == self.RESOURCE_URL
+        assert client.post(self.RESOURCE_URL, json=doc).status_code == 409
+
+        resp = client.get(self.BOOK_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["status"] == 1
+        assert body["validity_end"] == "2024-03-15T12:00:00"
+        body = json.loads(client.get("/api/works/2/").data)
+        assert (body["available_copies"], body["borrowed_copies"]) == (0, 1)
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["borrower"] == "test-user-handle-1"
+        assert body["returned_at"] is None
+        assert body["links"]["borrower"]["href"] == "/api/users/test-user-handle-1/"
+
+        assert client.delete(self.RESOURCE_URL).status_code == 204
+        assert client.delete(self.RESOURCE_URL).status_code == 409
+        assert client.get(self.RESOURCE_URL).status_code == 404
+        assert json.loads(client.get(self.BOOK_URL).data)["status"] == 0
+        assert client.post(self.RESOURCE_URL, json={"borrower": "test-user-handle-2"}).status_code == 201
+        items = json.loads(client.get("/api/books/1/loans/").data)["items"]
+        assert [item["borrower"] for item in items] == ["test-user-handle-1", "test-user-handle-2"]
+        assert items[0]["returned_at"] is not None
+        assert items[1]["returned_at"] is None
+
+    def test_borrow_invalid(self, client):
+        """
+        Tests borrow requests for missing books and borrowers and invalid bodies
+        """
+        assert client.post("/api/books/99/loan/", json={"borrower": "test-user-handle-1"}).status_code == 404
+        assert client.delete("/api/books/99/loan/").status_code == 404
+        assert client.get("/api/books/99/loans/").status_code == 404
+        assert client.post(self.RESOURCE_URL, json={"borrower": "nobody"}).status_code == 409
+        assert client.post(self.RESOURCE_URL, json={"status": 1}).status_code == 400
+        doc = {"borrower": "test-user-handle-1", "validity_end": "soon"}
+        assert client.post(self.RESOURCE_URL, json=doc).status_code == 400
+        assert client.post(self.RESOURCE_URL, data="borrower").status_code == 415
+        assert json.loads(client.get("/api/books/1/loans/").data)["items"] == []
+
+    def test_borrow_concurrent(self, client):
+        """
+        Tests that only one of concurrent borrow requests for a book succeeds
+        """
+        app = client.application
+        def borrow(i):
+            doc = {"borrower": f"test-user-handle-{i % 4}"}
+            return app.test_client().post(self.RESOURCE_URL, json=doc).status_code
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            statuses = list(pool.map(borrow, range(16)))
+        assert statuses.count(201) == 1
+        assert statuses.count(409) == 15
+        with app.app_context():
+            assert Loan.query.filter_by(book_id=1).count() == 1
+
+
+    def test_archive(self, client, tmp_path):
+        """
+        Tests that archived loans are listed with the live ones
+        """
+        app = client.application
+        app.config["LOAN_ARCHIVE_DIR"] = str(tmp_path)
+        for i in (1, 2, 3, 1):
+            assert client.post(self.RESOURCE_URL, json={"borrower": f"test-user-handle-{i}"}).status_code == 201
+            assert client.delete(self.RESOURCE_URL).status_code == 204
+        client.post(self.RESOURCE_URL, json={"borrower": "test-user-handle-1"})
+        runner = app.test_cli_runner()
+        with app.app_context():
+            ids = [loan.id for loan in Loan.query.filter_by(book_id=1).order_by(Loan.id)]
+            db.session.get(Loan, ids[0]).borrowed_at = datetime(2020, 1, 5, 10)
+            db.session.commit()
+        result = runner.invoke(args=["archive-loans", "--format", "sqlite"])
+        assert result.exit_code == 0
+        assert "Archived 1 loans" in result.output
+        with app.app_context():
+            db.session.get(Loan, ids[1]).borrowed_at = datetime(2020, 2, 10, 10)
+            db.session.get(Loan, ids[2]).borrowed_at = datetime(2020, 2, 20, 10)
+            db.session.commit()
+        assert runner.invoke(args=["archive-loans", "--format", "ndjson"]).exit_code == 0
+        assert sorted(os.listdir(tmp_path)) == ["loans-2020-01.sqlite", "loans-2020-02.ndjson.gz"]
+        with app.app_context():
+            assert Loan.query.filter_by(book_id=1).count() == 2
+
+        borrowers = [f"test-user-handle-{i}" for i in (1, 2, 3, 1, 1)]
+        items = json.loads(client.get("/api/books/1/loans/").data)["items"]
+        assert [item["borrower"] for item in items] == borrowers
+        assert items[0]["borrowed_at"] == "2020-01-05T10:00:00"
+        assert [item["returned_at"] is None for item in items] == [False] * 4 + [True]
+
+        url = "/api/books/1/loans/?limit=2"
+        pages = []
+        while url:
+            body = json.loads(client.get(url).data)
+            pages.append([item["borrower"] for item in body["items"]])
+            url = body["links"].get("next", {}).get("href")
+        assert sum(pages, []) == borrowers
+        url = body["links"]["prev"]["href"]
+        body = json.loads(client.get(url).data)
+        assert [item["borrower"] for item in body["items"]] == borrowers[2:4]
+
+        resp = client.get("/api/books/1/loans/?since=2020-02-01&until=2020-03-01")
+        items = json.loads(resp.data)["items"]
+        assert [item["borrower"] for item in items] == borrowers[1:3]
+        resp = client.get(
+            "/api/books/1/loans/?since=2020-02-10T12:00:00%2B02:00&until=2020-03-01T00:00:00Z"
+        )
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert [item["borrowed_at"] for item in items] == ["2020-02-10T10:00:00", "2020-02-20T10:00:00"]
+        assert client.get("/api/books/1/loans/?since=soon").status_code == 400
+        items = json.loads(client.get("/api/users/test-user-handle-1/loans/").data)["items"]
+        assert items[0]["borrowed_at"].startswith("2020-01")
+        assert len(items) == 3
+
+        # a rerun after a failed delete appends the same loans again
+        path = tmp_path / "loans-2020-02.ndjson.gz"
+        path.write_bytes(path.read_bytes() * 2)
+        records = read_archived_loans(str(tmp_path), "book_id", 1, since=datetime(2020, 2, 1), limit=2)
+        assert [record["id"] for record in records] == ids[1:3]
+        records = read_archived_loans(str(tmp_path), "book_id", 1, before=ids[3], limit=2)
+        assert [record["id"] for record in records] == [ids[2], ids[1]]
+
+
+class TestExport(object):
+
+    RESOURCE_URL = "/api/export/"
+
+    def test_get(self, client):
+        for resource, count in (("users", 4), ("libraries", 4), ("books", 4), ("works", 8)):
+            resp = client.get(self.RESOURCE_URL + resource + "/")
+            assert resp.status_code == 200
+            assert resp.mimetype == "application/x-ndjson"
+            lines = resp.data.decode().splitlines()
+            assert len(lines) == count
+            records = [json.loads(line) for line in lines]
+            assert [record["id"] for record in records] == list(range(1, count + 1))
+        resp = client.get(self.RESOURCE_URL + "books/")
+        records = [json.loads(line) for line in resp.data.decode().splitlines()]
+        with client.application.app_context():
+            for record in records:
+                book = db.session.get(Book, record["id"])
+                assert book.library_id == record["library_id"]
+                assert book.work_id == record["work_id"]
+        resp = client.get(self.RESOURCE_URL + "libraries/")
+        records = [json.loads(line) for line in resp.data.decode().splitlines()]
+        with client.application.app_context():
+            for record in records:
+                assert db.session.get(Library, record["id"]).owner_id == record["owner_id"]
+
+    def test_get_gzip(self, client):
+        _add_books(client, 10)
+        plain = client.get(self.RESOURCE_URL + "books/")
+        resp = client.get(self.RESOURCE_URL + "books/", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == plain.data
+        assert len(plain.data.decode().splitlines()) == 14
+
+    def test_get_gzip_refused(self, client):
+        for accept in ("gzip;q=0", "*;q=0", "identity"):
+            resp = client.get(self.RESOURCE_URL + "books/", headers={"Accept-Encoding": accept})
+            assert resp.status_code == 200
+            assert "Content-Encoding" not in resp.headers
+            assert len(resp.data.decode().splitlines()) == 4
+        resp = client.get(self.RESOURCE_URL + "books/", headers={"Accept-Encoding": "*"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+
+
+class TestLinks(object):
+
+    KEYS = ["plain", "with space", "ä/ö%20'", "x?y#z&w=1", "~-._!*()", "%(user)s"]
+
+    def test_href(self, client):
+        """
+        Tests that compiled link templates match url_for byte for byte
+        """
+        app = client.application
+        with app.test_request_context("/"):
+            for key in self.KEYS:
+                values = {
+                    "user": User(handle=key),
+                    "library": Library(name=key),
+                    "book": Book(id=len(key)),
+                    "work": Work(id=len(key) + 1)
+                }
+                for rule in app.url_map.iter_rules():
+                    if not rule.endpoint.startswith("api."):
+                        continue
+                    args = {name: values[name] for name in rule.arguments}
+                    assert href(rule.endpoint, **args) == url_for(rule.endpoint, **args)
+            assert href("api.workcollection", limit=5) == url_for("api.workcollection", limit=5)
+
+
+class TestResponseCache(object):
+
+    BOOKS_URL = "/api/books/"
+    LIBRARY_URL = "/api/users/test-user-handle-{0}/libraries/test-library-number-{0}/"
+    WORK_URL = "/api/works/2/"
+
+    def test_get(self, cached_client):
+        """
+        Tests that repeated reads are served from the cache without queries
+        """
+        assert cached_client.get(self.BOOKS_URL).headers["X-Cache"] == "MISS"
+        resp = cached_client.get(self.BOOKS_URL)
+        assert resp.headers["X-Cache"] == "HIT"
+        assert len(json.loads(resp.data)["items"]) == 4
+        assert _count_queries(cached_client, self.BOOKS_URL) == 0
+        assert cached_client.get(self.BOOKS_URL + "?status=1").headers["X-Cache"] == "MISS"
+        resp = cached_client.get(self.BOOKS_URL, headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+        assert cached_client.get(self.BOOKS_URL + "?stream=true").headers["X-Cache"] == "MISS"
+        assert cached_client.get(self.BOOKS_URL + "?stream=true").headers["X-Cache"] == "MISS"
+        cache = cached_client.application.extensions["response_cache"]
+        assert cache.stats() == {"hits": 3, "misses": 4}
+
+    def test_book_write(self, cached_client):
+        """
+        Tests that a book write evicts its library, the book lists, its work and
+        the work list, which shows copy counters
+        """
+        urls = [
+            self.BOOKS_URL,
+            self.LIBRARY_URL.format(0) + "books/",
+            self.LIBRARY_URL.format(1) + "books/",
+            self.LIBRARY_URL.format(0) + "books/1/",
+            self.WORK_URL,
+            "/api/works/4/",
+            "/api/works/",
+        ]
+        for url in urls:
+            cached_client.get(url)
+        resp = cached_client.put(
+            self.LIBRARY_URL.format(0) + "books/1/", json={"status": 1, "work_id": 2, "notes": "cached"}
+        )
+        assert resp.status_code == 204
+        states = [cached_client.get(url).headers["X-Cache"] for url in urls]
+        assert states == ["MISS", "MISS", "HIT", "MISS", "MISS", "HIT", "MISS"]
+        resp = cached_client.get(self.LIBRARY_URL.format(0) + "books/1/")
+        assert json.loads(resp.data)["notes"] == "cached"
+
+    def test_loan(self, cached_client):
+        """
+        Tests that borrowing and returning evict the book, its work and its loans
+        """
+        urls = [
+            self.LIBRARY_URL.format(0) + "books/1/",
+            self.LIBRARY_URL.format(1) + "books/",
+            self.WORK_URL,
+            "/api/books/1/loans/",
+        ]
+        for url in urls:
+            cached_client.get(url)
+        resp = cached_client.post("/api/books/1/loan/", json={"borrower": "test-user-handle-1"})
+        assert resp.status_code == 201
+        states = [cached_client.get(url).headers["X-Cache"] for url in urls]
+        assert states == ["MISS", "HIT", "MISS", "MISS"]
+        resp = cached_client.get("/api/books/1/loans/")
+        assert len(json.loads(resp.data)["items"]) == 1
+        assert cached_client.delete("/api/books/1/loan/").status_code == 204
+        states = [cached_client.get(url).headers["X-Cache"] for url in urls]
+        assert states == ["MISS", "HIT", "MISS", "MISS"]
+        resp = cached_client.get(self.LIBRARY_URL.format(0) + "books/1/")
+        assert json.loads(resp.data)["status"] == 0
+
+    def test_rename(self, cached_client):
+        """
+        Tests that renaming a user evicts the responses with links that contain the handle
+        """
+        urls = [
+            "/api/users/",
+            self.LIBRARY_URL.format(1),
+            self.LIBRARY_URL.format(1) + "books/",
+            "/api/works/",
+        ]
+        for url in urls:
+            cached_client.get(url)
+        resp = cached_client.put(
+            "/api/users/test-user-handle-1/", json={"handle": "renamed", "email": "renamed@email.com"}
+        )
+        assert resp.status_code == 204
+        assert cached_client.get(urls[0]).headers["X-Cache"] == "MISS"
+        assert cached_client.get(urls[1]).status_code == 404
+        assert cached_client.get(urls[2]).status_code == 404
+        assert cached_client.get(urls[3]).headers["X-Cache"] == "HIT"
+        resp = cached_client.get("/api/libraries/")
+        assert "/api/users/renamed/" in resp.data.decode()
+
+    def test_write_during_load(self, cached_client, monkeypatch):
+        """
+        Tests that an item loaded by its URL converter before a write is not
+        cached under the tokens of the write
+        """
+        load = utils._load
+        def _load_then_write(model, key_name, key, options):
+            instance = load(model, key_name, key, options)
+            monkeypatch.setattr(utils, "_load", load)
+            with db.engine.begin() as conn:
+                conn.execute(
+                    Work.__table__.update().where(Work.id == 2)
+                    .values(title="renamed", version=Work.version + 1)
+                )
+            cached_client.application.extensions["response_cache"].invalidate("work:2")
+            return instance
+        monkeypatch.setattr(utils, "_load", _load_then_write)
+        resp = cached_client.get(self.WORK_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        assert json.loads(resp.data)["title"] != "renamed"
+        resp = cached_client.get(self.WORK_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        assert json.loads(resp.data)["title"] == "renamed"
+        assert cached_client.get(self.WORK_URL).headers["X-Cache"] == "HIT"
+
+
+class TestReplicaRouting(object):
+
+    RESOURCE_URL = "/api/works/"
+
+    def test_get(self, replica_client):
+        """
+        Tests that reads go to the replica, except for clients that have just written
+        """
+        writer = replica_client.test_client()
+        reader = replica_client.test_client()
+        resp = writer.post(self.RESOURCE_URL, json={"title": "replicated", "author": "replicated"})
+        assert resp.status_code == 201
+        location = resp.headers["Location"]
+        assert writer.get(location).status_code == 200
+        assert len(json.loads(writer.get(self.RESOURCE_URL).data)["items"]) == 9
+        assert reader.get(location).status_code == 404
+        assert len(json.loads(reader.get(self.RESOURCE_URL).data)["items"]) == 8
+
+        writer.delete_cookie("librerian_primary")
+        assert writer.get(location).status_code == 404
+
+        assert replica_client.test_cli_runner().invoke(args=["sync-replica"]).exit_code == 0
+        assert reader.get(location).status_code == 200
+        resp = reader.get("/api/works/search/?q=replicated")
+        assert len(json.loads(resp.data)["items"]) == 1
+
+
+class TestAsgi(object):
+
+    URLS = [
+        "/api/works/",
+        "/api/works/?limit=3&after=Mg",
+        "/api/works/?author=test-author-1",
+        "/api/works/2/",
+        "/api/books/?status=1",
+        "/api/libraries/?limit=2",
+    ]
+
+    def test_get(self, asgi_app):
+        """
+        Tests that the async handlers produce the same responses as the Flask app
+        without passing the request to it
+        """
+        client = asgi_app.flask_app.test_client()
+        expected = [client.get(url) for url in self.URLS]
+        fallback = asgi_app.fallback
+        asgi_app.fallback = None
+        for url, resp in zip(self.URLS, expected):
+            status, headers, body = _asgi_request(asgi_app, "GET", url)
+            assert status == 200
+            assert body == resp.data
+            assert headers["etag"] == resp.headers["ETag"]
+            status, _, body = _asgi_request(
+                asgi_app, "GET", url, headers=[("If-None-Match", resp.headers["ETag"])]
+            )
+            assert status == 304
+            assert body == b""
+        asgi_app.fallback = fallback
+
+    def test_fallback(self, asgi_app):
+        """
+        Tests that other requests and errors are served by the Flask app
+        """
+        status, _, _ = _asgi_request(
+            asgi_app, "POST", "/api/works/", body=b'{"title": "async", "author": "async"}',
+            headers=[("Content-Type", "application/json"), ("Content-Length", "37")]
+        )
+        assert status == 201
+        status, _, body = _asgi_request(asgi_app, "GET", "/api/works/?author=async")
+        assert status == 200
+        assert len(json.loads(body)["items"]) == 1
+        assert _asgi_request(asgi_app, "GET", "/api/works/999/")[0] == 404
+        assert _asgi_request(asgi_app, "GET", "/api/works/?limit=0")[0] == 400
+        assert _asgi_request(asgi_app, "GET", "/api/users/")[0] == 200
+        status, _, body = _asgi_request(asgi_app, "GET", "/api/books/?stream=true")
+        assert status == 200
+        assert len(json.loads(body)["items"]) == 4
+
+    def test_observed(self, asgi_app):
+        """
+        Tests that the async handlers are counted by the metrics and checked
+        against their query budget
+        """
+        asgi_app.fallback = None
+        for url in ("/api/books/", "/api/books/?status=1", "/api/works/2/"):
+            assert _asgi_request(asgi_app, "GET", url)[0] == 200
+        samples = TestMetrics()._metrics(asgi_app.flask_app.test_client())
+        labels = '{endpoint="api.bookglobalcollection",method="GET"}'
+        assert samples["librerian_request_duration_seconds_count" + labels] == 2
+        assert samples["librerian_sql_queries_total" + labels] >= 4
+        assert samples["librerian_serialize_duration_seconds_total" + labels] > 0
+        assert samples[
+            'librerian_requests_total{endpoint="api.workitem",method="GET",status="200"}'
+        ] == 1
+        asgi_app.flask_app.config["QUERY_BUDGETS"] = {"api.bookglobalcollection": 1}
+        with pytest.raises(QueryBudgetExceeded, match="over the budget of 1"):
+            _asgi_request(asgi_app, "GET", "/api/books/")
+
+    @pytest.mark.parametrize("asgi_app", [{"RESPONSE_CACHE_SIZE": 1024}], indirect=True)
+    def test_cache(self, asgi_app):
+        """
+        Tests that the async handlers store their responses in the response cache
+        and that writes through the Flask app invalidate them
+        """
+        fallback = asgi_app.fallback
+        asgi_app.fallback = None
+        for url in ("/api/works/2/", "/api/works/"):
+            status, headers, body = _asgi_request(asgi_app, "GET", url)
+            assert status == 200
+            assert headers["x-cache"] == "MISS"
+            status, headers, cached = _asgi_request(asgi_app, "GET", url)
+            assert headers["x-cache"] == "HIT"
+            assert cached == body
+        count = len(json.loads(body)["items"])
+        asgi_app.fallback = fallback
+        status, _, _ = _asgi_request(
+            asgi_app, "POST", "/api/works/", body=b'{"title": "async", "author": "async"}',
+            headers=[("Content-Type", "application/json"), ("Content-Length", "37")]
+        )
+        assert status == 201
+        asgi_app.fallback = None
+        status, headers, body = _asgi_request(asgi_app, "GET", "/api/works/")
+        assert headers["x-cache"] == "MISS"
+        assert len(json.loads(body)["items"]) == count + 1
+        asgi_app.fallback = fallback
+
+
+class TestMetrics(object):
+
+    BOOKS_URL = "/api/books/"
+
+    def _metrics(self, client):
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        samples = {}
+        for line in resp.data.decode().splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_get(self, client):
+        """
+        Tests that requests are counted per endpoint with their queries, serialisation
+        time and response size
+        """
+        size = len(client.get(self.BOOKS_URL).data)
+        client.get(self.BOOKS_URL + "?status=1")
+        assert client.post("/api/works/", json={"title": "metrics"}).status_code == 400
+        queries = _count_queries(client, self.BOOKS_URL)
+        samples = self._metrics(client)
+        labels = '{endpoint="api.bookglobalcollection",method="GET"}'
+        assert samples["librerian_request_duration_seconds_count" + labels] == 3
+        assert samples[
+            'librerian_request_duration_seconds_bucket{endpoint="api.bookglobalcollection",'
+            'method="GET",le="+Inf"}'
+        ] == 3
+        assert samples["librerian_request_duration_seconds_sum" + labels] > 0
+        assert samples["librerian_sql_queries_total" + labels] >= 2 * queries
+        assert samples["librerian_sql_duration_seconds_total" + labels] > 0
+        assert samples["librerian_serialize_duration_seconds_total" + labels] > 0
+        assert samples["librerian_response_bytes_total" + labels] > 2 * size
+        assert samples[
+            'librerian_requests_total{endpoint="api.workcollection",method="POST",status="400"}'
+        ] == 1
+
+    def test_failed_statements(self, client):
+        """
+        Tests that statements that fail leave nothing behind on the connection
+        """
+        def connection_state():
+            with client.application.app_context():
+                connection = db.engine.raw_connection()
+                try:
+                    return {key: len(value) for key, value in connection.info.items()}
+                finally:
+                    connection.close()
+
+        client.get(self.BOOKS_URL)
+        before = connection_state()
+        user = {"handle": "test-user-handle-0", "email": "duplicate@email.com"}
+        for _i in range(5):
+            assert client.post("/api/users/", json=user).status_code == 409
+        assert connection_state() == before
+
+    def test_server_timing(self, client):
+        """
+        Tests that Server-Timing is only sent to requests with the configured token
+        """
+        assert "Server-Timing" not in client.get(self.BOOKS_URL).headers
+        client.application.config["SERVER_TIMING_TOKEN"] = "secret"
+        assert "Server-Timing" not in client.get(self.BOOKS_URL).headers
+        resp = client.get(self.BOOKS_URL, headers={"X-Server-Timing": "wrong"})
+        assert "Server-Timing" not in resp.headers
+        resp = client.get(self.BOOKS_URL, headers={"X-Server-Timing": "secret"})
+        timings = [metric.split(";")[0] for metric in resp.headers["Server-Timing"].split(", ")]
+        assert timings == ["sql", "serialize", "total"]
+
+    def test_cache(self, cached_client):
+        """
+        Tests that cache hits are counted and timings are not replayed from the cache
+        """
+        cached_client.application.config["SERVER_TIMING_TOKEN"] = "secret"
+        resp = cached_client.get(self.BOOKS_URL, headers={"X-Server-Timing": "secret"})
+        assert "Server-Timing" in resp.headers
+        resp = cached_client.get(self.BOOKS_URL)
+        assert resp.headers["X-Cache"] == "HIT"
+        assert "Server-Timing" not in resp.headers
+        samples = self._metrics(cached_client)
+        assert samples["librerian_response_cache_hits_total"] == 1
+        assert samples[
+            'librerian_request_duration_seconds_count{endpoint="api.bookglobalcollection",'
+            'method="GET"}'
+        ] == 1
+
+class TestQueryLog(object):
+
+    def test_budget(self, client):
+        """
+        Tests that a request over its statement budget fails in strict mode
+        """
+        client.application.config["QUERY_BUDGETS"] = {"api.bookglobalcollection": 1}
+        with pytest.raises(QueryBudgetExceeded, match="over the budget of 1"):
+            client.get("/api/books/")
+
+    def test_n_plus_one(self, client, monkeypatch):
+        """
+        Tests that a listing that loads the owner of each library separately fails
+        """
+        monkeypatch.setattr(library_resources, "joinedload", lazyload)
+        with pytest.raises(QueryBudgetExceeded, match="N\\+1 query, 4 times: SELECT"):
+            client.get("/api/libraries/")
+
+    def test_slow_query(self, client, caplog):
+        """
+        Tests that slow statements are logged with their query plan
+        """
+        client.application.config["SLOW_QUERY_SECONDS"] = 0
+        client.application.config["QUERY_BUDGET_STRICT"] = False
+        with caplog.at_level("WARNING"):
+            assert client.get("/api/books/?status=1").status_code == 200
+        messages = [record.getMessage() for record in caplog.records]
+        assert any("Slow query" in message and "\nPlan:\n  SCAN" in message for message in messages)
+
+    def test_slow_query_parameters(self, client, caplog):
+        """
+        Tests that slow writes are logged without a plan and with cut parameters
+        """
+        client.application.config["SLOW_QUERY_SECONDS"] = 0
+        docs = [
+            {"title": f"slow-title-{i}" * 10, "author": "slow-author", "version": 1}
+            for i in range(200)
+        ]
+        with caplog.at_level("WARNING"), client.application.app_context():
+            with db.engine.begin() as conn:
+                conn.execute(Work.__table__.insert(), docs)
+                conn.execute(
+                    text("UPDATE work SET author = :author WHERE id = :id"),
+                    [{"author": "slow-author", "id": i} for i in range(1, 4)]
+                )
+        messages = [record.getMessage() for record in caplog.records]
+        assert messages
+        for message in messages:
+            assert "Plan:" not in message
+            assert len(message.partition("\nParameters: ")[2]) < 600
+        assert any("Parameters: 3 rows, first ('slow-author', 1)" in message for message in messages)
+
+class TestEncoding(object):
+
+    URLS = ("/api/books/", "/api/books/?stream=true", "/api/works/2/", "/api/export/books/")
+
+    def test_encoders(self, client):
+        """
+        Tests that the stdlib and orjson encoders produce the same bodies and encode datetimes
+        """
+        pytest.importorskip("orjson")
+        doc = {"at": datetime(2024, 1, 1, 12, 30), "name": "Brontë", 1: [None, 1.5]}
+        expected = b'{"at":"2024-01-01T12:30:00","name":"Bront\xc3\xab","1":[null,1.5]}'
+        assert get_encoder("json").dumps(doc) == expected
+        assert get_encoder("orjson").dumps(doc) == expected
+
+        bodies = {}
+        for name in ("json", "orjson"):
+            client.application.extensions["json_encoder"] = get_encoder(name)
+            bodies[name] = [client.get(url).data for url in self.URLS]
+        assert bodies["json"] == bodies["orjson"]
+        assert len(json.loads(bodies["json"][1])["items"]) == 4
+
+class TestProjection(object):
+
+    def test_items(self, client):
+        """
+        Tests that listings built from plain rows have the same items as the models give
+        """
+        with client.application.app_context():
+            book = db.session.get(Book, 2)
+            book.validity_start, book.validity_end = datetime(2024, 1, 1), datetime(2024, 2, 1, 8)
+            db.session.commit()
+        _add_books(client, 3)
+        for url, model, itemize in (
+            ("/api/books/", Book, book_resources.itemize),
+            ("/api/works/", Work, work_resources.itemize),
+        ):
+            items = json.loads(client.get(url).data)["items"]
+            with client.application.test_request_context():
+                rows = model.query.order_by(model.id).all()
+                expected = json.loads(dumps([itemize(row) for row in rows]))
+            assert items == expected
+        items = json.loads(client.get("/api/books/?stream=true").data)["items"]
+        assert items[1]["validity_end"] == "2024-02-01T08:00:00"